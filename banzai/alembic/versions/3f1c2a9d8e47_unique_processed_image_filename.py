@@ -0,0 +1,35 @@
+"""Make processed image filenames unique.
+
+Duplicate rows for the same filename are removed before the unique index is
+created, keeping the most recently added row for each filename.
+
+Revision ID: 3f1c2a9d8e47
+Revises: 5b5b96094c33
+Create Date: 2026-10-17 09:12:41.318207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c2a9d8e47'
+down_revision: Union[str, Sequence[str], None] = '5b5b96094c33'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute(
+        'DELETE FROM processedimages WHERE id NOT IN '
+        '(SELECT MAX(id) FROM processedimages GROUP BY filename)'
+    )
+    op.drop_index(op.f('ix_processedimages_filename'), table_name='processedimages')
+    op.create_index(op.f('ix_processedimages_filename'), 'processedimages', ['filename'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_processedimages_filename'), table_name='processedimages')
+    op.create_index(op.f('ix_processedimages_filename'), 'processedimages', ['filename'], unique=False)
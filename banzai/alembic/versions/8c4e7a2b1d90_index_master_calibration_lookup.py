@@ -0,0 +1,41 @@
+"""Index the master calibration lookup.
+
+Adds a composite index that serves the nearest in time master calibration
+lookups in dbs.query_calibrations and, on Postgres, expression indexes on
+the attributes that masters are grouped by.
+
+Revision ID: 8c4e7a2b1d90
+Revises: 3f1c2a9d8e47
+Create Date: 2026-10-17 13:40:22.504817
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4e7a2b1d90'
+down_revision: Union[str, Sequence[str], None] = '3f1c2a9d8e47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+GROUPING_ATTRIBUTES = ['configuration_mode', 'binning', 'ccd_temperature', 'filter']
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_calimages_master_lookup', 'calimages',
+                    ['instrument_id', 'type', 'is_master', 'is_bad', 'dateobs'], unique=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        for attribute in GROUPING_ATTRIBUTES:
+            op.create_index(f'ix_calimages_{attribute}', 'calimages',
+                            [sa.text(f"(CAST((attributes ->> '{attribute}') AS VARCHAR))")], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        for attribute in GROUPING_ATTRIBUTES:
+            op.drop_index(f'ix_calimages_{attribute}', table_name='calimages')
+    op.drop_index('ix_calimages_master_lookup', table_name='calimages')
@@ -0,0 +1,111 @@
+"""Accumulate reduced calibration frames through the night so they are ready to stack.
+
+stack_calibrations runs after the calibration block has finished and used to re-open every individual BIAS, DARK
+and SKYFLAT frame from the archive or the processed data directory, downloading and decompressing each one before
+stacking them. Instead, as each individual calibration frame finishes reducing, the worker writes an uncompressed,
+memory-mappable copy of it into a shared accumulator directory. When the stack is made, the frames are mapped
+copy-on-write from there, so the stacking task only has to do the (exact) sigma clipped stack itself. Frames that
+are not in the accumulator (e.g. reduced on a node that does not share the directory) are opened as before.
+"""
+import os
+import time
+
+from banzai.logs import get_logger, format_exception
+from banzai.utils import mmap_utils
+
+logger = get_logger()
+
+
+class CalibrationAccumulator:
+    """
+    Directory of memory-mapped, reduced individual calibration frames waiting to be stacked.
+
+    Parameters
+    ----------
+    directory: str
+               Directory to keep the frames in. Every worker that reduces calibration frames and every worker that
+               stacks them should see the same directory.
+    max_age: float
+             Frames are removed this many seconds after they were added
+    """
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+
+    def get_path(self, filename):
+        return os.path.join(self.directory, os.path.basename(filename) + mmap_utils.MAPPED_FILE_SUFFIX)
+
+    def add(self, image, runtime_context):
+        """
+        Add a reduced calibration frame.
+
+        Parameters
+        ----------
+        image: banzai.frames.CalibrationFrame
+               Reduced individual calibration frame. It should already have been written so that the filename
+               matches the one in the database.
+        runtime_context: banzai.context.Context
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        filename = image.get_output_filename(runtime_context)
+        # Same extensions and data types as the file that was written, just without the compression
+        hdu_list = image.to_fits(runtime_context, compress=False)
+        mmap_utils.write_mapped_file(self.get_path(filename), hdu_list, filename, image.frame_id)
+        logger.info('Added frame to the calibration accumulator', image=image)
+        self.remove_expired()
+
+    def localize(self, file_info):
+        """
+        Point the file info of an individual calibration frame at its accumulated copy if we have one
+
+        Returns
+        -------
+        file_info: dict
+                   The data of accumulated frames is mapped copy-on-write, so stacking stages can still modify
+                   the frames in place
+        """
+        filename = file_info.get('filename')
+        if filename is None:
+            return file_info
+        path = self.get_path(filename)
+        if not os.path.exists(path):
+            return file_info
+        return {**file_info, 'path': path, 'copy_on_write': True}
+
+    def remove_expired(self):
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(mmap_utils.MAPPED_FILE_SUFFIX):
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.max_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+
+
+def get_calibration_accumulator(runtime_context):
+    """
+    Get the calibration accumulator or None if it is disabled (CALIBRATION_ACCUMULATOR_DIRECTORY unset)
+    """
+    if not runtime_context.CALIBRATION_ACCUMULATOR_DIRECTORY:
+        return None
+    return CalibrationAccumulator(runtime_context.CALIBRATION_ACCUMULATOR_DIRECTORY,
+                                  runtime_context.CALIBRATION_ACCUMULATOR_MAX_AGE)
+
+
+def accumulate_calibration_frame(image, runtime_context):
+    """
+    Add a freshly reduced individual calibration frame to the accumulator if it is enabled and the frame will be
+    stacked. Failures are logged rather than raised: the frame can always be stacked from its written copy.
+    """
+    accumulator = get_calibration_accumulator(runtime_context)
+    if accumulator is None or image.obstype not in runtime_context.CALIBRATION_STACKER_STAGES:
+        return
+    if getattr(image, 'is_master', False) or getattr(image, 'is_bad', False):
+        return
+    try:
+        accumulator.add(image, runtime_context)
+    except Exception:
+        logger.error(f'Could not add frame to the calibration accumulator: {format_exception()}', image=image)
@@ -0,0 +1,196 @@
+"""Calibration bundles: every cached master for one instrument configuration in a single mapped file.
+
+A science frame needs a BPM, READNOISE, BIAS, DARK and SKYFLAT master. Resolving each of them separately costs
+a database query and a file open per stage. The download worker packs the masters it has cached for each
+instrument, configuration mode and binning into one memory-mappable bundle (see banzai.utils.mmap_utils) whose
+index carries the database fields needed to pick a master. The calibration stages then resolve their masters
+from the (per-process cached) bundle index and map them from that one file.
+
+The bundle only holds the most recent masters for each calibration set, so a master is only taken from a bundle
+when no older master that is missing from the bundle could be closer in time. Otherwise, and whenever the download
+worker has stopped refreshing the bundles, the stages fall back to querying the database.
+"""
+import datetime
+import hashlib
+import json
+import os
+import time
+
+from banzai.logs import get_logger
+from banzai.utils import fits_utils, mmap_utils
+
+logger = get_logger()
+
+BUNDLE_SUFFIX = '.bundle'
+HEARTBEAT_FILENAME = '.heartbeat'
+BUNDLE_CRITERIA = ['configuration_mode', 'binning']
+DATE_FIELDS = ['dateobs', 'datecreated', 'good_after', 'good_until']
+
+
+def get_bundle_path(directory, instrument_id, configuration_mode, binning):
+    grouping = json.dumps([instrument_id, str(configuration_mode), str(binning)])
+    return os.path.join(directory, f'{instrument_id}-{hashlib.sha1(grouping.encode()).hexdigest()[:16]}{BUNDLE_SUFFIX}')
+
+
+def bundles_are_current(directory, max_age):
+    """The download worker touches the heartbeat file every time it brings the bundles up to date"""
+    try:
+        return time.time() - os.path.getmtime(os.path.join(directory, HEARTBEAT_FILENAME)) <= max_age
+    except OSError:
+        return False
+
+
+def _parse_dates(member):
+    return {field: datetime.datetime.fromisoformat(member[field]) if member.get(field) else None
+            for field in DATE_FIELDS}
+
+
+def select_bundle_member(members, image, calibration_type, selection_criteria, use_only_older_calibrations=False):
+    """
+    Pick the master closest in time to the image, following the same rules as dbs.get_master_cal_record
+
+    Returns
+    -------
+    member: int or None
+            Index of the master in the bundle or None if the bundle cannot be guaranteed to hold the right master
+    """
+    candidates = []
+    for i, member in enumerate(members):
+        if member['type'] != calibration_type.upper():
+            continue
+        if all(member['attributes'].get(criterion) == str(getattr(image, criterion))
+               for criterion in selection_criteria):
+            candidates.append((i, _parse_dates(member)))
+    if len(candidates) == 0:
+        return None
+
+    # Any master in the database that is not in the bundle is older than everything in the bundle
+    oldest_dateobs = min(dates['dateobs'] for _, dates in candidates)
+    if image.dateobs < oldest_dateobs:
+        return None
+
+    valid_candidates = []
+    for i, dates in candidates:
+        # Like the SQL comparisons in the database query, a missing date never satisfies the validity window
+        if dates['good_after'] is None or dates['good_after'] > image.dateobs:
+            continue
+        if dates['good_until'] is None or dates['good_until'] < image.dateobs:
+            continue
+        if use_only_older_calibrations and getattr(image, 'block_start') is not None and \
+                (dates['datecreated'] is None or not dates['datecreated'] < image.block_start):
+            continue
+        valid_candidates.append((i, abs(dates['dateobs'] - image.dateobs)))
+    if len(valid_candidates) == 0:
+        return None
+    best_member, time_difference = min(valid_candidates, key=lambda candidate: candidate[1])
+    if time_difference > image.dateobs - oldest_dateobs:
+        return None
+    return best_member
+
+
+def get_bundle_file_info(image, calibration_type, selection_criteria, runtime_context):
+    """
+    Resolve a master calibration from the calibration bundle for this image's configuration
+
+    Returns
+    -------
+    file_info: dict or None
+               File info that fits_utils.open_fits_file can open, or None if the master could not be resolved from
+               a bundle and the database needs to be queried instead
+    """
+    directory = runtime_context.CALIBRATION_BUNDLE_DIRECTORY
+    if not directory or not bundles_are_current(directory, runtime_context.CALIBRATION_BUNDLE_MAX_AGE):
+        return None
+    path = get_bundle_path(directory, image.instrument.id, image.configuration_mode, image.binning)
+    try:
+        members = mmap_utils.read_index(path)
+    except (OSError, ValueError):
+        return None
+    member = select_bundle_member(members, image, calibration_type, selection_criteria,
+                                  use_only_older_calibrations=runtime_context.use_only_older_calibrations)
+    if member is None:
+        return None
+    return {'path': path, 'bundle_member': member,
+            'filename': members[member]['filename'],
+            'frameid': members[member]['frameid'],
+            'dateobs': _parse_dates(members[member])['dateobs']}
+
+
+def _member_metadata(cal):
+    metadata = {'filename': cal.filename, 'frameid': cal.frameid, 'type': cal.type, 'attributes': cal.attributes}
+    for field in DATE_FIELDS:
+        value = getattr(cal, field)
+        metadata[field] = None if value is None else value.isoformat()
+    return metadata
+
+
+def write_bundle(path, cached_masters, runtime_context):
+    """
+    Pack locally cached masters into a bundle
+
+    Parameters
+    ----------
+    path: str
+    cached_masters: list of tuples
+                    (calibration record as returned by download_worker.get_calibrations_to_cache, local path)
+    runtime_context: banzai.context.Context
+    """
+    with mmap_utils.MappedFileWriter(path) as writer:
+        # Add one master at a time so we never hold more than one decompressed master in memory
+        for cal, local_path in cached_masters:
+            hdu_list, _, _ = fits_utils.open_fits_file({'path': local_path}, runtime_context)
+            writer.add_member(hdu_list, **_member_metadata(cal))
+    logger.info(f"Wrote calibration bundle {os.path.basename(path)} with {len(cached_masters)} masters")
+
+
+def update_bundles(directory, cached_masters, runtime_context):
+    """
+    Bring the calibration bundles in directory in line with the cached masters
+
+    Parameters
+    ----------
+    directory: str
+    cached_masters: list of tuples
+                    (calibration record as returned by download_worker.get_calibrations_to_cache, local path)
+    runtime_context: banzai.context.Context
+
+    Notes
+    -----
+    Masters that are not on local disk yet are left out of the bundles. In that case the bundles are marked as
+    out of date until the masters have been downloaded, as a missing master could be the one a frame needs.
+    """
+    os.makedirs(directory, exist_ok=True)
+    bundles = {}
+    all_masters_on_disk = True
+    for cal, local_path in cached_masters:
+        if not os.path.exists(local_path):
+            all_masters_on_disk = False
+            continue
+        path = get_bundle_path(directory, cal.instrument_id,
+                               *[(cal.attributes or {}).get(criterion) for criterion in BUNDLE_CRITERIA])
+        bundles.setdefault(path, []).append((cal, local_path))
+
+    for path, bundle_masters in bundles.items():
+        bundle_masters = sorted(bundle_masters, key=lambda cached_master: (cached_master[0].type,
+                                                                           cached_master[0].filename))
+        expected_members = [_member_metadata(cal) for cal, _ in bundle_masters]
+        try:
+            current_members = [{key: value for key, value in member.items() if key != 'hdus'}
+                               for member in mmap_utils.read_index(path)]
+        except (OSError, ValueError):
+            current_members = None
+        if current_members != expected_members:
+            write_bundle(path, bundle_masters, runtime_context)
+
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if filename.endswith(BUNDLE_SUFFIX) and path not in bundles:
+            os.remove(path)
+            logger.info(f"Removed calibration bundle {filename}")
+
+    heartbeat_path = os.path.join(directory, HEARTBEAT_FILENAME)
+    if all_masters_on_disk:
+        with open(heartbeat_path, 'a'):
+            os.utime(heartbeat_path)
+    elif os.path.exists(heartbeat_path):
+        os.remove(heartbeat_path)
@@ -0,0 +1,132 @@
+"""Node-level store of decompressed master calibrations.
+
+Every worker process on a node opens the same handful of masters. Rather than each process decompressing its
+own copy, the first process to need a master writes an uncompressed, memory-mappable copy into a shared
+directory (ideally on tmpfs, e.g. /dev/shm). Every other process maps that copy read-only, so the pages are
+shared through the OS page cache and the memory used for calibrations does not grow with the number of workers.
+"""
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+
+from banzai.cache.frame_cache import get_cache_key
+from banzai.logs import get_logger
+from banzai.utils import fits_utils, mmap_utils
+
+logger = get_logger()
+
+LOCK_SUFFIX = '.lock'
+
+
+class CalibrationStore:
+    """
+    Directory of memory-mapped master calibrations shared by all of the worker processes on a node.
+
+    Parameters
+    ----------
+    directory: str
+               Directory to store the mapped files in
+    max_bytes: int
+               Maximum size of the store. The least recently used files are removed when a new file would push
+               the store over this size. Processes that already have a removed file mapped keep working as the
+               data is only freed when the last mapping is closed.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get_path(self, file_info):
+        key = get_cache_key(file_info)
+        if key is None:
+            return None
+        filename = os.path.splitext(os.path.basename(str(key[0])))[0].replace('.fits', '')
+        return os.path.join(self.directory,
+                            f'{filename}-{hashlib.sha1(repr(key).encode()).hexdigest()}{mmap_utils.MAPPED_FILE_SUFFIX}')
+
+    @contextmanager
+    def lock(self, path):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path + LOCK_SUFFIX, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def localize(self, file_info, runtime_context):
+        """
+        Make sure a master calibration is in the store.
+
+        Parameters
+        ----------
+        file_info: dict
+                   File info for the master calibration as returned by dbs.cal_record_to_file_info
+        runtime_context: banzai.context.Context
+
+        Returns
+        -------
+        file_info: dict
+                   File info pointing at the mapped copy of the master if it is in the store, otherwise the
+                   original file info
+        """
+        path = self.get_path(file_info)
+        if path is None:
+            return file_info
+        # Bundles and files with a sidecar are already mapped from disk and shared through the page cache
+        if file_info.get('path') is not None and (mmap_utils.is_mapped_file(file_info['path']) or
+                                                  mmap_utils.get_sidecar_path(file_info['path']) is not None):
+            return file_info
+        # Hold the lock while writing so only one process per node decompresses each master
+        with self.lock(path):
+            if not os.path.exists(path):
+                hdu_list, filename, frame_id = fits_utils.open_fits_file(file_info, runtime_context)
+                file_size = mmap_utils.get_mapped_file_size(hdu_list)
+                if file_size > self.max_bytes:
+                    return file_info
+                self.make_space(file_size)
+                mmap_utils.write_mapped_file(path, hdu_list, filename, frame_id or file_info.get('frameid'))
+                logger.info('Added master calibration to calibration store', extra_tags={'filename': filename})
+            else:
+                # Touch the file so that eviction is least recently used rather than least recently added
+                os.utime(path)
+        return {**file_info, 'path': path}
+
+    def get_stored_files(self):
+        """Paths, modification times, and sizes of the files in the store, least recently used first"""
+        stored_files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(mmap_utils.MAPPED_FILE_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Evicted by another process
+                continue
+            stored_files.append((entry.path, stat.st_mtime, stat.st_size))
+        return sorted(stored_files, key=lambda stored_file: stored_file[1])
+
+    def make_space(self, n_bytes):
+        stored_files = self.get_stored_files()
+        stored_bytes = sum(size for _, _, size in stored_files)
+        while stored_files and stored_bytes + n_bytes > self.max_bytes:
+            evicted_file, _, evicted_size = stored_files.pop(0)
+            stored_bytes -= evicted_size
+            # If another process is holding the lock for this file, the worst case is that the master
+            # is decompressed twice
+            for path in [evicted_file, evicted_file + LOCK_SUFFIX]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            logger.debug('Evicting master calibration from calibration store',
+                         extra_tags={'filename': os.path.basename(evicted_file)})
+
+
+def get_calibration_store(runtime_context):
+    """
+    Get the calibration store for this node or None if the store is disabled (CALIBRATION_STORE_DIRECTORY unset)
+    """
+    if not runtime_context.CALIBRATION_STORE_DIRECTORY:
+        return None
+    return CalibrationStore(runtime_context.CALIBRATION_STORE_DIRECTORY, runtime_context.CALIBRATION_STORE_MAX_BYTES)
@@ -8,8 +8,9 @@ from astropy.io import fits
 from sqlalchemy import cast, func, String
 
 from banzai import dbs, logs, settings
+from banzai.cache import bundles
 from banzai.context import Context
-from banzai.utils import date_utils, file_utils, fits_utils
+from banzai.utils import date_utils, file_utils, fits_utils, mmap_utils
 
 logger = logs.get_logger()
 HEARTBEAT_INTERVAL = 300
@@ -37,6 +38,9 @@ def get_calibrations_to_cache(db_address, site_id, instrument_types):
                 dbs.CalibrationImage.id, dbs.CalibrationImage.filename,
                 dbs.CalibrationImage.frameid, dbs.CalibrationImage.type,
                 dbs.CalibrationImage.dateobs, dbs.CalibrationImage.filepath,
+                dbs.CalibrationImage.datecreated, dbs.CalibrationImage.good_after,
+                dbs.CalibrationImage.good_until, dbs.CalibrationImage.attributes,
+                dbs.CalibrationImage.instrument_id,
                 dbs.Instrument.site.label('site'), dbs.Instrument.camera.label('camera'),
                 rank,
             ).join(dbs.Instrument).filter(
@@ -65,13 +69,33 @@ def update_filepath(db_address, cal_id, filepath):
             cal.filepath = filepath
 
 
-def download_calibration(db_address, processed_path, runtime_context, cal):
-    """Download file, validate FITS, write to disk, update DB filepath."""
+def write_sidecar(local_path, runtime_context, cal):
+    """Write a decompressed, memory-mappable copy of a cached file next to it.
+
+    Failures are logged rather than raised: workers fall back to the FITS file.
+    """
+    try:
+        hdu_list, _, _ = fits_utils.open_fits_file({'path': local_path}, runtime_context)
+        mmap_utils.write_mapped_file(local_path + mmap_utils.MAPPED_FILE_SUFFIX, hdu_list,
+                                     cal.filename, cal.frameid)
+        logger.info(f"Wrote memory-mappable sidecar for {cal.filename}")
+    except Exception as e:
+        logger.error(f"Failed to write sidecar for {cal.filename}: {e}", exc_info=True)
+
+
+def download_calibration(db_address, processed_path, runtime_context, cal, write_sidecars=False):
+    """Download file, validate FITS, write to disk, update DB filepath.
+
+    If write_sidecars is set, also write a decompressed copy of the file that
+    pipeline workers can memory map instead of decompressing on every open.
+    """
     dest_dir = get_cache_path(processed_path, cal)
     local_path = os.path.join(dest_dir, cal.filename)
 
     if os.path.exists(local_path):
         logger.info(f"Already on disk: {cal.filename}, updating DB filepath")
+        if write_sidecars and mmap_utils.get_sidecar_path(local_path) is None:
+            write_sidecar(local_path, runtime_context, cal)
         update_filepath(db_address, cal.id, dest_dir)
         return
     if cal.frameid is None:
@@ -91,6 +115,8 @@ def download_calibration(db_address, processed_path, runtime_context, cal):
         hdulist.close()
     finally:
         buffer.close()
+    if write_sidecars:
+        write_sidecar(local_path, runtime_context, cal)
     update_filepath(db_address, cal.id, dest_dir)
     logger.info(f"Downloaded {cal.filename}")
 
@@ -101,6 +127,8 @@ def delete_calibration(db_address, cal):
     if os.path.exists(file_path):
         os.remove(file_path)
         logger.info(f"Deleted {cal.filename}")
+    if os.path.exists(file_path + mmap_utils.MAPPED_FILE_SUFFIX):
+        os.remove(file_path + mmap_utils.MAPPED_FILE_SUFFIX)
     update_filepath(db_address, cal.id, None)
 
 
@@ -118,7 +146,7 @@ def get_cached_calibrations(db_address, site_id, processed_path):
 
 
 def run_download_worker(db_address, site_id, instrument_types, processed_path,
-                        runtime_context, poll_interval=10):
+                        runtime_context, poll_interval=10, write_sidecars=False):
     """Main loop: poll DB, download missing files, delete stale ones."""
     logger.info("Download worker started")
     last_heartbeat = time.monotonic()
@@ -128,10 +156,13 @@ def run_download_worker(db_address, site_id, instrument_types, processed_path,
             needed = get_calibrations_to_cache(db_address, site_id, instrument_types)
             needed_filenames = {cal.filename for cal in needed}
 
-            # Download calibrations not yet on local disk
-            to_download = [cal for cal in needed
-                           if not os.path.exists(os.path.join(
-                               get_cache_path(processed_path, cal), cal.filename))]
+            # Download calibrations not yet on local disk (or missing their sidecar)
+            to_download = []
+            for cal in needed:
+                local_path = os.path.join(get_cache_path(processed_path, cal), cal.filename)
+                if not os.path.exists(local_path) or \
+                        (write_sidecars and mmap_utils.get_sidecar_path(local_path) is None):
+                    to_download.append(cal)
 
             # Find locally-cached cals no longer in the top-2 needed set
             cached_in_db = get_cached_calibrations(db_address, site_id, processed_path)
@@ -139,7 +170,8 @@ def run_download_worker(db_address, site_id, instrument_types, processed_path,
 
             for cal in to_download:
                 try:
-                    download_calibration(db_address, processed_path, runtime_context, cal)
+                    download_calibration(db_address, processed_path, runtime_context, cal,
+                                         write_sidecars=write_sidecars)
                 except Exception as e:
                     logger.error(f"Failed to download {cal.filename}: {e}", exc_info=True)
             for cal in to_delete:
@@ -148,6 +180,15 @@ def run_download_worker(db_address, site_id, instrument_types, processed_path,
                 except Exception as e:
                     logger.error(f"Failed to delete {cal.filename}: {e}", exc_info=True)
 
+            if runtime_context.CALIBRATION_BUNDLE_DIRECTORY:
+                try:
+                    cached_masters = [(cal, os.path.join(get_cache_path(processed_path, cal), cal.filename))
+                                      for cal in needed]
+                    bundles.update_bundles(runtime_context.CALIBRATION_BUNDLE_DIRECTORY, cached_masters,
+                                           runtime_context)
+                except Exception as e:
+                    logger.error(f"Failed to update calibration bundles: {e}", exc_info=True)
+
             now = time.monotonic()
             if to_download or to_delete:
                 logger.info(f"Cache sync: downloaded {len(to_download)}, "
@@ -170,6 +211,7 @@ def run_download_worker_daemon():
     instrument_types_str = os.getenv('INSTRUMENT_TYPES', '*')
     processed_path = os.getenv('PROCESSED_PATH', '/data/processed')
     poll_interval = int(os.getenv('DOWNLOAD_WORKER_POLL_INTERVAL', '10'))
+    write_sidecars = os.getenv('DOWNLOAD_WORKER_WRITE_SIDECARS', 'false').lower() in ['true', '1', 'yes']
 
     if not db_address or not site_id:
         logger.error('DB_ADDRESS and SITE_ID environment variables are required')
@@ -181,7 +223,7 @@ def run_download_worker_daemon():
 
     try:
         run_download_worker(db_address, site_id, instrument_types, processed_path,
-                            runtime_context, poll_interval)
+                            runtime_context, poll_interval, write_sidecars)
     except KeyboardInterrupt:
         logger.info("Download worker stopped")
         sys.exit(0)
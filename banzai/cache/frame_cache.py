@@ -0,0 +1,167 @@
+"""In-process cache of opened master calibration frames.
+
+Consecutive frames from the same block almost always use the same BPM, READNOISE,
+BIAS, DARK and SKYFLAT masters. Each worker process keeps the masters it has already
+opened so they do not have to be downloaded and decompressed again for every frame.
+"""
+import copy
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from banzai.logs import get_logger
+
+logger = get_logger()
+
+CACHED_ARRAY_ATTRIBUTES = ['data', 'mask', '_variance']
+
+
+def get_cache_key(file_info):
+    """
+    Build the key used to store a master calibration in the cache.
+
+    Parameters
+    ----------
+    file_info: dict
+               File info for the master calibration as returned by dbs.cal_record_to_file_info
+
+    Returns
+    -------
+    key: tuple or None
+         (filename, frameid, modification time) or None if the file cannot be uniquely identified.
+
+    Notes
+    -----
+    Masters that are re-stacked during the night keep the same filename. A new version gets a new frameid
+    when it is ingested into the archive and a new modification time when it is written to disk, so we
+    include both in the key. If there is neither a frameid nor a file on disk, we have no way to know that
+    the content has not changed, so those files are not cached.
+    """
+    path = file_info.get('path')
+    if path is not None and os.path.exists(path):
+        modification_time = os.path.getmtime(path)
+    else:
+        modification_time = None
+    if file_info.get('frameid') is None and modification_time is None:
+        return None
+    return file_info.get('filename'), file_info.get('frameid'), modification_time
+
+
+def get_frame_size(frame):
+    """Number of bytes used by the pixel arrays of a frame"""
+    n_bytes = 0
+    for hdu in frame._hdus:
+        for attribute in CACHED_ARRAY_ATTRIBUTES:
+            array = getattr(hdu, attribute, None)
+            if isinstance(array, np.ndarray):
+                n_bytes += array.nbytes
+    return n_bytes
+
+
+def read_only_view(frame):
+    """
+    Make a copy of a frame that shares the pixel arrays with the original but cannot modify them.
+
+    Headers are copied so that stages can update keywords (e.g. ISMASTER) without changing the cached frame.
+    """
+    view = copy.copy(frame)
+    view._hdus = [_read_only_hdu(hdu) for hdu in frame._hdus]
+    if hasattr(frame, '_hdu_mapping'):
+        view._hdu_mapping = dict(frame._hdu_mapping)
+    return view
+
+
+def _read_only_hdu(hdu):
+    hdu_view = copy.copy(hdu)
+    hdu_view.meta = hdu.meta.copy()
+    for attribute in CACHED_ARRAY_ATTRIBUTES:
+        array = hdu.__dict__.get(attribute)
+        if isinstance(array, np.ndarray):
+            array_view = array.view()
+            array_view.flags.writeable = False
+            # Write directly into __dict__ to avoid the validation and copying done by the property setters
+            hdu_view.__dict__[attribute] = array_view
+    return hdu_view
+
+
+class CalibrationFrameCache:
+    """
+    Least recently used cache of master calibration frames with a memory budget.
+
+    Parameters
+    ----------
+    max_bytes: int
+               Maximum number of bytes of pixel data to keep. Frames are evicted, least recently used first,
+               until the cache is under budget. 0 disables the cache.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, file_info):
+        return get_cache_key(file_info) in self._frames
+
+    def get(self, file_info):
+        """
+        Get a read-only view of a cached master calibration frame
+
+        Returns
+        -------
+        frame: banzai.frames.ObservationFrame or None
+               None if the frame is not in the cache
+        """
+        key = get_cache_key(file_info)
+        if key is None:
+            return None
+        with self._lock:
+            if key not in self._frames:
+                return None
+            self._frames.move_to_end(key)
+            frame, _ = self._frames[key]
+        return read_only_view(frame)
+
+    def add(self, file_info, frame):
+        """
+        Add a frame to the cache, evicting the least recently used frames if we are over the memory budget.
+        """
+        key = get_cache_key(file_info)
+        if key is None or frame is None:
+            return
+        frame_size = get_frame_size(frame)
+        if frame_size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._frames:
+                self.n_bytes -= self._frames.pop(key)[1]
+            self._frames[key] = (frame, frame_size)
+            self.n_bytes += frame_size
+            while self.n_bytes > self.max_bytes:
+                evicted_key, (_, evicted_size) = self._frames.popitem(last=False)
+                self.n_bytes -= evicted_size
+                logger.debug('Evicting master calibration from cache', extra_tags={'filename': evicted_key[0]})
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.n_bytes = 0
+
+
+_calibration_frame_cache = None
+
+
+def get_calibration_frame_cache(max_bytes):
+    """
+    Get the calibration frame cache for this process, creating it if necessary.
+    """
+    global _calibration_frame_cache
+    if _calibration_frame_cache is None:
+        _calibration_frame_cache = CalibrationFrameCache(max_bytes)
+    _calibration_frame_cache.max_bytes = max_bytes
+    return _calibration_frame_cache
@@ -1,11 +1,18 @@
 import abc
+import os
 from datetime import datetime
 
+import numpy as np
+from astropy.io import fits
+
 from banzai.stages import Stage
 from banzai import dbs, logs
-from banzai.utils import qc, import_utils, stage_utils, file_utils
-from banzai.data import stack
-from banzai.utils.image_utils import Section
+from banzai.cache.accumulator import get_calibration_accumulator
+from banzai.cache.bundles import get_bundle_file_info
+from banzai.cache.calibration_store import get_calibration_store
+from banzai.cache.frame_cache import get_calibration_frame_cache
+from banzai.utils import qc, import_utils, stage_utils, file_utils, mmap_utils
+from banzai.stacking import stack_by_band, read_band, plan_band_tasks
 
 logger = logs.get_logger()
 
@@ -66,34 +73,10 @@ class CalibrationStacker(CalibrationMaker):
         master_image = master_frame_class.init_master_frame(images, master_calibration_filename,
                                                             grouping_criteria=grouping, hdu_order=hdu_order)
 
-        # turn off memory mapping for each segment
-        for image in images:
-            image.primary_hdu.memmap = False
-        # Split the image into N sections where N is the number of images
-        # This is just for convenience. Technically N can be anything you want.
-        # I assume that you can read a couple of images into memory so order N sections is good for memory management.
-        N = len(images)
-        # Split along the y-direction to get more sequential reads off of disk
-        # detector section (y_stop - y_start) // binning(y) // N, abs(x_stop - x_start) // binning(x)
-        y_step = images[0].shape[0] // N
-        for i in range(N + 1):
-            y_start = 1 + i * y_step
-            if i == N:
-                # If the image divided evenly just move on.
-                if images[0].shape[0] % N == 0:
-                    break
-                # Otherwise, don't forget to do the last %mod sized section
-                y_stop = images[0].shape[0]
-            else:
-                y_stop = (i + 1) * y_step
-
-            section_to_stack = Section(x_start=1, x_stop=images[0].data.shape[1],
-                                       y_start=y_start, y_stop=y_stop)
-
-            data_to_stack = [image.primary_hdu[section_to_stack] for image in images]
-            stacked_data = stack(data_to_stack, 3.0)
-
-            master_image.primary_hdu.copy_in(stacked_data)
+        # Stack in bands of rows so that memory use is set by STACKING_MAX_BYTES rather than by the number
+        # and size of the frames
+        stack_by_band([image.primary_hdu for image in images], master_image.primary_hdu, 3.0,
+                      self.runtime_context.STACKING_MAX_BYTES)
 
         logger.info('Created master calibration stack', image=master_image,
                     extra_tags={'calibration_type': self.calibration_type})
@@ -101,6 +84,10 @@ class CalibrationStacker(CalibrationMaker):
 
 
 class CalibrationUser(Stage):
+    # Masters resolved ahead of time for the whole pipeline run (see MasterCalibrationPlan). Set by
+    # stage_utils.run_pipeline_stages.
+    calibration_plan = None
+
     def __init__(self, runtime_context):
         super(CalibrationUser, self).__init__(runtime_context)
 
@@ -125,8 +112,7 @@ class CalibrationUser(Stage):
         if master_calibration_file_info is None:
             return self.on_missing_master_calibration(image)
 
-        frame_factory = import_utils.import_attribute(self.runtime_context.FRAME_FACTORY)()
-        master_calibration_image = frame_factory.open(master_calibration_file_info, self.runtime_context)
+        master_calibration_image = self.open_master_calibration(master_calibration_file_info)
         master_calibration_image.is_master = True
         # If the frame id was not included originally but we were able to pull it from the archive,
         # we store it for future use
@@ -141,7 +127,47 @@ class CalibrationUser(Stage):
     def apply_master_calibration(self, image, master_calibration_image):
         pass
 
+    def open_master_calibration(self, file_info):
+        """
+        Open a master calibration frame, reusing the copy already opened by this process if we have one.
+
+        Frames that come out of the cache have read-only pixel arrays, so apply_master_calibration
+        must not modify the master in place.
+        """
+        frame_cache = get_calibration_frame_cache(self.runtime_context.CALIBRATION_CACHE_MAX_BYTES)
+        master_calibration_image = frame_cache.get(file_info)
+        if master_calibration_image is None:
+            frame_factory = import_utils.import_attribute(self.runtime_context.FRAME_FACTORY)()
+            master_calibration_image = frame_factory.open(self.localize_master_calibration(file_info),
+                                                          self.runtime_context)
+            frame_cache.add(file_info, master_calibration_image)
+            if file_info in frame_cache:
+                master_calibration_image = frame_cache.get(file_info)
+        return master_calibration_image
+
+    def localize_master_calibration(self, file_info):
+        """
+        Put the master into the node's calibration store (if enabled) so that the pixel data is memory mapped
+        from a copy shared by every worker process rather than decompressed into each one.
+        """
+        calibration_store = get_calibration_store(self.runtime_context)
+        if calibration_store is None:
+            return file_info
+        try:
+            return calibration_store.localize(file_info, self.runtime_context)
+        except OSError:
+            logger.error(f'Could not add master to the calibration store: {logs.format_exception()}',
+                         extra_tags={'filename': file_info.get('filename')})
+            return file_info
+
     def get_calibration_file_info(self, image):
+        if self.calibration_plan is not None and \
+                self.calibration_plan.has_master(image, self.calibration_type, self.master_selection_criteria):
+            return self.calibration_plan.get_master(image, self.calibration_type, self.master_selection_criteria)
+        bundle_file_info = get_bundle_file_info(image, self.calibration_type, self.master_selection_criteria,
+                                                self.runtime_context)
+        if bundle_file_info is not None:
+            return bundle_file_info
         return dbs.cal_record_to_file_info(
             dbs.get_master_cal_record(image, self.calibration_type, self.master_selection_criteria,
                                       self.runtime_context.cal_db_address,
@@ -149,6 +175,80 @@ class CalibrationUser(Stage):
         )
 
 
+class MasterCalibrationPlan:
+    """
+    The master calibrations for a set of images, resolved up front for every calibration stage in a pipeline run.
+
+    Resolving the masters stage by stage and image by image costs a database query per calibration type per
+    image. Instead, resolve_master_calibrations looks them all up with one query per calibration type and
+    calibration set. The calibration stages then take their masters from the plan and only query the database
+    for images that are not in it (e.g. if a stage changed an attribute the masters are selected on).
+    """
+    def __init__(self, use_only_older_calibrations=False):
+        self.use_only_older_calibrations = use_only_older_calibrations
+        self._masters = {}
+
+    def _get_key(self, image, calibration_type, master_selection_criteria):
+        key = (calibration_type.upper(), dbs.get_calibration_set_key(image, master_selection_criteria),
+               image.dateobs)
+        if self.use_only_older_calibrations:
+            key += (getattr(image, 'block_start'),)
+        return key
+
+    def add_master(self, image, calibration_type, master_selection_criteria, file_info):
+        self._masters[self._get_key(image, calibration_type, master_selection_criteria)] = file_info
+
+    def has_master(self, image, calibration_type, master_selection_criteria):
+        """Whether the plan covers this image. The master itself can still be None if there is no master."""
+        return self._get_key(image, calibration_type, master_selection_criteria) in self._masters
+
+    def get_master(self, image, calibration_type, master_selection_criteria):
+        file_info = self._masters[self._get_key(image, calibration_type, master_selection_criteria)]
+        # Stages can add to the file info so don't hand out the shared copy
+        return None if file_info is None else dict(file_info)
+
+
+def resolve_master_calibrations(images, stages, runtime_context):
+    """
+    Build the MasterCalibrationPlan for the calibration stages in a pipeline run.
+
+    Parameters
+    ----------
+    images: list of banzai.frames.ObservationFrame
+    stages: list of banzai.stages.Stage
+            Only the CalibrationUser stages are planned for
+    runtime_context: banzai.context.Context
+
+    Returns
+    -------
+    plan: MasterCalibrationPlan
+    """
+    plan = MasterCalibrationPlan(use_only_older_calibrations=runtime_context.use_only_older_calibrations)
+    planned_types = set()
+    for stage in stages:
+        if not isinstance(stage, CalibrationUser) or stage.calibration_type.upper() in planned_types:
+            continue
+        planned_types.add(stage.calibration_type.upper())
+        images_to_query = []
+        for image in images:
+            # Bundles are cheaper than the database so use them first, just like get_calibration_file_info
+            bundle_file_info = get_bundle_file_info(image, stage.calibration_type, stage.master_selection_criteria,
+                                                    runtime_context)
+            if bundle_file_info is not None:
+                plan.add_master(image, stage.calibration_type, stage.master_selection_criteria, bundle_file_info)
+            else:
+                images_to_query.append(image)
+        if not images_to_query:
+            continue
+        records = dbs.get_master_cal_records(images_to_query, stage.calibration_type, stage.master_selection_criteria,
+                                             runtime_context.cal_db_address,
+                                             use_only_older_calibrations=runtime_context.use_only_older_calibrations)
+        for image, record in zip(images_to_query, records):
+            plan.add_master(image, stage.calibration_type, stage.master_selection_criteria,
+                            dbs.cal_record_to_file_info(record))
+    return plan
+
+
 class CalibrationComparer(CalibrationUser):
     # In a 16 megapixel image, this should flag 0 or 1 pixels statistically, much much less than 5% of the image
     SIGNAL_TO_NOISE_THRESHOLD = 6.0
@@ -186,14 +286,27 @@ class CalibrationComparer(CalibrationUser):
         return image
 
 
+def get_calibration_frames_to_stack(instrument, frame_type, min_date, max_date, runtime_context):
+    """
+    File infos of the individual calibration frames to stack, pointing at their accumulated copies where we have
+    them (see banzai.cache.accumulator)
+    """
+    calibration_frames_info = dbs.get_individual_cal_frames(instrument, frame_type, min_date, max_date,
+                                                            db_address=runtime_context.db_address)
+    accumulator = get_calibration_accumulator(runtime_context)
+    if accumulator is not None:
+        calibration_frames_info = [accumulator.localize(file_info) for file_info in calibration_frames_info]
+    return calibration_frames_info
+
+
 def make_master_calibrations(instrument, frame_type, min_date, max_date, runtime_context):
     extra_tags = {'type': instrument.type, 'site': instrument.site,
                   'camera': instrument.camera, 'obstype': frame_type,
                   'min_date': min_date,
                   'max_date': max_date}
     logger.info("Making master frames", extra_tags=extra_tags)
-    calibration_frames_info = dbs.get_individual_cal_frames(instrument, frame_type, min_date, max_date,
-                                                            db_address=runtime_context.db_address)
+    calibration_frames_info = get_calibration_frames_to_stack(instrument, frame_type, min_date, max_date,
+                                                              runtime_context)
     if len(calibration_frames_info) == 0:
         logger.info("No calibration frames found to stack", extra_tags=extra_tags)
     try:
@@ -201,3 +314,122 @@ def make_master_calibrations(instrument, frame_type, min_date, max_date, runtime
     except Exception:
         logger.error(logs.format_exception())
     logger.info("Finished")
+
+
+def plan_master_bands(calibration_frames_info, runtime_context):
+    """
+    Split stacking the masters for calibration_frames_info into bands of rows, one band per task.
+
+    Only frames that are in the calibration accumulator can be read a band at a time (they are memory mapped;
+    frames from the archive have to be decompressed whole), so this returns None unless all of them are.
+
+    Returns
+    -------
+    bands: list of tuples or None
+           (start, stop) rows of each band like banzai.stacking.plan_row_bands
+    """
+    n_tasks = runtime_context.STACKING_BAND_TASKS
+    if n_tasks < 2 or len(calibration_frames_info) == 0:
+        return None
+    if not all(file_info.get('copy_on_write', False) for file_info in calibration_frames_info):
+        return None
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    image = frame_factory.open(calibration_frames_info[0], runtime_context)
+    if image is None:
+        return None
+    return plan_band_tasks(image.primary_hdu.shape[0], n_tasks)
+
+
+def get_band_path(master_filename, start, runtime_context):
+    """Where the band of a master starting at row start is kept until the bands are combined"""
+    return os.path.join(runtime_context.CALIBRATION_ACCUMULATOR_DIRECTORY,
+                        f'{os.path.basename(master_filename)}.band{start}{mmap_utils.MAPPED_FILE_SUFFIX}')
+
+
+def stack_master_band(calibration_frames_info, start, stop, runtime_context):
+    """
+    Stack rows start to stop (zero indexed, stop exclusive) of the masters for calibration_frames_info.
+
+    The frames are opened from the calibration accumulator, so only the pages holding the band are ever read.
+    The band of each master is written to a mapped file next to the accumulated frames for
+    combine_master_bands.
+
+    Returns
+    -------
+    master_filenames: list of str
+                      Filenames of the masters that a band was stacked for
+    """
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    images = [frame_factory.open(file_info, runtime_context) for file_info in calibration_frames_info]
+    images = [image for image in images if image is not None]
+    if len(images) == 0:
+        return []
+    # read_band changes the sections in the frames' headers to those of the band. The masters copy the header of
+    # one of their frames, so keep the full sections, by band section, to put back on them.
+    full_sections = {}
+    for image in images:
+        full_section = image.primary_hdu.meta.get('DETSEC'), image.primary_hdu.meta.get('DATASEC')
+        image.primary_hdu = read_band(image.primary_hdu, start, stop)
+        full_sections[image.primary_hdu.meta.get('DETSEC')] = full_section
+
+    stages_to_do = runtime_context.CALIBRATION_STACKER_STAGES[images[0].obstype.upper()]
+    for stage_name in stages_to_do:
+        images = import_utils.import_attribute(stage_name)(runtime_context).run(images)
+        if not images:
+            return []
+
+    master_filenames = []
+    for master_image in images:
+        detector_section, data_section = full_sections[master_image.primary_hdu.meta.get('DETSEC')]
+        master_image.primary_hdu.meta['DETSEC'] = detector_section
+        master_image.primary_hdu.meta['DATASEC'] = data_section
+        mmap_utils.write_mapped_file(get_band_path(master_image.filename, start, runtime_context),
+                                     master_image.to_fits(runtime_context, compress=False), master_image.filename)
+        master_filenames.append(master_image.filename)
+    logger.info(f'Stacked rows {start} to {stop} of {len(master_filenames)} master frames')
+    return master_filenames
+
+
+def combine_master_bands(master_filenames, bands, runtime_context):
+    """
+    Assemble the masters from the bands written by stack_master_band and write them out like
+    make_master_calibrations would.
+
+    Parameters
+    ----------
+    master_filenames: list of lists of str
+                      Masters stacked for each band, as returned by stack_master_band
+    bands: list of tuples
+           (start, stop) rows of each band in the same order
+    runtime_context: banzai.context.Context
+    """
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    complete_masters = set.intersection(*[set(filenames) for filenames in master_filenames])
+    for master_filename in set.union(*[set(filenames) for filenames in master_filenames]) - complete_masters:
+        logger.error('Missing bands of master frame, not writing it', extra_tags={'filename': master_filename})
+    for master_filename in sorted(complete_masters):
+        band_paths = [get_band_path(master_filename, start, runtime_context) for start, _ in bands]
+        combined_path = get_band_path(master_filename, 'all', runtime_context)
+        try:
+            band_hdu_lists = [mmap_utils.read_mapped_file(band_path)[0] for band_path in band_paths]
+            combined_hdu_list = fits.HDUList()
+            for hdus in zip(*band_hdu_lists):
+                if hdus[0].data is None or isinstance(hdus[0], fits.BinTableHDU) or hdus[0].data.ndim != 2:
+                    combined_hdu_list.append(hdus[0])
+                else:
+                    hdu_class = fits.PrimaryHDU if isinstance(hdus[0], fits.PrimaryHDU) else fits.ImageHDU
+                    combined_hdu_list.append(hdu_class(data=np.concatenate([hdu.data for hdu in hdus]),
+                                                       header=hdus[0].header))
+            mmap_utils.write_mapped_file(combined_path, combined_hdu_list, master_filename)
+            master_image = frame_factory.open({'path': combined_path, 'filename': master_filename},
+                                              runtime_context)
+            master_image.is_master = True
+            master_image.write(runtime_context)
+            logger.info('Combined bands of master calibration stack', image=master_image)
+        except Exception:
+            logger.error(f'Could not combine bands of master frame: {logs.format_exception()}',
+                         extra_tags={'filename': master_filename})
+        finally:
+            for path in band_paths + [combined_path]:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -40,11 +40,10 @@ class DarkSubtractor(CalibrationUser):
         return 'dark'
 
     def apply_master_calibration(self, image, master_calibration_image):
-        master_calibration_image *= image.exptime
         temperature_scaling_factor = np.exp(master_calibration_image.dark_temperature_coefficient * \
                                             (image.measured_ccd_temperature - master_calibration_image.measured_ccd_temperature))
-        master_calibration_image *= temperature_scaling_factor
-        image -= master_calibration_image
+        # Don't scale the master in place: it may be shared with other frames through the calibration cache
+        image -= master_calibration_image * (image.exptime * temperature_scaling_factor)
         image.meta['L1IDDARK'] = master_calibration_image.filename, 'ID of dark frame'
         image.meta['L1STATDA'] = 1, 'Status flag for dark frame correction'
         image.meta['DRKTSCAL'] = temperature_scaling_factor, 'Temperature scaling factor applied to dark image'
@@ -1,5 +1,4 @@
 import abc
-import tempfile
 from typing import Union, Type
 
 import numpy as np
@@ -7,7 +6,8 @@ from astropy.io import fits
 from astropy.table import Table
 
 from banzai.utils.image_utils import Section
-from banzai.utils import fits_utils, stats
+from banzai.utils import fits_utils, stack_utils
+from banzai.utils.scratch_utils import get_scratch_storage
 from io import BytesIO
 
 
@@ -29,8 +29,6 @@ class DataProduct:
 
 
 class Data(metaclass=abc.ABCMeta):
-    _file_handles = []
-
     def __init__(self, data: Union[np.array, Table], meta: Union[dict, fits.Header],
                  mask: np.array = None, name: str = '', memmap=True):
         self.memmap = memmap
@@ -51,27 +49,20 @@ class Data(metaclass=abc.ABCMeta):
     def _init_array(self, array: np.array = None, dtype: Type = None):
         if not self.memmap:
             return array
-        file_handle = tempfile.NamedTemporaryFile('w+b')
         if array is None:
-            shape = self.data.shape
             if dtype is None:
                 dtype = self.data.dtype
-            array = np.zeros(shape, dtype=dtype)
-        if array.size > 0:
-            memory_mapped_array = np.memmap(file_handle, shape=array.shape, dtype=array.dtype, mode='readwrite')
-            memory_mapped_array.ravel()[:] = array.ravel()[:]
-            self._file_handles.append(file_handle)
-        else:
-            memory_mapped_array = array
-        return memory_mapped_array
+            return get_scratch_storage().zeros(self.data.shape, dtype)
+        if array.size == 0:
+            return array
+        # Large arrays are memory mapped from scratch files that go away with the arrays (see scratch_utils)
+        return get_scratch_storage().copy(array)
 
     def add_mask(self, mask: np.array):
         self._validate_array(mask)
         self.mask = self._init_array(mask)
 
     def __del__(self):
-        for handle in self._file_handles:
-            handle.close()
         del self.data
         del self.mask
 
@@ -128,29 +119,56 @@ class ArrayData(Data):
 
 
 class CCDData(Data):
+    """
+    Image data with a bad pixel mask and uncertainties
+
+    We keep the variance of each pixel rather than the uncertainty so that propagating it through arithmetic is
+    just adding and scaling arrays in place. The uncertainty is computed from it when it is needed (e.g. when the
+    ERR extension is written), so set uncertainty rather than modifying it in place.
+
+    The variance can be a single value for every pixel (e.g. from the read noise when the image is opened, or
+    zero for masters without an ERR extension). It is only expanded to a full array when something needs the
+    variance of each pixel, so frames whose uncertainties are replaced by ReadNoiseLoader or
+    PoissonInitializer, or that are only used for their data, never allocate it. Methods of this class use
+    _variance directly as numpy broadcasts the scalar; everything else should use variance or uncertainty.
+    """
+    # Set on views made by trim
+    _copy_on_write = False
+
     def __init__(self, data: Union[np.array, Table], meta: fits.Header,
-                 mask: np.array = None, name: str = '', uncertainty: np.array = None, memmap=True):
+                 mask: np.array = None, name: str = '', uncertainty: Union[np.array, float] = None, memmap=True,
+                 variance: Union[np.array, float] = None):
         super().__init__(data=data, meta=meta, mask=mask, name=name, memmap=memmap)
-        if uncertainty is None:
-            uncertainty = self.read_noise * np.sqrt(self.n_sub_exposures) * np.ones(data.shape, dtype=data.dtype)
-            uncertainty /= self.gain
-        self.uncertainty = self._init_array(uncertainty)
+        if self.mask is None:
+            self.mask = np.zeros(self.data.shape, dtype=np.uint8)
+        if variance is not None:
+            self.variance = variance
+        else:
+            if uncertainty is None:
+                uncertainty = self.read_noise * np.sqrt(self.n_sub_exposures) / self.gain
+            self.uncertainty = uncertainty
         self._detector_section = Section.parse_region_keyword(self.meta.get('DETSEC'))
         self._data_section = Section.parse_region_keyword(self.meta.get('DATASEC'))
         self._background = None
 
     def __getitem__(self, section):
         """
-        Return a new CCDData object with the given section of data
+        Return a new CCDData object with the given section of data. Its arrays are read-only views of ours, so
+        nothing is copied unless the section is modified in place, which copies the arrays being modified first.
         :param section: needs to be  in data coords
         :return:
         """
-        return self.trim(trim_section=section)
+        section_data = self.trim(trim_section=section, view=True)
+        for array in [section_data.data, section_data.mask, section_data._variance]:
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+        return section_data
 
     def __imul__(self, value):
         # TODO: Handle the case where this is an array. Add SATURATE and GAIN handling when array.
+        self._make_writeable('data', '_variance')
         self.data *= value
-        self.uncertainty *= value
+        self._variance *= value * value
         self.meta['SATURATE'] *= value
         self.meta['GAIN'] /= value
         self.meta['MAXLIN'] *= value
@@ -158,7 +176,7 @@ class CCDData(Data):
 
     def __mul__(self, value):
         output = CCDData(self.data * value, meta=self.meta.copy(),
-                         name=self.name, uncertainty=self.uncertainty * value,
+                         name=self.name, variance=self._variance * (value * value),
                          mask=self.mask.copy(), memmap=self.memmap)
         output.meta['SATURATE'] *= value
         output.meta['GAIN'] /= value
@@ -167,9 +185,16 @@ class CCDData(Data):
 
     def __itruediv__(self, value):
         if isinstance(value, CCDData):
-            self.uncertainty = np.abs(self.data / value.data) * \
-                               np.sqrt((self.uncertainty / self.data) ** 2 + (value.uncertainty / value.data) ** 2)
+            self._make_writeable('data', 'mask', '_variance')
             self.data /= value.data
+            # var(a / b) = (var(a) + (a / b)^2 var(b)) / b^2
+            variance = self.variance
+            if not value.uncertainty_is_scalar or value._variance != 0:
+                ratio_variance = np.square(self.data)
+                ratio_variance *= value._variance
+                variance += ratio_variance
+            variance /= value.data
+            variance /= value.data
             self.mask |= value.mask
         else:
             self.__imul__(1.0 / value)
@@ -186,33 +211,87 @@ class CCDData(Data):
 
     def __del__(self):
         super().__del__()
-        del self._uncertainty
+        del self._variance
 
     def __isub__(self, value):
+        self._make_writeable('data')
         if isinstance(value, CCDData):
+            self._make_writeable('mask')
             self.data -= value.data
-            self.uncertainty = np.sqrt(value.uncertainty * value.uncertainty + self.uncertainty * self.uncertainty)
+            self._add_variance(value._variance)
             self.mask |= value.mask
         else:
             self.data -= value
         return self
 
     def __sub__(self, other):
-        uncertainty = np.sqrt(self.uncertainty * self.uncertainty + other.uncertainty * other.uncertainty)
         return type(self)(data=self.data - other.data, meta=self.meta, mask=self.mask | other.mask,
-                          uncertainty=uncertainty)
+                          variance=self._variance + other._variance)
+
+    @property
+    def variance(self):
+        if self.uncertainty_is_scalar:
+            self._variance = self._full_array(self._variance)
+        return self._variance
+
+    @variance.setter
+    def variance(self, value: Union[np.array, float]):
+        # This replaces our array rather than writing into it, so there is nothing to copy for views (see trim)
+        if np.ndim(value) == 0:
+            self._variance = self.data.dtype.type(value)
+        else:
+            self._validate_array(value)
+            self._variance = self._init_array(value)
 
     @property
     def uncertainty(self):
-        return self._uncertainty
+        if self.uncertainty_is_scalar:
+            return self._full_array(np.sqrt(self._variance))
+        return np.sqrt(self._variance, out=self._new_array(self._variance.dtype))
 
     @uncertainty.setter
-    def uncertainty(self, value: np.array):
+    def uncertainty(self, value: Union[np.array, float]):
+        if np.ndim(value) == 0:
+            self.variance = np.square(value)
+            return
         self._validate_array(value)
-        self._uncertainty = self._init_array(value)
+        variance = self._init_array(value)
+        if variance is value:
+            variance = np.square(value)
+        else:
+            np.square(variance, out=variance)
+        self._variance = variance
+
+    @property
+    def uncertainty_is_scalar(self):
+        """True if every pixel has the same uncertainty and the array has not been needed yet"""
+        return np.ndim(self._variance) == 0
+
+    def _new_array(self, dtype):
+        if not self.memmap:
+            return np.empty(self.data.shape, dtype=dtype)
+        return self._init_array(dtype=dtype)
+
+    def _full_array(self, value):
+        array = self._new_array(self.data.dtype)
+        array[...] = value
+        return array
+
+    def _add_variance(self, variance):
+        """Add variance (a scalar or an array) to the variance of every pixel in place"""
+        if self.uncertainty_is_scalar and np.ndim(variance) == 0:
+            self.variance = self._variance + variance
+        else:
+            self._make_writeable('_variance')
+            own_variance = self.variance
+            own_variance += variance
 
-    def signal_to_noise(self):
-        return np.abs(self.data) / self.uncertainty
+    def signal_to_noise(self, index=None):
+        """Signal to noise of every pixel, or only the pixels at index (e.g. from stats.sample_indices)"""
+        if index is None:
+            return np.abs(self.data) / np.sqrt(self._variance)
+        variance = self._variance if self.uncertainty_is_scalar else self._variance[index]
+        return np.abs(self.data[index]) / np.sqrt(variance)
 
     def get_overscan_region(self):
         return Section.parse_region_keyword(self.meta.get('BIASSEC', 'N/A'))
@@ -237,23 +316,48 @@ class CCDData(Data):
         inner_ny = round(self.data.shape[0] * inner_edge_width)
         return self.data[inner_ny: -inner_ny, inner_nx: -inner_nx]
 
-    def trim(self, trim_section=None):
+    def trim(self, trim_section=None, view=False):
         """
         :param trim_section: Always in data coords
+        :param view: Share the arrays of this object instead of copying them. Use this when the original is only
+                     read from or is about to be replaced: modifying a view of writeable arrays in place also
+                     modifies this object. Read-only arrays (e.g. of cached masters, or of sections made by
+                     __getitem__) are copied the first time the view modifies them in place instead.
         :return:
         """
         if trim_section is None:
             trim_section = Section.parse_region_keyword(self.meta.get('TRIMSEC', 'N/A'))
 
+        if self.uncertainty_is_scalar:
+            variance = self._variance
+        else:
+            variance = self._variance[trim_section.to_slice()]
         trimmed_image = type(self)(data=self.data[trim_section.to_slice()], meta=self.meta,
                                    mask=self.mask[trim_section.to_slice()], name=self.name,
-                                   uncertainty=self.uncertainty[trim_section.to_slice()], memmap=self.memmap)
+                                   variance=variance,
+                                   memmap=self.memmap and not view)
+        if view:
+            # Any new arrays still go in scratch storage
+            trimmed_image.memmap = self.memmap
+            trimmed_image._copy_on_write = True
         trimmed_image.detector_section = self.data_to_detector_section(trim_section)
         trimmed_image.data_section = Section(x_start=1, y_start=1,
                                              x_stop=trimmed_image.data.shape[1],
                                              y_stop=trimmed_image.data.shape[0])
         return trimmed_image
 
+    def _make_writeable(self, *attributes):
+        """
+        Copy the read-only arrays of a view (see trim) that are about to be modified in place. attributes are the
+        names of the arrays (data, mask and/or _variance), all of them if none are given.
+        """
+        if not self._copy_on_write:
+            return
+        for attribute in attributes or ['data', 'mask', '_variance']:
+            array = getattr(self, attribute)
+            if isinstance(array, np.ndarray) and not array.flags.writeable:
+                setattr(self, attribute, self._init_array(array) if self.memmap else array.copy())
+
     @property
     def dtype(self):
         return self.data.dtype
@@ -397,16 +501,19 @@ class CCDData(Data):
         :param data_to_copy:
         :return:
         """
+        self._make_writeable()
         overlap_section = self.get_overlap(data.detector_section)
-        data_to_copy = data.trim(trim_section=data.detector_to_data_section(overlap_section))
+        data_to_copy = data.trim(trim_section=data.detector_to_data_section(overlap_section), view=True)
         data_to_copy = data_to_copy.rebin(self.binning)
-        for array_name_to_copy in ['data', 'mask', 'uncertainty']:
-            array_to_copy = getattr(data_to_copy, array_name_to_copy)
-            my_overlap = self.detector_to_data_section(overlap_section).to_slice()
-            getattr(self, array_name_to_copy)[my_overlap][:] = array_to_copy[:]
+        my_overlap = self.detector_to_data_section(overlap_section).to_slice()
+        self.data[my_overlap] = data_to_copy.data
+        self.mask[my_overlap] = data_to_copy.mask
+        if not (self.uncertainty_is_scalar and data_to_copy.uncertainty_is_scalar and
+                self._variance == data_to_copy._variance):
+            self.variance[my_overlap] = data_to_copy._variance
 
     def init_poisson_uncertainties(self):
-        self.uncertainty = np.sqrt(self.uncertainty ** 2.0 + np.abs(self.data))
+        self._add_variance(np.abs(self.data))
 
     @property
     def background(self):
@@ -414,6 +521,7 @@ class CCDData(Data):
 
     @background.setter
     def background(self, value):
+        self._make_writeable('data')
         if self._background is not None:
             self.data += self._background
         self._background = value
@@ -422,47 +530,21 @@ class CCDData(Data):
 
 def stack(data_to_stack, nsigma_reject) -> CCDData:
     """
+    Sigma clipped mean of a list of CCDData objects, see banzai.utils.stack_utils.sigma_clipped_stack
     """
     shape3d = [len(data_to_stack)] + list(data_to_stack[0].shape)
-    a = np.zeros(shape3d, dtype=data_to_stack[0].dtype)
-    uncertainties = np.zeros(shape3d, dtype=data_to_stack[0].dtype)
+    a = np.zeros(shape3d, dtype=np.float32)
+    uncertainties = np.zeros(shape3d, dtype=np.float32)
     mask = np.zeros(shape3d, dtype=np.uint8)
 
     for i, data in enumerate(data_to_stack):
         a[i, :, :] = data.data[:, :]
         mask[i, :, :] = data.mask[:, :]
-        uncertainties[i, :, :] = data.uncertainty[:, :]
-
-    abs_deviation = stats.absolute_deviation(a, axis=0, mask=mask)
-
-    robust_std = stats.robust_standard_deviation(a, axis=0, abs_deviation=abs_deviation, mask=mask)
-
-    robust_std = np.expand_dims(robust_std, axis=0)
-
-    # Mask values that are N sigma from the median
-    sigma_mask = abs_deviation > (nsigma_reject * robust_std)
-
-    mask3d = np.logical_or(sigma_mask, mask > 0)
-    n_good_pixels = np.logical_not(mask3d).sum(axis=0)
-
-    stacked_mask = np.zeros(n_good_pixels.shape, dtype=np.uint8)
-
-    # If a pixel is bad in all images, make sure we don't divide by zero
-    bad_pixels = n_good_pixels == 0
-
-    # If pixel is bad in all of the images, we take the logical or of all of the bits to go in the final mask
-    stacked_mask[bad_pixels] = np.bitwise_or.reduce(mask, axis=0)[bad_pixels]
-
-    # If a pixel is bad in all images, fill that pixel with the mean from the images
-    n_good_pixels[bad_pixels] = len(data_to_stack)
-    mask3d[:, bad_pixels] = False
-
-    a[mask3d] = 0.0
-    stacked_data = a.sum(axis=0) / n_good_pixels
-
-    # Again if a pixel is bad in all images, fill the uncertainties with the quadrature sum / N images
-    uncertainties[mask3d] = 0.0
-    uncertainties *= uncertainties
-    stacked_uncertainty = np.sqrt(uncertainties.sum(axis=0) / (n_good_pixels ** 2.0))
-
-    return CCDData(data=stacked_data, meta=data_to_stack[0].meta, uncertainty=stacked_uncertainty, mask=stacked_mask)
+        uncertainties[i, :, :] = data._variance
+    np.sqrt(uncertainties, out=uncertainties)
+
+    stacked_data, stacked_uncertainty, stacked_mask = stack_utils.sigma_clipped_stack(a, uncertainties, mask,
+                                                                                      nsigma_reject)
+    output_dtype = data_to_stack[0].dtype
+    return CCDData(data=stacked_data.astype(output_dtype, copy=False), meta=data_to_stack[0].meta,
+                   uncertainty=stacked_uncertainty.astype(output_dtype, copy=False), mask=stacked_mask)
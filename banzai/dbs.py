@@ -7,13 +7,19 @@ Author
 
 October 2015
 """
+import os
 import os.path
 import datetime
+import threading
+import time
+from collections import namedtuple
 from dateutil.parser import parse
 import requests
-from sqlalchemy import create_engine, pool, func, make_url
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, pool, func, make_url, case, update, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import sessionmaker, declarative_base, aliased
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, CHAR, JSON, UniqueConstraint, Float
+from sqlalchemy import Index, text
 from sqlalchemy.sql.expression import true
 from contextlib import contextmanager
 from banzai.logs import get_logger
@@ -22,6 +28,59 @@ Base = declarative_base()
 
 logger = get_logger()
 
+# Engines (and their connection pools) are shared by every session in a process. They are keyed by db_address
+# and are rebuilt if we find ourselves in a new process as pooled connections cannot be shared across a fork.
+_engines = {}
+_engines_pid = None
+_engines_lock = threading.Lock()
+
+# How long (in seconds) the in-memory copy of the instruments and sites tables is used before it is reloaded
+INSTRUMENT_REGISTRY_TTL = 300
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def _create_engine(db_address):
+    if make_url(db_address).get_backend_name() == 'sqlite':
+        # sqlite connections are cheap and sqlite databases are routinely created and deleted underneath us
+        # (e.g. the local cache and the tests), so don't hold any connections open.
+        return create_engine(db_address, poolclass=pool.NullPool)
+    # Connections to Postgres can be dropped by the server or a proxy while they sit in the pool,
+    # so check them before use
+    return create_engine(db_address, pool_pre_ping=True)
+
+
+def get_engine(db_address):
+    """
+    Get the engine for a database, creating it if this process does not have one yet.
+
+    Engines are thread safe so this can be shared by all of the threads in the process.
+    """
+    global _engines_pid
+    with _engines_lock:
+        if _engines_pid != os.getpid():
+            _reset_engines()
+        if db_address not in _engines:
+            _engines[db_address] = _create_engine(db_address)
+        return _engines[db_address]
+
+
+def _reset_engines():
+    global _engines_pid
+    for engine in _engines.values():
+        # Don't close the connections: after a fork, they still belong to the parent process
+        engine.dispose(close=False)
+    _engines.clear()
+    _engines_pid = os.getpid()
+
+
+def reset_engines():
+    """
+    Drop all of the engines (and connection pools) in this process. Call this in a freshly forked process.
+    """
+    with _engines_lock:
+        _reset_engines()
+
 
 @contextmanager
 def get_session(db_address):
@@ -32,8 +91,7 @@ def get_session(db_address):
     -------
     session: SQLAlchemy Database Session
     """
-    # Build a new engine for each session. This makes things thread safe.
-    engine = create_engine(db_address, poolclass=pool.NullPool)
+    engine = get_engine(db_address)
     Base.metadata.bind = engine
 
     # We don't use autoflush typically. I have run into issues where SQLAlchemy would try to flush
@@ -59,6 +117,15 @@ class CalibrationImage(Base):
     easy to find the closest calibration frame.
     """
     __tablename__ = 'calimages'
+    __table_args__ = (
+        # Serves the nearest in time master lookups in query_calibrations
+        Index('ix_calimages_master_lookup', 'instrument_id', 'type', 'is_master', 'is_bad', 'dateobs'),
+        # Match the expressions build_master_calibration_criteria filters on. Postgres only: sqlite cannot
+        # index the JSON path expressions SQLAlchemy generates.
+        *[Index(f'ix_calimages_{attribute}', text(f"(CAST((attributes ->> '{attribute}') AS VARCHAR))"))
+          .ddl_if(dialect='postgresql') for attribute in ['configuration_mode', 'binning', 'ccd_temperature',
+                                                          'filter']],
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     type = Column(String(50), index=True)
     filename = Column(String(100), unique=True)
@@ -108,7 +175,7 @@ class Site(Base):
 class ProcessedImage(Base):
     __tablename__ = 'processedimages'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    filename = Column(String(100), index=True)
+    filename = Column(String(100), index=True, unique=True)
     frameid = Column(Integer, nullable=True)
     checksum = Column(CHAR(32), index=True, default='0'*32)
     success = Column(Boolean, default=False)
@@ -183,6 +250,7 @@ def add_instrument(instrument, db_address):
 
         instrument_record = add_or_update_record(db_session, Instrument, equivalence_criteria, record_attributes)
         db_session.commit()
+    invalidate_registry(db_address)
     return instrument_record
 
 
@@ -197,6 +265,7 @@ def add_site(site, db_address):
 
         site_record = add_or_update_record(db_session, Site, equivalence_criteria, record_attributes)
         db_session.commit()
+    invalidate_registry(db_address)
     return site_record
 
 
@@ -245,10 +314,96 @@ class SiteMissingException(Exception):
     pass
 
 
-def query_for_instrument(db_address, site, camera, name=None):
-    # Short circuit
-    if None in [site, camera]:
+class InstrumentRegistry:
+    """
+    In-memory copy of the instruments and sites tables.
+
+    Every frame looks up its instrument several times (when it is queued, when we check whether it needs to be
+    processed, and when it is opened). The tables are small and rarely change, so we load them in bulk and
+    reload them after ttl seconds. Anything that is not in the registry is looked up in the database by the
+    callers, so new instruments are picked up straight away. Changes made in this process call
+    invalidate_registry; other processes see them after at most ttl seconds.
+
+    Parameters
+    ----------
+    db_address: str
+    ttl: float
+         Number of seconds to use the loaded tables for
+    """
+    def __init__(self, db_address, ttl=INSTRUMENT_REGISTRY_TTL):
+        self.db_address = db_address
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._instruments = {}
+        self._instruments_by_id = {}
+        self._sites = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self):
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            with get_session(db_address=self.db_address) as db_session:
+                instruments = db_session.query(Instrument).order_by(Instrument.id.desc()).all()
+                sites = db_session.query(Site).all()
+            self._instruments = {}
+            for instrument in instruments:
+                # Newest instrument first, to match query_for_instrument
+                self._instruments.setdefault((instrument.site, instrument.camera), []).append(instrument)
+            self._instruments_by_id = {instrument.id: instrument for instrument in instruments}
+            self._sites = {site.id: site for site in sites}
+            self._loaded_at = time.monotonic()
+
+    def get_instrument(self, site, camera, name=None):
+        self._load()
+        for instrument in self._instruments.get((site, camera), []):
+            if name is None or instrument.name == name:
+                return instrument
         return None
+
+    def get_instrument_by_id(self, id):
+        self._load()
+        return self._instruments_by_id.get(id)
+
+    def has_instrument(self, id):
+        """Whether the loaded tables include the instrument, without reloading them"""
+        with self._lock:
+            return self._loaded_at is not None and id in self._instruments_by_id
+
+    def get_site(self, site_id):
+        self._load()
+        return self._sites.get(site_id)
+
+
+def get_registry(db_address):
+    """Get this process's InstrumentRegistry for a database"""
+    with _registries_lock:
+        if db_address not in _registries:
+            _registries[db_address] = InstrumentRegistry(db_address)
+        return _registries[db_address]
+
+
+def invalidate_registry(db_address=None):
+    """
+    Make the instrument registry reload the instruments and sites tables the next time it is used.
+
+    Parameters
+    ----------
+    db_address: str
+                Only invalidate the registry for this database. If None, invalidate every registry.
+    """
+    with _registries_lock:
+        registries = [registry for address, registry in _registries.items()
+                      if db_address is None or address == db_address]
+    for registry in registries:
+        registry.invalidate()
+
+
+def _query_for_instrument(db_address, site, camera, name=None):
     with get_session(db_address=db_address) as db_session:
         criteria = (Instrument.site == site) & (Instrument.camera == camera)
         if name is not None:
@@ -257,6 +412,20 @@ def query_for_instrument(db_address, site, camera, name=None):
     return instrument
 
 
+def query_for_instrument(db_address, site, camera, name=None):
+    # Short circuit
+    if None in [site, camera]:
+        return None
+    registry = get_registry(db_address)
+    instrument = registry.get_instrument(site, camera, name=name)
+    if instrument is None:
+        # The instrument may have been added since the registry was loaded
+        instrument = _query_for_instrument(db_address, site, camera, name=name)
+        if instrument is not None:
+            registry.invalidate()
+    return instrument
+
+
 def save_calibration_info(calibration_image: CalibrationImage, db_address):
     record_attributes = vars(calibration_image)
     # There is not a clean way to back a dict object from a calibration image object without this instance state
@@ -284,11 +453,105 @@ def commit_processed_image(processed_image, db_address):
         db_session.commit()
 
 
+def _insert(db_session, table_model):
+    if 'postgres' in db_session.bind.dialect.name:
+        return postgresql.insert(table_model)
+    elif 'sqlite' in db_session.bind.dialect.name:
+        return sqlite.insert(table_model)
+    else:
+        raise NotImplementedError("Only postgres and sqlite are supported")
+
+
+ClaimedFrame = namedtuple('ClaimedFrame', ['tries', 'success', 'checksum_changed'])
+
+
+def claim_frame(path, checksum, frameid, db_address):
+    """
+    Record that we have received a frame, in a single statement.
+
+    Parameters
+    ----------
+    path: str
+          Path or filename of the frame
+    checksum: str
+              md5 of the frame. If this is different than the checksum we have on record, the frame has changed,
+              so the number of tries and the success flag are reset.
+    frameid: int
+             Archive frame id. Left alone if None.
+    db_address: str
+
+    Returns
+    -------
+    processed_image: ClaimedFrame
+                     The tries and success columns for the frame after the update, and whether the checksum
+                     differed from the one on record (always True for a frame we have not seen before)
+
+    Notes
+    -----
+    On postgres, the checksum on record is returned by a subquery, which sees the table from before the statement.
+    Subqueries in a sqlite RETURNING clause see the updated row instead, so there we can only report that the frame
+    is in the state a changed checksum leaves it in: no tries and not successful.
+    """
+    filename = os.path.basename(path)
+    with get_session(db_address=db_address) as db_session:
+        insert = _insert(db_session, ProcessedImage)
+        insert = insert.values(filename=filename, checksum=checksum, frameid=frameid, tries=0, success=False)
+        checksum_changed = ProcessedImage.checksum != insert.excluded.checksum
+        insert = insert.on_conflict_do_update(
+            index_elements=[ProcessedImage.filename],
+            set_={'checksum': insert.excluded.checksum,
+                  'frameid': func.coalesce(insert.excluded.frameid, ProcessedImage.frameid),
+                  'tries': case((checksum_changed, 0), else_=ProcessedImage.tries),
+                  'success': case((checksum_changed, False), else_=ProcessedImage.success)}
+        )
+        if 'postgres' in db_session.bind.dialect.name:
+            previous_image = aliased(ProcessedImage)
+            previous_checksum = select(previous_image.checksum).where(previous_image.filename == filename)
+            insert = insert.returning(ProcessedImage.tries, ProcessedImage.success,
+                                      previous_checksum.scalar_subquery().label('previous_checksum'))
+            processed_image = db_session.execute(insert).one()
+            checksum_changed = processed_image.previous_checksum != checksum
+        else:
+            insert = insert.returning(ProcessedImage.tries, ProcessedImage.success)
+            processed_image = db_session.execute(insert).one()
+            checksum_changed = processed_image.tries == 0 and not processed_image.success
+    return ClaimedFrame(processed_image.tries, processed_image.success, checksum_changed)
+
+
+def mark_try(path, db_address):
+    """
+    Increment the number of times we have tried to process a frame in a single statement.
+
+    Returns
+    -------
+    tries: int
+           The number of tries including this one
+    """
+    filename = os.path.basename(path)
+    with get_session(db_address=db_address) as db_session:
+        insert = _insert(db_session, ProcessedImage).values(filename=filename, tries=1)
+        insert = insert.on_conflict_do_update(index_elements=[ProcessedImage.filename],
+                                              set_={'tries': ProcessedImage.tries + 1})
+        tries = db_session.execute(insert.returning(ProcessedImage.tries)).scalar_one()
+    return tries
+
+
+def mark_success(path, db_address):
+    """
+    Mark a frame as successfully processed in a single statement. Frames we have no record of are ignored.
+    """
+    filename = os.path.basename(path)
+    with get_session(db_address=db_address) as db_session:
+        db_session.execute(update(ProcessedImage).where(ProcessedImage.filename == filename).values(success=True))
+
+
 def save_processed_image(path, md5, db_address):
     filename = os.path.basename(path)
-    output_record = get_processed_image(filename, db_address)
-    output_record.checksum = md5
-    commit_processed_image(output_record, db_address)
+    with get_session(db_address=db_address) as db_session:
+        insert = _insert(db_session, ProcessedImage).values(filename=filename, checksum=md5)
+        insert = insert.on_conflict_do_update(index_elements=[ProcessedImage.filename],
+                                              set_={'checksum': insert.excluded.checksum})
+        db_session.execute(insert)
 
 
 def get_timezone(site, db_address):
@@ -297,19 +560,29 @@ def get_timezone(site, db_address):
 
 
 def get_instruments_at_site(site, db_address):
+    # The registry cannot tell us that its list for a site is complete, so always ask the database. This is only
+    # used when scheduling, not for every frame.
     with get_session(db_address=db_address) as db_session:
-        query = (Instrument.site == site)
-        instruments = db_session.query(Instrument).filter(query).all()
+        instruments = db_session.query(Instrument).filter(Instrument.site == site).all()
+    registry = get_registry(db_address)
+    if not all(registry.has_instrument(instrument.id) for instrument in instruments):
+        # Added by another process: pick it up for the per-frame lookups too
+        registry.invalidate()
     return instruments
 
 
 def get_instrument_by_id(id, db_address):
-    with get_session(db_address=db_address) as db_session:
-        instrument = db_session.query(Instrument).filter(Instrument.id==id).first()
+    instrument = get_registry(db_address).get_instrument_by_id(id)
+    if instrument is None:
+        with get_session(db_address=db_address) as db_session:
+            instrument = db_session.query(Instrument).filter(Instrument.id==id).first()
     return instrument
 
 
 def get_site(site_id, db_address):
+    site = get_registry(db_address).get_site(site_id)
+    if site is not None:
+        return site
     with get_session(db_address=db_address) as db_session:
         site_list = db_session.query(Site).filter(Site.id == site_id).all()
     if len(site_list) == 0:
@@ -342,8 +615,8 @@ def update_calibration_frameid(cal_record_file_info, db_address):
             db_session.commit()
 
 
-def build_master_calibration_criteria(image, calibration_type, master_selection_criteria,
-                                      use_only_older_calibrations):
+def build_calibration_set_criteria(image, calibration_type, master_selection_criteria):
+    """Criteria for the masters of the right type and calibration set for an image, regardless of the date"""
     calibration_criteria = CalibrationImage.type == calibration_type.upper()
     calibration_criteria &= CalibrationImage.instrument_id == image.instrument.id
     calibration_criteria &= CalibrationImage.is_master.is_(True)
@@ -354,6 +627,12 @@ def build_master_calibration_criteria(image, calibration_type, master_selection_
         # https://docs.sqlalchemy.org/en/latest/core/type_basics.html?highlight=json#sqlalchemy.types.JSON
         calibration_criteria &= CalibrationImage.attributes[criterion].as_string() ==\
                                 str(getattr(image, criterion))
+    return calibration_criteria
+
+
+def build_master_calibration_criteria(image, calibration_type, master_selection_criteria,
+                                      use_only_older_calibrations):
+    calibration_criteria = build_calibration_set_criteria(image, calibration_type, master_selection_criteria)
 
     # During real-time reduction, we want to avoid using different master calibrations for the same block,
     # therefore we make sure the the calibration frame used was created before the block start time
@@ -366,17 +645,24 @@ def build_master_calibration_criteria(image, calibration_type, master_selection_
 
 
 def query_calibrations(image, calibration_criteria, db_address):
+    """
+    Find the calibration closest in time to the image.
+
+    Rather than sorting every candidate by the time difference, which no index can serve, we look up the latest
+    calibration taken before the image and the earliest one taken after it. Each of these is a single range scan
+    on ix_calimages_master_lookup. Ties go to the earlier calibration.
+    """
     with get_session(db_address=db_address) as db_session:
-        if 'postgres' in db_session.bind.dialect.name:
-            order_func = func.abs(func.extract("epoch", CalibrationImage.dateobs) -
-                                  func.extract("epoch", image.dateobs))
-        elif 'sqlite' in db_session.bind.dialect.name:
-            order_func = func.abs(func.julianday(CalibrationImage.dateobs) - func.julianday(image.dateobs))
-        else:
-            raise NotImplementedError("Only postgres and sqlite are supported")
         image_filter = db_session.query(CalibrationImage).filter(calibration_criteria)
-        calibration_image = image_filter.order_by(order_func).first()
-    return calibration_image
+        before = image_filter.filter(CalibrationImage.dateobs <= image.dateobs)
+        before = before.order_by(CalibrationImage.dateobs.desc()).first()
+        after = image_filter.filter(CalibrationImage.dateobs > image.dateobs)
+        after = after.order_by(CalibrationImage.dateobs.asc()).first()
+    if before is None or after is None:
+        return before or after
+    if after.dateobs - image.dateobs < image.dateobs - before.dateobs:
+        return after
+    return before
 
 
 def get_master_cal_record(image, calibration_type, master_selection_criteria, db_address,
@@ -387,6 +673,94 @@ def get_master_cal_record(image, calibration_type, master_selection_criteria, db
     return calibration_image
 
 
+def get_calibration_set_key(image, master_selection_criteria):
+    """Images with the same key share the same set of candidate masters"""
+    return (image.instrument.id,) + tuple(str(getattr(image, criterion)) for criterion in master_selection_criteria)
+
+
+def _is_valid_calibration(record, image, use_only_older_calibrations):
+    # The same date cuts as build_master_calibration_criteria. NULLs never pass a comparison in SQL.
+    if record.good_after is None or record.good_after > image.dateobs:
+        return False
+    if record.good_until is None or record.good_until < image.dateobs:
+        return False
+    if use_only_older_calibrations and getattr(image, 'block_start') is not None:
+        return record.datecreated is not None and record.datecreated < image.block_start
+    return True
+
+
+def _select_closest_calibration(records, image, use_only_older_calibrations):
+    closest_record = None
+    for record in records:
+        if not _is_valid_calibration(record, image, use_only_older_calibrations):
+            continue
+        # records are sorted by dateobs so ties go to the earlier calibration like in query_calibrations
+        if closest_record is None or abs(record.dateobs - image.dateobs) < abs(closest_record.dateobs - image.dateobs):
+            closest_record = record
+    return closest_record
+
+
+def get_master_cal_records(images, calibration_type, master_selection_criteria, db_address,
+                           use_only_older_calibrations=False):
+    """
+    Find the master calibration for each of a list of images, with one query per calibration set.
+
+    For each set of images that share candidate masters (see get_calibration_set_key), we load every candidate
+    taken between the latest one before the first image and the earliest one after the last image. Any other
+    candidate is further in time from every image than one of these, so the closest master for each image can
+    be picked from the loaded candidates. If the date cuts rule out everything that was loaded for an image,
+    that image falls back to get_master_cal_record.
+
+    Returns
+    -------
+    records: list
+             The CalibrationImage record (or None) for each image, in the same order as images
+    """
+    image_sets = {}
+    for i, image in enumerate(images):
+        image_sets.setdefault(get_calibration_set_key(image, master_selection_criteria), []).append(i)
+
+    records = [None] * len(images)
+    with get_session(db_address=db_address) as db_session:
+        for image_indices in image_sets.values():
+            image_set = [images[i] for i in image_indices]
+            first_dateobs = min(image.dateobs for image in image_set)
+            last_dateobs = max(image.dateobs for image in image_set)
+            calibration_set_criteria = build_calibration_set_criteria(image_set[0], calibration_type,
+                                                                      master_selection_criteria)
+            latest_before = db_session.query(func.max(CalibrationImage.dateobs))
+            latest_before = latest_before.filter(calibration_set_criteria & (CalibrationImage.dateobs <= first_dateobs))
+            earliest_after = db_session.query(func.min(CalibrationImage.dateobs))
+            earliest_after = earliest_after.filter(calibration_set_criteria & (CalibrationImage.dateobs > last_dateobs))
+            candidates_query = db_session.query(CalibrationImage).filter(calibration_set_criteria)
+            candidates_query = candidates_query.filter(
+                CalibrationImage.dateobs >= func.coalesce(latest_before.scalar_subquery(), first_dateobs),
+                CalibrationImage.dateobs <= func.coalesce(earliest_after.scalar_subquery(), last_dateobs)
+            )
+            candidates = candidates_query.order_by(CalibrationImage.dateobs).all()
+
+            # Anything that was not loaded is strictly further away than the loaded candidates at either end
+            lower_bound, upper_bound = None, None
+            if candidates and candidates[0].dateobs <= first_dateobs:
+                lower_bound = candidates[0].dateobs
+            if candidates and candidates[-1].dateobs > last_dateobs:
+                upper_bound = candidates[-1].dateobs
+            for i, image in zip(image_indices, image_set):
+                record = _select_closest_calibration(candidates, image, use_only_older_calibrations)
+                if record is not None:
+                    time_difference = abs(record.dateobs - image.dateobs)
+                    if (lower_bound is None or time_difference <= image.dateobs - lower_bound) and \
+                            (upper_bound is None or time_difference <= upper_bound - image.dateobs):
+                        records[i] = record
+                        continue
+                elif lower_bound is None and upper_bound is None:
+                    # Every candidate was loaded so there is no master for this image
+                    continue
+                records[i] = get_master_cal_record(image, calibration_type, master_selection_criteria, db_address,
+                                                   use_only_older_calibrations=use_only_older_calibrations)
+    return records
+
+
 def get_individual_cal_records(instrument, calibration_type, min_date: str, max_date: str, db_address: str,
                                include_bad_frames: bool = False):
     calibration_criteria = CalibrationImage.instrument_id == instrument.id
@@ -589,3 +963,4 @@ def replicate_instrument(instrument_record, db_address):
 
         add_or_update_record(db_session, Instrument, equivalence_criteria, record_attributes)
         db_session.commit()
+    invalidate_registry(db_address)
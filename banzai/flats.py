@@ -14,8 +14,11 @@ class FlatSNRChecker(Stage):
         super(FlatSNRChecker, self).__init__(runtime_context)
 
     def do_stage(self, image):
-        # Make sure the median signal-to-noise ratio is over 50 for the image otherwise abort
-        flat_snr = np.median(image.primary_hdu.signal_to_noise())
+        # Make sure the median signal-to-noise ratio is over 50 for the image otherwise abort. We only need the
+        # signal-to-noise of a sample of the pixels unless the median is close to the threshold.
+        flat_snr, _, _ = stats.sampled_median(image.primary_hdu.signal_to_noise, threshold=50.0,
+                                              shape=image.primary_hdu.data.shape,
+                                              n_samples=self.runtime_context.SAMPLED_STATISTICS_SIZE)
         logger.info('Flat signal-to-noise', image=image, extra_tags={'flat_snr': flat_snr})
         if flat_snr < 50.0:
             logger.error('Rejecting Flat due to low signal-to-noise', image=image, extra_tags={'flat_snr': flat_snr})
@@ -234,7 +234,7 @@ class ObservationFrame(metaclass=abc.ABCMeta):
     def write(self, runtime_context):
         pass
 
-    def to_fits(self, context):
+    def to_fits(self, context, compress=True):
         hdu_list_to_write = fits.HDUList([])
         for hdu in self._hdus:
             hdu_list_to_write += hdu.to_fits(context)
@@ -242,7 +242,7 @@ class ObservationFrame(metaclass=abc.ABCMeta):
         if not isinstance(hdu_list_to_write[0], fits.PrimaryHDU):
             hdu_list_to_write[0] = fits.PrimaryHDU(data=hdu_list_to_write[0].data, header=hdu_list_to_write[0].header)
         fits_utils.convert_extension_datatypes(hdu_list_to_write, context.REDUCED_DATA_EXTENSION_TYPES)
-        if context.fpack:
+        if context.fpack and compress:
             hdu_list_to_write = fits_utils.pack(hdu_list_to_write, context.LOSSLESS_EXTENSIONS)
         return hdu_list_to_write
 
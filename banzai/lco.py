@@ -513,7 +513,8 @@ class LCOFrameFactory(FrameFactory):
                 if hdu.data is None or hdu.data.size == 0:
                     hdu_list.append(HeaderOnly(meta=hdu.header, name=hdu.header.get('EXTNAME')))
                 else:
-                    hdu_list.append(self.data_class(data=hdu.data, meta=hdu.header, name=hdu.header.get('EXTNAME')))
+                    hdu_list.append(self.data_class(data=hdu.data, meta=hdu.header, name=hdu.header.get('EXTNAME'),
+                                                    memmap=hdu.data.flags.writeable))
         else:
             primary_hdu = None
             for hdu in fits_hdu_list:
@@ -550,17 +551,21 @@ class LCOFrameFactory(FrameFactory):
                     if hdu.header.get('INSTRUME') == 'fs01':
                         self._update_fs01_sections(hdu)
                     if hdu.data.dtype == np.uint16 or hdu.data.dtype == np.uint32:
-                        hdu.data = hdu.data.astype(np.float64)
+                        hdu.data = hdu.data.astype(runtime_context.PROCESSING_DTYPE)
                     # check if we need to propagate any header keywords from the primary header
                     if primary_hdu is not None:
                         for keyword in self.primary_header_keys_to_propagate:
                             if keyword in primary_hdu.header and keyword not in hdu.header:
                                 hdu.header[keyword] = primary_hdu.header[keyword]
-                    # For master frames without uncertainties, set to all zeros
+                    # For master frames without uncertainties, set to zero (only expanded to an array if needed)
                     if hdu.header.get('ISMASTER', False) and associated_data['uncertainty'] is None:
-                        associated_data['uncertainty'] = np.zeros(hdu.data.shape, dtype=hdu.data.dtype)
+                        associated_data['uncertainty'] = 0.0
+                    # Memory mapped arrays come from a shared, decompressed copy of the file
+                    # (see banzai.cache.calibration_store and banzai.cache.accumulator). Use them as they are
+                    # instead of copying them.
+                    memmap = hdu.data.flags.writeable and not isinstance(hdu.data, np.memmap)
                     hdu_list.append(self.data_class(data=hdu.data, meta=hdu.header, name=hdu.header.get('EXTNAME'),
-                                                    **associated_data))
+                                                    memmap=memmap, **associated_data))
                 else:
                     hdu_list.append(ArrayData(data=hdu.data, meta=hdu.header, name=hdu.header.get('EXTNAME')))
 
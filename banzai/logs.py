@@ -56,6 +56,10 @@ def set_log_level(log_level='INFO'):
     logger.setLevel(log_level.upper())
 
 
+def get_log_level():
+    return logging.getLevelName(logger.level)
+
+
 def format_exception():
     exc_type, exc_value, exc_tb = sys.exc_info()
     return traceback.format_exception(exc_type, exc_value, exc_tb)
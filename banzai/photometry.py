@@ -76,8 +76,9 @@ class SourceDetector(Stage):
 
     def do_stage(self, image):
         try:
-            data = image.data.copy()
-            error = image.uncertainty
+            # Do the source detection and photometry in double precision, whatever precision we reduce in
+            data = image.data.astype(np.float64)
+            error = image.uncertainty.astype(np.float64, copy=False)
 
             # From what I can piece together, the background estimator makes a low resolution mesh set by box size
             # (32, 32) here and then applies a filter to the low resolution image. The filter size is 3x3 here.
@@ -237,15 +238,17 @@ class SourceDetector(Stage):
             sources.reverse()
 
             # Save some background statistics in the header
-            mean_background = stats.sigma_clipped_mean(bkg.background, 5.0)
+            # The background is smooth, so a sample of its pixels gives these to well within their precision
+            n_samples = self.runtime_context.SAMPLED_STATISTICS_SIZE
+            mean_background, _, _ = stats.sampled_sigma_clipped_mean(bkg.background, 5.0, n_samples=n_samples)
             image.meta['L1MEAN'] = (mean_background,
                                     '[counts] Sigma clipped mean of frame background')
 
-            median_background = np.median(bkg.background)
+            median_background, _, _ = stats.sampled_median(bkg.background, n_samples=n_samples)
             image.meta['L1MEDIAN'] = (median_background,
                                       '[counts] Median of frame background')
 
-            std_background = stats.robust_standard_deviation(bkg.background)
+            std_background, _, _ = stats.sampled_robust_standard_deviation(bkg.background, n_samples=n_samples)
             image.meta['L1SIGMA'] = (std_background,
                                      '[counts] Robust std dev of frame background')
 
@@ -2,7 +2,7 @@ import os
 from datetime import datetime, timedelta, timezone
 from dateutil.parser import parse
 
-from celery import Celery
+from celery import Celery, chord, group
 from kombu import Queue
 from celery.exceptions import Retry
 from banzai import dbs, calibrations, logs
@@ -38,6 +38,8 @@ RETRY_DELAY = int(os.getenv('RETRY_DELAY', 600))
 
 @worker_process_init.connect(weak=False)
 def configure_workers(**kwargs):
+    # Don't reuse the database connections inherited from the parent process
+    dbs.reset_engines()
     if OPENTELEMETRY_AVAILABLE:
         CeleryInstrumentor().instrument()
     # We need to do this because of how the metrics library uses threads and how celery spawns workers.
@@ -142,7 +144,8 @@ def schedule_calibration_stacking(site: str, runtime_context: dict,
                     logger.info('Scheduling stacking at {}'.format(schedule_time.strftime(date_utils.TIMESTAMP_FORMAT)),
                                 extra_tags={'site': site, 'min_date': stacking_min_date, 'max_date': stacking_max_date,
                                             'instrument': instrument.camera, 'frame_type': frame_type})
-                    if instrument.nx * instrument.ny > runtime_context.LARGE_WORKER_THRESHOLD:
+                    if instrument.nx * instrument.ny > runtime_context.LARGE_WORKER_THRESHOLD and \
+                            not stacking_by_band(runtime_context):
                         queue_name = runtime_context.LARGE_WORKER_QUEUE
                     else:
                         queue_name = runtime_context.CELERY_TASK_QUEUE_NAME
@@ -208,7 +211,10 @@ def stack_calibrations(self, min_date: str, max_date: str, instrument_id: int, f
                 "instrument": instrument.camera,
                 "frame_type": frame_type
             })
-            calibrations.make_master_calibrations(instrument, frame_type, min_date, max_date, runtime_context)
+            if stacking_by_band(runtime_context):
+                schedule_master_bands(instrument, frame_type, min_date, max_date, runtime_context)
+            else:
+                calibrations.make_master_calibrations(instrument, frame_type, min_date, max_date, runtime_context)
             add_telemetry_span_event("completed_calibration_stacking", {
                 "site": instrument.site,
                 "instrument": instrument.camera,
@@ -224,6 +230,59 @@ def stack_calibrations(self, min_date: str, max_date: str, instrument_id: int, f
         raise self.retry()
 
 
+def stacking_by_band(runtime_context):
+    """Whether masters are stacked in bands of rows across several tasks (see schedule_master_bands)"""
+    return runtime_context.STACKING_BAND_TASKS > 1 and bool(runtime_context.CALIBRATION_ACCUMULATOR_DIRECTORY)
+
+
+def schedule_master_bands(instrument, frame_type, min_date, max_date, runtime_context):
+    """
+    Stack the masters in bands of rows, one stack_calibration_band task per band, and combine the bands with
+    combine_calibration_bands once they are all done (a celery chord). None of the tasks needs to hold whole
+    individual frames in memory, so they do not need a large worker. If the frames cannot be read by band, the
+    masters are made here as usual.
+    """
+    calibration_frames_info = calibrations.get_calibration_frames_to_stack(instrument, frame_type, min_date,
+                                                                           max_date, runtime_context)
+    bands = calibrations.plan_master_bands(calibration_frames_info, runtime_context)
+    if bands is None:
+        logger.info('Not all frames are in the calibration accumulator, stacking in a single task',
+                    extra_tags={'instrument': instrument.camera, 'frame_type': frame_type})
+        calibrations.make_master_calibrations(instrument, frame_type, min_date, max_date, runtime_context)
+        return
+    # Only what we need to open the frames. Task arguments have to be json serializable.
+    calibration_frames_info = [{key: value for key, value in file_info.items() if key != 'dateobs'}
+                               for file_info in calibration_frames_info]
+    logger.info(f'Stacking in {len(bands)} bands', extra_tags={'instrument': instrument.camera,
+                                                               'frame_type': frame_type})
+    band_tasks = group(stack_calibration_band.s(calibration_frames_info, start, stop, vars(runtime_context))
+                       .set(queue=runtime_context.CELERY_TASK_QUEUE_NAME) for start, stop in bands)
+    chord(band_tasks)(combine_calibration_bands.s(bands, vars(runtime_context))
+                      .set(queue=runtime_context.CELERY_TASK_QUEUE_NAME))
+
+
+@app.task(name='celery.stack_calibration_band', reject_on_worker_lost=True)
+def stack_calibration_band(calibration_frames_info: list, start: int, stop: int, runtime_context: dict):
+    runtime_context = Context(runtime_context)
+    add_telemetry_span_attribute("band_start", start)
+    add_telemetry_span_attribute("band_stop", stop)
+    try:
+        return calibrations.stack_master_band(calibration_frames_info, start, stop, runtime_context)
+    except Exception:
+        logger.error("Exception stacking band of master frames: {error}".format(error=logs.format_exception()),
+                     extra_tags={'start': start, 'stop': stop})
+        return []
+
+
+@app.task(name='celery.combine_calibration_bands', reject_on_worker_lost=True)
+def combine_calibration_bands(master_filenames: list, bands: list, runtime_context: dict):
+    runtime_context = Context(runtime_context)
+    try:
+        calibrations.combine_master_bands(master_filenames, bands, runtime_context)
+    except Exception:
+        logger.error("Exception combining bands of master frames: {error}".format(error=logs.format_exception()))
+
+
 @app.task(name='celery.process_image', bind=True, reject_on_worker_lost=True, max_retries=5)
 def process_image(self, file_info: dict, runtime_context: dict):
     """
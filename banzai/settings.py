@@ -150,6 +150,11 @@ MASTER_CALIBRATION_EXTENSION_ORDER = {'BIAS': ['SCI', 'BPM', 'ERR'],
                                       'DARK': ['SCI', 'BPM', 'ERR'],
                                       'SKYFLAT': ['SCI', 'BPM', 'ERR']}
 
+# Data type that integer raw pixels are converted to for processing. float32 halves the memory used by every stage.
+# Statistics, stacking and photometry accumulate in double precision either way, and the reduced data is always
+# written as REDUCED_DATA_EXTENSION_TYPES.
+PROCESSING_DTYPE = os.getenv('PROCESSING_DTYPE', 'float64')
+
 REDUCED_DATA_EXTENSION_TYPES = {'SCI': 'float32',
                                 'ERR': 'float32',
                                 'BPM': 'uint8'}
@@ -163,6 +168,58 @@ LARGE_WORKER_THRESHOLD = 5000 * 5000
 
 LARGE_WORKER_QUEUE = os.getenv('CELERY_LARGE_TASK_QUEUE_NAME', 'celery_large')
 
+# Memory budget (in bytes) for the master calibration frames each worker process keeps open between frames.
+# Set to 0 to disable the cache.
+CALIBRATION_CACHE_MAX_BYTES = int(os.getenv('CALIBRATION_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Directory (ideally on tmpfs, e.g. /dev/shm/banzai) where decompressed masters are shared between all of the
+# worker processes on a node. Leave unset to disable the shared calibration store.
+CALIBRATION_STORE_DIRECTORY = os.getenv('CALIBRATION_STORE_DIRECTORY')
+CALIBRATION_STORE_MAX_BYTES = int(os.getenv('CALIBRATION_STORE_MAX_BYTES', 8 * 1024 ** 3))
+
+# Directory where the download worker writes calibration bundles: all of the cached masters for an instrument
+# configuration in one memory-mappable file. Leave unset to resolve every master from the database.
+CALIBRATION_BUNDLE_DIRECTORY = os.getenv('CALIBRATION_BUNDLE_DIRECTORY')
+# Bundles that have not been refreshed by the download worker in this many seconds are ignored
+CALIBRATION_BUNDLE_MAX_AGE = int(os.getenv('CALIBRATION_BUNDLE_MAX_AGE', 600))
+
+# Directory (ideally tmpfs or local NVMe) for the scratch files that large pixel arrays are memory mapped from while
+# frames are reduced. Leave unset to use the system temporary directory.
+SCRATCH_DIRECTORY = os.getenv('SCRATCH_DIRECTORY')
+# Quota (in bytes) for the scratch files of each worker process. Arrays that do not fit are kept in memory.
+SCRATCH_MAX_BYTES = int(os.getenv('SCRATCH_MAX_BYTES', 16 * 1024 ** 3))
+# Arrays smaller than this (in bytes) are always kept in memory rather than spilled to a scratch file
+SCRATCH_MIN_BYTES = int(os.getenv('SCRATCH_MIN_BYTES', 4 * 1024 ** 2))
+
+# Threads used by run_pipeline_stages to open and write frames, so that downloads and decompression of many frames
+# overlap. Set to 1 to open and write frames serially.
+PIPELINE_THREADS = int(os.getenv('PIPELINE_THREADS', 8))
+
+# Threads used to run stages that process each frame on its own on several frames at once. Stages run serially by
+# default: only raise this for stage lists that are safe to run on threads. The cores are then shared between the
+# threads by the parallel median and stacking functions (see median_utils.set_num_threads).
+STAGE_THREADS = int(os.getenv('STAGE_THREADS', 1))
+
+# Processes used to run independent groups of frames at once, e.g. to stack the flats for each filter at the same
+# time. Each process gets a copy of the frames in its group. Set to 0 to run the groups one after another.
+STAGE_GROUP_PROCESSES = int(os.getenv('STAGE_GROUP_PROCESSES', 0))
+
+# Memory budget (in bytes) for stacking master calibrations. Frames are stacked in bands of rows that fit in it.
+STACKING_MAX_BYTES = int(os.getenv('STACKING_MAX_BYTES', 1024 ** 3))
+
+# Directory shared by the workers where reduced individual calibration frames are kept, uncompressed and memory
+# mappable, until they are stacked (see banzai.cache.accumulator). Leave unset to re-open the frames when stacking.
+CALIBRATION_ACCUMULATOR_DIRECTORY = os.getenv('CALIBRATION_ACCUMULATOR_DIRECTORY')
+# Accumulated frames are removed after this many seconds
+CALIBRATION_ACCUMULATOR_MAX_AGE = int(os.getenv('CALIBRATION_ACCUMULATOR_MAX_AGE', 2 * 86400))
+# Stack each master across this many tasks, one band of rows each, instead of in a single task on a large worker.
+# Needs the calibration accumulator: only frames in it can be read a band at a time. Set to 0 to disable.
+STACKING_BAND_TASKS = int(os.getenv('STACKING_BAND_TASKS', 0))
+
+# Number of pixels sampled to estimate QC and header statistics of large arrays (see stats.sampled_median).
+# Set to 0 to always compute them exactly.
+SAMPLED_STATISTICS_SIZE = int(os.getenv('SAMPLED_STATISTICS_SIZE', 100000))
+
 REFERENCE_CATALOG_URL = os.getenv('REFERENCE_CATALOG_URL', 'http://phot-catalog.lco.gtn/')
 
 REQUEUE_OBSTYPES = ['EXPOSE', 'STANDARD']
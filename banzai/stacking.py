@@ -0,0 +1,86 @@
+"""Stack frames one band of rows at a time.
+
+Stacking whole frames needs a data cube, an uncertainty cube and a mask cube the size of every input frame in
+memory, on top of the pages of the frames themselves. Instead we split the frames into bands of
+rows, sized so that stacking one band fits in a memory budget, and fill the output frame band by band. The bands
+are views of the input arrays (which are memory mapped when the frames are opened), so only the pages holding
+the current band need to be in memory.
+"""
+from banzai.data import stack
+from banzai.utils.image_utils import Section
+
+# banzai.data.stack holds about this many times the size of its inputs in memory at once (the pages of the
+# inputs and the cubes it copies them into)
+STACK_MEMORY_OVERHEAD = 2
+
+
+def get_stack_bytes_per_row(data_to_stack):
+    """Approximate memory needed to stack one row of every frame in data_to_stack"""
+    n_bytes = 0
+    for data in data_to_stack:
+        # The variance has the same data type as the data, even before it has been expanded to an array
+        for dtype in [data.data.dtype, data.mask.dtype, data.data.dtype]:
+            n_bytes += data.shape[1] * dtype.itemsize
+    return STACK_MEMORY_OVERHEAD * n_bytes
+
+
+def plan_row_bands(n_rows, bytes_per_row, max_bytes):
+    """
+    Split the rows of a frame into bands that can each be stacked within max_bytes
+
+    Parameters
+    ----------
+    n_rows: int
+    bytes_per_row: int
+                   Memory needed to stack a single row, e.g. from get_stack_bytes_per_row
+    max_bytes: int
+               Memory budget for stacking a band. A band is always at least one row.
+
+    Returns
+    -------
+    bands: list of tuples
+           (start, stop) row indices of each band, zero indexed with stop exclusive like a slice
+    """
+    rows_per_band = int(max(1, min(n_rows, max_bytes // max(bytes_per_row, 1))))
+    return [(start, min(start + rows_per_band, n_rows)) for start in range(0, n_rows, rows_per_band)]
+
+
+def plan_band_tasks(n_rows, n_tasks):
+    """
+    Split the rows of a frame into (at most) n_tasks bands of about the same size, e.g. to stack them on
+    different workers. Returns (start, stop) row indices like plan_row_bands.
+    """
+    rows_per_band = max(1, -(-n_rows // max(1, min(n_tasks, n_rows))))
+    return [(start, min(start + rows_per_band, n_rows)) for start in range(0, n_rows, rows_per_band)]
+
+
+def read_band(data, start, stop):
+    """
+    Rows start to stop (zero indexed, stop exclusive) of a CCDData object
+
+    Unlike data[section], the arrays of the band are views of the arrays of data rather than new memory mapped
+    copies.
+    """
+    return data.trim(Section(x_start=1, x_stop=data.shape[1], y_start=start + 1, y_stop=stop), view=True)
+
+
+def stack_by_band(data_to_stack, output, nsigma_reject, max_bytes):
+    """
+    Sigma clip and stack data_to_stack into output, one band of rows at a time
+
+    Parameters
+    ----------
+    data_to_stack: list of banzai.data.CCDData
+                   Frames to stack. They must all have the same shape.
+    output: banzai.data.CCDData
+            The stacked bands are copied into this based on their detector sections
+    nsigma_reject: float
+                   Passed to banzai.data.stack
+    max_bytes: int
+               Memory budget for stacking a single band
+    """
+    n_rows = data_to_stack[0].shape[0]
+    for start, stop in plan_row_bands(n_rows, get_stack_bytes_per_row(data_to_stack), max_bytes):
+        stacked_band = stack([read_band(data, start, stop) for data in data_to_stack], nsigma_reject)
+        output.copy_in(stacked_band)
+    return output
@@ -1,4 +1,5 @@
 import abc
+import contextvars
 import itertools
 from collections.abc import Iterable
 
@@ -10,6 +11,12 @@ logger = logs.get_logger()
 
 
 class Stage(abc.ABC):
+    # Thread pool to run the stage on several images at once when each image is processed on its own. Opt in with
+    # STAGE_THREADS. Set by stage_utils.run_pipeline_stages.
+    executor = None
+    # Process pool to run independent groups of images (e.g. the flats of different filters) at once. Opt in with
+    # STAGE_GROUP_PROCESSES. Set by stage_utils.run_pipeline_stages.
+    group_executor = None
 
     def __init__(self, runtime_context):
         self.runtime_context = runtime_context
@@ -40,37 +47,67 @@ class Stage(abc.ABC):
         with create_manual_telemetry_span(self.stage_name, {"context": traced_context}):
             if not images:
                 return images
-            if self.group_by_attributes or self.process_by_group:
+            grouped = self.group_by_attributes or self.process_by_group
+            if grouped:
                 images.sort(key=self.get_grouping)
                 image_sets = [list(image_set) for _, image_set in itertools.groupby(images, self.get_grouping)]
             else:
                 # Treat each image individually
                 image_sets = images
             add_telemetry_span_attribute("image_set_length", len(image_sets))
-            processed_images = []
-            for image_set in image_sets:
-                try:
-                    if isinstance(image_set, Iterable):
-                        image = image_set[0]
-                    else:
-                        image = image_set
-                    logger.info('Running {0}'.format(self.stage_name), image=image)
-                    add_telemetry_span_event(f"stage started for image {image}")
-                    processed_image = self.do_stage(image_set)
-                    if processed_image is not None:
-                        processed_images.append(processed_image)
-                except Exception:
-                    logger.error(logs.format_exception())
-                    if isinstance(image_set, Iterable):
-                        for image in image_set:
-                            logger.error('Reduction stopped', image=image)
-                    else:
-                        logger.error('Reduction stopped', image=image)
-                    add_telemetry_span_event("reduction stopped")
+            if grouped and self.group_executor is not None and len(image_sets) > 1:
+                futures = [self.group_executor.submit(self.run_on_image_set, image_set) for image_set in image_sets]
+                results = [self.get_group_result(future, image_set) for future, image_set in zip(futures, image_sets)]
+            elif not grouped and self.executor is not None and len(image_sets) > 1:
+                # Each thread needs its own copy of the context so stage events end up in this stage's span
+                futures = [self.executor.submit(contextvars.copy_context().run, self.run_on_image_set, image_set)
+                           for image_set in image_sets]
+                results = [future.result() for future in futures]
+            else:
+                results = [self.run_on_image_set(image_set) for image_set in image_sets]
+            processed_images = [processed_image for processed_image in results if processed_image is not None]
 
             add_telemetry_span_attribute("processed_image_set_length", len(processed_images))
             return processed_images
 
+    def run_on_image_set(self, image_set):
+        try:
+            if isinstance(image_set, Iterable):
+                image = image_set[0]
+            else:
+                image = image_set
+            logger.info('Running {0}'.format(self.stage_name), image=image)
+            add_telemetry_span_event(f"stage started for image {image}")
+            return self.do_stage(image_set)
+        except Exception:
+            logger.error(logs.format_exception())
+            self.stop_reduction(image_set)
+            return None
+
+    def get_group_result(self, future, image_set):
+        try:
+            return future.result()
+        except Exception:
+            # The group could not be sent to (or back from) its process, or the process died
+            logger.error(logs.format_exception())
+            self.stop_reduction(image_set)
+            return None
+
+    def stop_reduction(self, image_set):
+        if isinstance(image_set, Iterable):
+            for image in image_set:
+                logger.error('Reduction stopped', image=image)
+        else:
+            logger.error('Reduction stopped', image=image_set)
+        add_telemetry_span_event("reduction stopped")
+
+    def __getstate__(self):
+        # Stages are sent to the processes of group_executor, but the executors themselves cannot be
+        state = self.__dict__.copy()
+        state.pop('executor', None)
+        state.pop('group_executor', None)
+        return state
+
     @abc.abstractmethod
     def do_stage(self, images) -> ObservationFrame:
         return images
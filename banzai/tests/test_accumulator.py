@@ -0,0 +1,153 @@
+import os
+import time
+
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai.cache.accumulator import CalibrationAccumulator, accumulate_calibration_frame
+from banzai import calibrations
+from banzai.utils import fits_utils, mmap_utils, stage_utils
+from banzai.tests.utils import FakeContext, FakeInstrument
+
+pytestmark = pytest.mark.accumulator
+
+
+def make_hdu_list(nx=101, ny=103):
+    primary_hdu = fits.PrimaryHDU(header=fits.Header({'OBSTYPE': 'BIAS'}))
+    data = np.random.normal(size=(ny, nx)).astype(np.float32)
+    image_hdu = fits.ImageHDU(data=data, header=fits.Header({'GAIN': 1.0}), name='SCI')
+    bpm_hdu = fits.ImageHDU(data=np.zeros((ny, nx), dtype=np.uint8), name='BPM')
+    return fits.HDUList([primary_hdu, image_hdu, bpm_hdu])
+
+
+def make_image(hdu_list, filename='bias-91.fits.fz', obstype='BIAS', is_bad=False):
+    image = mock.MagicMock(obstype=obstype, is_master=False, is_bad=is_bad, frame_id=1234)
+    image.get_output_filename.return_value = filename
+    image.to_fits.return_value = hdu_list
+    return image
+
+
+def make_context(directory, **kwargs):
+    context = FakeContext()
+    context.CALIBRATION_ACCUMULATOR_DIRECTORY = directory
+    for key, value in kwargs.items():
+        setattr(context, key, value)
+    return context
+
+
+def test_accumulated_frames_are_mapped_copy_on_write(tmpdir):
+    context = make_context(str(tmpdir))
+    hdu_list = make_hdu_list()
+    image = make_image(hdu_list)
+    accumulate_calibration_frame(image, context)
+    image.to_fits.assert_called_with(context, compress=False)
+
+    accumulator = CalibrationAccumulator(str(tmpdir), context.CALIBRATION_ACCUMULATOR_MAX_AGE)
+    file_info = accumulator.localize({'filename': 'bias-91.fits.fz', 'frameid': 1234})
+    assert file_info['copy_on_write']
+    assert mmap_utils.is_mapped_file(file_info['path'])
+
+    mapped_hdu_list, filename, frame_id = fits_utils.open_fits_file(file_info, context)
+    assert filename == 'bias-91.fits.fz'
+    assert frame_id == 1234
+    np.testing.assert_array_equal(mapped_hdu_list['SCI'].data, hdu_list['SCI'].data)
+    # Stacking stages can modify the frames without touching the accumulated copy
+    mapped_hdu_list['SCI'].data[:] = 0.0
+    reread_hdu_list, _, _ = fits_utils.open_fits_file(file_info, context)
+    np.testing.assert_array_equal(reread_hdu_list['SCI'].data, hdu_list['SCI'].data)
+
+
+def test_frames_not_in_the_accumulator_are_unchanged(tmpdir):
+    accumulator = CalibrationAccumulator(str(tmpdir), 3600)
+    file_info = {'filename': 'bias-91.fits.fz', 'frameid': 1234, 'path': None}
+    assert accumulator.localize(file_info) == file_info
+
+
+def test_only_frames_that_get_stacked_are_accumulated(tmpdir):
+    accumulate_calibration_frame(make_image(make_hdu_list(), filename='bias.fits.fz'), make_context(None))
+    accumulate_calibration_frame(make_image(make_hdu_list(), filename='expose.fits.fz', obstype='EXPOSE'),
+                                 make_context(str(tmpdir)))
+    accumulate_calibration_frame(make_image(make_hdu_list(), filename='bad.fits.fz', is_bad=True),
+                                 make_context(str(tmpdir)))
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_old_frames_are_removed(tmpdir):
+    accumulator = CalibrationAccumulator(str(tmpdir), 3600)
+    old_path = accumulator.get_path('old.fits.fz')
+    mmap_utils.write_mapped_file(old_path, make_hdu_list(), 'old.fits.fz')
+    os.utime(old_path, (time.time() - 7200, time.time() - 7200))
+    accumulator.add(make_image(make_hdu_list(), filename='new.fits.fz'), make_context(str(tmpdir)))
+    assert not os.path.exists(old_path)
+    assert os.path.exists(accumulator.get_path('new.fits.fz'))
+
+
+@mock.patch('banzai.calibrations.stage_utils.run_pipeline_stages')
+@mock.patch('banzai.calibrations.dbs.get_individual_cal_frames')
+def test_master_is_stacked_from_accumulated_frames(mock_get_frames, mock_run_stages, tmpdir):
+    context = make_context(str(tmpdir))
+    accumulate_calibration_frame(make_image(make_hdu_list(), filename='bias1-91.fits.fz'), context)
+    mock_get_frames.return_value = [{'filename': 'bias1-91.fits.fz', 'frameid': 1, 'path': None},
+                                    {'filename': 'bias2-91.fits.fz', 'frameid': 2, 'path': None}]
+    instrument = mock.MagicMock(type='1m0-SciCam-Sinistro', site='cpt', camera='fa14')
+    calibrations.make_master_calibrations(instrument, 'BIAS', '2026-10-16T12:00:00', '2026-10-17T12:00:00', context)
+    frames_to_stack = mock_run_stages.call_args[0][0]
+    assert frames_to_stack[0]['path'] == os.path.join(str(tmpdir), 'bias1-91.fits.fz' + mmap_utils.MAPPED_FILE_SUFFIX)
+    assert frames_to_stack[1] == {'filename': 'bias2-91.fits.fz', 'frameid': 2, 'path': None}
+
+
+def make_reduced_bias(filename, nx=53, ny=47):
+    header = fits.Header({'OBSTYPE': 'BIAS', 'SITEID': 'cpt', 'INSTRUME': 'fa14', 'TELESCOP': '1m0-03',
+                          'DATASEC': f'[1:{nx},1:{ny}]', 'DETSEC': f'[1:{nx},1:{ny}]', 'CCDSUM': '1 1',
+                          'GAIN': 1.0, 'RDNOISE': 3.0, 'SATURATE': 65535.0, 'MAXLIN': 65535.0, 'BIASLVL': 100.0,
+                          'EXPTIME': 0.0, 'DAY-OBS': '20261016', 'DATE-OBS': '2026-10-16T20:00:00.000',
+                          'EXTNAME': 'SCI'})
+    data = np.random.normal(size=(ny, nx)).astype(np.float32)
+    hdu_list = fits.HDUList([fits.PrimaryHDU(data=data, header=header),
+                             fits.ImageHDU(data=(np.random.uniform(size=(ny, nx)) > 0.95).astype(np.uint8),
+                                           name='BPM'),
+                             fits.ImageHDU(data=np.ones((ny, nx), dtype=np.float32), name='ERR')])
+    return hdu_list
+
+
+@mock.patch('banzai.lco.image_utils.image_can_be_processed', return_value=True)
+@mock.patch('banzai.lco.dbs.query_for_instrument')
+def test_master_stacked_in_bands_matches_master_stacked_whole(mock_instrument, mock_can_process, tmpdir):
+    mock_instrument.return_value = FakeInstrument(site='cpt', camera='fa14', telescope='1m0-03',
+                                                  type='1m0-SciCam-Sinistro')
+    context = make_context(str(tmpdir), STACKING_BAND_TASKS=3)
+    accumulator = CalibrationAccumulator(str(tmpdir), context.CALIBRATION_ACCUMULATOR_MAX_AGE)
+    np.random.seed(1235)
+    calibration_frames_info = []
+    for i in range(7):
+        filename = f'cpt1m003-fa14-20261016-00{i:02d}-b91.fits.fz'
+        mmap_utils.write_mapped_file(accumulator.get_path(filename), make_reduced_bias(filename), filename, i)
+        calibration_frames_info.append(accumulator.localize({'filename': filename, 'frameid': i, 'path': None}))
+
+    written_masters = []
+    with mock.patch('banzai.lco.LCOCalibrationFrame.write', autospec=True,
+                    side_effect=lambda master, runtime_context: written_masters.append(master)):
+        stage_utils.run_pipeline_stages(calibration_frames_info, context, calibration_maker=True)
+        bands = calibrations.plan_master_bands(calibration_frames_info, context)
+        assert bands == [(0, 16), (16, 32), (32, 47)]
+        master_filenames = [calibrations.stack_master_band(calibration_frames_info, start, stop, context)
+                            for start, stop in bands]
+        calibrations.combine_master_bands(master_filenames, bands, context)
+
+    whole_master, band_master = written_masters
+    assert band_master.filename == whole_master.filename
+    assert band_master.meta['DETSEC'] == whole_master.meta['DETSEC']
+    assert band_master.meta['DATASEC'] == whole_master.meta['DATASEC']
+    np.testing.assert_allclose(band_master.data, whole_master.data, rtol=1e-6)
+    np.testing.assert_allclose(band_master.uncertainty, whole_master.uncertainty, rtol=1e-6)
+    np.testing.assert_array_equal(band_master.mask, whole_master.mask)
+    # Only the accumulated frames are left behind
+    assert len(os.listdir(str(tmpdir))) == 7
+
+
+def test_masters_are_stacked_whole_unless_every_frame_is_accumulated(tmpdir):
+    context = make_context(str(tmpdir), STACKING_BAND_TASKS=3)
+    assert calibrations.plan_master_bands([{'filename': 'bias.fits.fz', 'path': '/archive/bias.fits.fz'}],
+                                          context) is None
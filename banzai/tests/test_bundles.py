@@ -0,0 +1,133 @@
+import os
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai.cache import bundles
+from banzai.tests.utils import FakeContext
+from banzai.utils import fits_utils
+
+pytestmark = pytest.mark.bundles
+
+
+def make_cal(filename, cal_type='BIAS', dateobs=datetime(2024, 1, 10), instrument_id=1, **attributes):
+    attributes = {'configuration_mode': 'default', 'binning': '[1, 1]', **attributes}
+    return SimpleNamespace(filename=filename, frameid=hash(filename) % 1000, type=cal_type, attributes=attributes,
+                           dateobs=dateobs, datecreated=dateobs + timedelta(hours=12),
+                           good_after=datetime(1000, 1, 1), good_until=datetime(3000, 1, 1),
+                           instrument_id=instrument_id)
+
+
+def make_image(dateobs=datetime(2024, 1, 15), **kwargs):
+    defaults = {'configuration_mode': 'default', 'binning': [1, 1], 'filter': 'rp', 'ccd_temperature': -100,
+                'instrument': SimpleNamespace(id=1), 'dateobs': dateobs, 'block_start': dateobs}
+    return SimpleNamespace(**{**defaults, **kwargs})
+
+
+def make_hdu_list(value):
+    return fits.HDUList([fits.PrimaryHDU(header=fits.Header({'ISMASTER': True})),
+                         fits.ImageHDU(data=value * np.ones((10, 10), dtype=np.float32), name='SCI')])
+
+
+def members(*cals):
+    return [bundles._member_metadata(cal) for cal in cals]
+
+
+def test_closest_master_is_selected():
+    cals = members(make_cal('old.fits', dateobs=datetime(2024, 1, 10)),
+                   make_cal('new.fits', dateobs=datetime(2024, 1, 14)))
+    assert bundles.select_bundle_member(cals, make_image(), 'bias', ['configuration_mode', 'binning']) == 1
+
+
+def test_master_must_match_criteria():
+    cals = members(make_cal('flat-rp.fits', cal_type='SKYFLAT', filter='rp'),
+                   make_cal('flat-V.fits', cal_type='SKYFLAT', filter='V', dateobs=datetime(2024, 1, 14)))
+    assert bundles.select_bundle_member(cals, make_image(), 'skyflat',
+                                        ['configuration_mode', 'binning', 'filter']) == 0
+    assert bundles.select_bundle_member(cals, make_image(), 'bias', ['configuration_mode', 'binning']) is None
+
+
+def test_no_master_selected_for_images_older_than_the_bundle():
+    # There could be a closer master in the database that is not in the bundle
+    cals = members(make_cal('bias.fits', dateobs=datetime(2024, 1, 10)))
+    assert bundles.select_bundle_member(cals, make_image(dateobs=datetime(2024, 1, 1)), 'bias',
+                                        ['configuration_mode', 'binning']) is None
+
+
+def test_no_master_selected_if_closer_master_could_be_missing():
+    cals = members(make_cal('old.fits', dateobs=datetime(2024, 1, 10)),
+                   make_cal('new.fits', dateobs=datetime(2024, 1, 14)))
+    cals[1]['good_until'] = datetime(2024, 1, 14, 12).isoformat()
+    # Only old.fits is valid, but a master from e.g. 2024-01-09 that is not in the bundle would be just as close
+    assert bundles.select_bundle_member(cals, make_image(), 'bias', ['configuration_mode', 'binning']) == 0
+    assert bundles.select_bundle_member(cals[1:], make_image(), 'bias', ['configuration_mode', 'binning']) is None
+
+
+@pytest.mark.parametrize('date_field', ['good_after', 'good_until'])
+def test_master_without_validity_dates_is_not_selected(date_field):
+    # The database query never selects a master with a NULL validity date, so the bundle must not either
+    cals = members(make_cal('old.fits', dateobs=datetime(2024, 1, 10)),
+                   make_cal('new.fits', dateobs=datetime(2024, 1, 14)))
+    cals[1][date_field] = None
+    assert bundles.select_bundle_member(cals, make_image(), 'bias', ['configuration_mode', 'binning']) == 0
+
+
+def test_only_older_calibrations():
+    cals = members(make_cal('old.fits', dateobs=datetime(2024, 1, 10)),
+                   make_cal('new.fits', dateobs=datetime(2024, 1, 14)))
+    image = make_image(block_start=datetime(2024, 1, 14, 6))
+    assert bundles.select_bundle_member(cals, image, 'bias', ['configuration_mode', 'binning'],
+                                        use_only_older_calibrations=True) == 0
+
+
+def test_bundle_round_trip(tmpdir):
+    directory = str(tmpdir.join('bundles'))
+    cals = [make_cal('bias1.fits', dateobs=datetime(2024, 1, 10)),
+            make_cal('dark2.fits', cal_type='DARK', dateobs=datetime(2024, 1, 14), ccd_temperature='-100')]
+    cached_masters = [(cal, str(tmpdir.join(cal.filename))) for cal in cals]
+    for _, local_path in cached_masters:
+        open(local_path, 'w').close()
+    context = FakeContext(CALIBRATION_BUNDLE_DIRECTORY=directory)
+    with mock.patch('banzai.utils.fits_utils.open_fits_file') as mock_open:
+        mock_open.side_effect = lambda file_info, context: (make_hdu_list(float(file_info['path'][-6])), None, None)
+        bundles.update_bundles(directory, cached_masters, context)
+    assert bundles.bundles_are_current(directory, 60)
+
+    file_info = bundles.get_bundle_file_info(make_image(), 'dark', ['configuration_mode', 'binning',
+                                                                    'ccd_temperature'], context)
+    assert file_info['filename'] == 'dark2.fits'
+    hdu_list, filename, frame_id = fits_utils.open_fits_file(file_info, context)
+    assert filename == 'dark2.fits'
+    assert frame_id == cals[1].frameid
+    np.testing.assert_array_equal(hdu_list['SCI'].data, 2.0)
+
+    # The bundle is only rewritten when the masters change
+    modification_time = os.path.getmtime(file_info['path'])
+    with mock.patch('banzai.utils.fits_utils.open_fits_file') as mock_open:
+        bundles.update_bundles(directory, cached_masters, context)
+    assert not mock_open.called
+    assert os.path.getmtime(file_info['path']) == modification_time
+
+
+@mock.patch('banzai.cache.bundles.fits_utils.open_fits_file')
+def test_bundles_are_not_current_when_masters_are_missing(mock_open, tmpdir):
+    mock_open.return_value = make_hdu_list(1.0), None, None
+    directory = str(tmpdir.join('bundles'))
+    cal = make_cal('bias1.fits')
+    bundles.update_bundles(directory, [(cal, str(tmpdir.join(cal.filename)))], FakeContext())
+    assert not bundles.bundles_are_current(directory, 60)
+
+
+def test_stale_bundles_are_ignored(tmpdir):
+    directory = str(tmpdir)
+    tmpdir.join(bundles.HEARTBEAT_FILENAME).write('')
+    old_time = time.time() - 120
+    os.utime(os.path.join(directory, bundles.HEARTBEAT_FILENAME), (old_time, old_time))
+    assert not bundles.bundles_are_current(directory, 60)
+    context = FakeContext(CALIBRATION_BUNDLE_DIRECTORY=directory, CALIBRATION_BUNDLE_MAX_AGE=60)
+    assert bundles.get_bundle_file_info(make_image(), 'bias', ['configuration_mode', 'binning'], context) is None
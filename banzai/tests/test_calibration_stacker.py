@@ -18,7 +18,8 @@ context = {'CALIBRATION_MIN_FRAMES': {'TEST': 1},
            'TELESCOPE_FILENAME_FUNCTION': 'banzai.utils.file_utils.telescope_to_filename',
            'MASTER_CALIBRATION_EXTENSION_ORDER': {'BIAS': ['SCI', 'BPM', 'ERR'],
                                                   'DARK': ['SCI', 'BPM', 'ERR'],
-                                                  'SKYFLAT': ['SCI', 'BPM', 'ERR']}}
+                                                  'SKYFLAT': ['SCI', 'BPM', 'ERR']},
+           'STACKING_MAX_BYTES': 1024 ** 3}
 context = Context(context)
 instrument = Instrument(site='cpt', camera='fa11', name='fa11')
 
@@ -0,0 +1,94 @@
+import os
+
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai.cache.calibration_store import CalibrationStore
+from banzai.utils import mmap_utils, fits_utils
+from banzai.tests.utils import FakeContext
+
+pytestmark = pytest.mark.calibration_store
+
+
+def make_hdu_list(nx=101, ny=103):
+    primary_hdu = fits.PrimaryHDU(header=fits.Header({'OBSTYPE': 'BIAS', 'ISMASTER': True}))
+    data = np.random.normal(size=(ny, nx)).astype(np.float32)
+    image_hdu = fits.ImageHDU(data=data, header=fits.Header({'GAIN': 1.0}), name='SCI')
+    bpm_hdu = fits.ImageHDU(data=np.zeros((ny, nx), dtype=np.uint8), name='BPM')
+    table_hdu = fits.BinTableHDU.from_columns([fits.Column('flux', 'E', array=np.arange(3.0))], name='CAT')
+    return fits.HDUList([primary_hdu, image_hdu, bpm_hdu, table_hdu])
+
+
+def test_mapped_file_round_trip(tmpdir):
+    hdu_list = make_hdu_list()
+    path = str(tmpdir.join('test.mmap'))
+    mmap_utils.write_mapped_file(path, hdu_list, 'test.fits.fz', 1234)
+    assert mmap_utils.is_mapped_file(path)
+    mapped_hdu_list, filename, frame_id = mmap_utils.read_mapped_file(path)
+    assert filename == 'test.fits.fz'
+    assert frame_id == 1234
+    assert mapped_hdu_list[0].header['OBSTYPE'] == 'BIAS'
+    np.testing.assert_array_equal(mapped_hdu_list['SCI'].data, hdu_list['SCI'].data)
+    assert mapped_hdu_list['BPM'].data.dtype == np.uint8
+    np.testing.assert_array_equal(mapped_hdu_list['CAT'].data['flux'], hdu_list['CAT'].data['flux'])
+
+
+def test_mapped_arrays_are_page_aligned_and_read_only(tmpdir):
+    path = str(tmpdir.join('test.mmap'))
+    mmap_utils.write_mapped_file(path, make_hdu_list(), 'test.fits.fz')
+    mapped_hdu_list, _, _ = mmap_utils.read_mapped_file(path)
+    assert mapped_hdu_list['SCI'].data.offset % mmap_utils.PAGE_SIZE == 0
+    with pytest.raises(ValueError):
+        mapped_hdu_list['SCI'].data[0, 0] = 1.0
+
+
+def test_fits_files_are_not_mapped_files(tmpdir):
+    path = str(tmpdir.join('test.fits'))
+    make_hdu_list().writeto(path)
+    assert not mmap_utils.is_mapped_file(path)
+
+
+def test_open_fits_file_maps_mapped_files(tmpdir):
+    path = str(tmpdir.join('test.mmap'))
+    mmap_utils.write_mapped_file(path, make_hdu_list(), 'test.fits.fz', 1234)
+    hdu_list, filename, frame_id = fits_utils.open_fits_file({'path': path}, FakeContext())
+    assert filename == 'test.fits.fz'
+    assert frame_id == 1234
+    assert not hdu_list['SCI'].data.flags.writeable
+
+
+@mock.patch('banzai.cache.calibration_store.fits_utils.open_fits_file')
+def test_master_is_only_decompressed_once(mock_open, tmpdir):
+    mock_open.return_value = make_hdu_list(), 'test.fits.fz', None
+    store = CalibrationStore(str(tmpdir.join('store')), max_bytes=10 * 1024 ** 2)
+    file_info = {'filename': 'test.fits.fz', 'frameid': 1234}
+    localized_file_info = store.localize(file_info, FakeContext())
+    assert mmap_utils.is_mapped_file(localized_file_info['path'])
+    assert store.localize(file_info, FakeContext()) == localized_file_info
+    assert mock_open.call_count == 1
+    _, _, frame_id = mmap_utils.read_mapped_file(localized_file_info['path'])
+    assert frame_id == 1234
+
+
+@mock.patch('banzai.cache.calibration_store.fits_utils.open_fits_file')
+def test_files_without_a_key_are_not_stored(mock_open, tmpdir):
+    store = CalibrationStore(str(tmpdir.join('store')), max_bytes=10 * 1024 ** 2)
+    assert store.localize({'filename': 'test.fits.fz'}, FakeContext()) == {'filename': 'test.fits.fz'}
+    assert not mock_open.called
+
+
+@mock.patch('banzai.cache.calibration_store.fits_utils.open_fits_file')
+def test_least_recently_used_master_is_evicted(mock_open, tmpdir):
+    mock_open.side_effect = lambda *args, **kwargs: (make_hdu_list(), 'test.fits.fz', None)
+    file_size = mmap_utils.get_mapped_file_size(make_hdu_list())
+    store = CalibrationStore(str(tmpdir.join('store')), max_bytes=2 * file_size)
+    paths = [store.localize({'filename': 'test.fits.fz', 'frameid': frameid}, FakeContext())['path']
+             for frameid in [1, 2]]
+    # Make sure the first file is more recently used than the second
+    os.utime(paths[1], (0, 0))
+    store.localize({'filename': 'test.fits.fz', 'frameid': 3}, FakeContext())
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert sum(size for _, _, size in store.get_stored_files()) <= store.max_bytes
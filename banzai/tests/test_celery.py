@@ -7,7 +7,7 @@ from unittest.mock import ANY
 from astropy.io.fits import Header
 from celery.exceptions import Retry
 
-from banzai.scheduling import stack_calibrations, schedule_calibration_stacking
+from banzai.scheduling import stack_calibrations, schedule_calibration_stacking, app
 from banzai.settings import CALIBRATION_STACK_DELAYS
 from banzai.utils import date_utils
 from banzai.context import Context
@@ -183,7 +183,9 @@ class TestMain():
                                 'CALIBRATION_STACKER_STAGES': {'BIAS': ['banzai.bias.BiasMaker']},
                                 'CELERY_TASK_QUEUE_NAME': 'test',
                                 'LARGE_WORKER_QUEUE': 'test_large',
-                                'LARGE_WORKER_THRESHOLD': 5000*5000})
+                                'LARGE_WORKER_THRESHOLD': 5000*5000,
+                                'STACKING_BAND_TASKS': 0,
+                                'CALIBRATION_ACCUMULATOR_DIRECTORY': None})
         self.frame_type = 'BIAS'
         self.fake_blocks_response_json = fake_blocks_response_json
         self.fake_inst = FakeInstrument(site='coj', camera='2m0-SciCam-Spectral', enclosure='clma', telescope='2m0a')
@@ -251,3 +253,70 @@ class TestMain():
             stack_calibrations(self.min_date, self.max_date, 1, self.frame_type, self.context,
                                [self.fake_blocks_response_json['results'][0]])
         assert e.type is Retry
+
+
+    @mock.patch('banzai.scheduling.stack_calibrations.apply_async')
+    @mock.patch('banzai.scheduling.dbs.get_instruments_at_site')
+    @mock.patch('banzai.scheduling.get_calibration_blocks_for_time_range')
+    @mock.patch('banzai.scheduling.filter_calibration_blocks_for_type')
+    def test_large_instruments_stacked_by_band_use_normal_queue(self, mock_filter_blocks, mock_get_blocks,
+                                                                mock_get_instruments, mock_stack_calibrations, setup):
+        self.fake_inst.nx, self.fake_inst.ny = 9216, 9232
+        mock_get_instruments.return_value = [self.fake_inst]
+        mock_get_blocks.return_value = self.fake_blocks_response_json
+        mock_filter_blocks.return_value = [block for block in self.fake_blocks_response_json['results']]
+        schedule_calibration_stacking(self.site, self.context, self.min_date, self.max_date)
+        assert mock_stack_calibrations.call_args[1]['queue'] == self.context.LARGE_WORKER_QUEUE
+
+        context = Context({**vars(self.context), 'STACKING_BAND_TASKS': 4,
+                           'CALIBRATION_ACCUMULATOR_DIRECTORY': '/tmp/accumulator'})
+        schedule_calibration_stacking(self.site, context, self.min_date, self.max_date)
+        assert mock_stack_calibrations.call_args[1]['queue'] == context.CELERY_TASK_QUEUE_NAME
+
+    @mock.patch('banzai.calibrations.combine_master_bands')
+    @mock.patch('banzai.calibrations.stack_master_band')
+    @mock.patch('banzai.calibrations.plan_master_bands')
+    @mock.patch('banzai.calibrations.get_calibration_frames_to_stack')
+    @mock.patch('banzai.calibrations.make_master_calibrations')
+    @mock.patch('banzai.scheduling.dbs.get_individual_cal_frames')
+    @mock.patch('banzai.scheduling.dbs.get_instrument_by_id')
+    def test_stack_calibrations_by_band(self, mock_get_instrument, mock_get_calibration_images, mock_make_master_cals,
+                                        mock_get_frames, mock_plan_bands, mock_stack_band, mock_combine_bands, setup):
+        mock_get_instrument.return_value = self.fake_inst
+        mock_get_calibration_images.return_value = [{'filename': 'bias.fits'}] * 2
+        frames = [{'filename': f'bias{i}.fits', 'path': f'/tmp/accumulator/bias{i}.fits.mmap', 'copy_on_write': True,
+                   'dateobs': datetime(2019, 2, 19, 21)} for i in range(2)]
+        mock_get_frames.return_value = frames
+        mock_plan_bands.return_value = [(0, 50), (50, 100), (100, 105)]
+        mock_stack_band.side_effect = lambda frames_info, start, stop, context: ['bias-master.fits']
+        context = Context({**vars(self.context), 'STACKING_BAND_TASKS': 3,
+                           'CALIBRATION_ACCUMULATOR_DIRECTORY': '/tmp/accumulator'})
+        app.conf.task_always_eager = True
+        try:
+            stack_calibrations(self.min_date, self.max_date, 1, self.frame_type, context,
+                               [self.fake_blocks_response_json['results'][0]])
+        finally:
+            app.conf.task_always_eager = False
+        mock_make_master_cals.assert_not_called()
+        assert [call[0][1:3] for call in mock_stack_band.call_args_list] == [(0, 50), (50, 100), (100, 105)]
+        # Task arguments have to be json serializable
+        assert all('dateobs' not in frame_info for frame_info in mock_stack_band.call_args[0][0])
+        mock_combine_bands.assert_called_once()
+        assert mock_combine_bands.call_args[0][0] == [['bias-master.fits']] * 3
+
+    @mock.patch('banzai.calibrations.plan_master_bands')
+    @mock.patch('banzai.calibrations.get_calibration_frames_to_stack')
+    @mock.patch('banzai.calibrations.make_master_calibrations')
+    @mock.patch('banzai.scheduling.dbs.get_individual_cal_frames')
+    @mock.patch('banzai.scheduling.dbs.get_instrument_by_id')
+    def test_stack_calibrations_falls_back_to_single_task(self, mock_get_instrument, mock_get_calibration_images,
+                                                          mock_make_master_cals, mock_get_frames, mock_plan_bands,
+                                                          setup):
+        mock_get_instrument.return_value = self.fake_inst
+        mock_get_calibration_images.return_value = [{'filename': 'bias.fits'}] * 2
+        mock_plan_bands.return_value = None
+        context = Context({**vars(self.context), 'STACKING_BAND_TASKS': 3,
+                           'CALIBRATION_ACCUMULATOR_DIRECTORY': '/tmp/accumulator'})
+        stack_calibrations(self.min_date, self.max_date, 1, self.frame_type, context,
+                           [self.fake_blocks_response_json['results'][0]])
+        mock_make_master_cals.assert_called_with(self.fake_inst, self.frame_type, self.min_date, self.max_date, ANY)
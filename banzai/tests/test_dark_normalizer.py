@@ -40,7 +40,7 @@ def test_dark_normalization_is_reasonable(set_random_seed):
     image = normalizer.do_stage(image)
 
     np.testing.assert_allclose(image.data, data / image.exptime, 1e-5)
-    np.testing.assert_allclose(image.primary_hdu.uncertainty, uncertainty / image.exptime, 1e-5)
+    np.testing.assert_allclose(image.primary_hdu.uncertainty, np.abs(uncertainty) / image.exptime, 1e-5)
     assert image.meta['SATURATE'] == saturation_level / image.exptime
     assert image.meta['MAXLIN'] == saturation_level / image.exptime
     assert image.meta['GAIN'] == gain * image.exptime
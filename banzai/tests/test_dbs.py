@@ -1,4 +1,6 @@
 import os
+import datetime
+from types import SimpleNamespace
 
 import mock
 import pytest
@@ -6,6 +8,7 @@ import argparse
 
 import banzai.main
 from banzai import dbs
+from sqlalchemy.pool import NullPool, QueuePool
 from banzai.tests.utils import FakeResponse
 from astropy.utils.data import get_pkg_data_filename
 
@@ -56,3 +59,204 @@ def test_add_or_update():
         # Clean up for other methods
         db_session.delete(instrument)
         db_session.commit()
+
+
+def test_engines_are_reused():
+    assert dbs.get_engine('sqlite:///test.db') is dbs.get_engine('sqlite:///test.db')
+
+
+def test_engines_are_pooled_for_postgres():
+    engine = dbs.get_engine('postgresql+psycopg://banzai@localhost:5432/banzai')
+    assert isinstance(engine.pool, QueuePool)
+
+
+def test_engines_are_not_pooled_for_sqlite():
+    assert isinstance(dbs.get_engine('sqlite:///test.db').pool, NullPool)
+
+
+def test_engines_are_rebuilt_after_fork():
+    engine = dbs.get_engine('postgresql+psycopg://banzai@localhost:5432/banzai')
+    with mock.patch('banzai.dbs.os.getpid', return_value=os.getpid() + 1):
+        assert dbs.get_engine('postgresql+psycopg://banzai@localhost:5432/banzai') is not engine
+
+
+def test_reset_engines():
+    engine = dbs.get_engine('sqlite:///test.db')
+    dbs.reset_engines()
+    assert dbs.get_engine('sqlite:///test.db') is not engine
+
+
+def test_claim_new_frame():
+    processed_image = dbs.claim_frame('/archive/claim-new.fits', 'a' * 32, 1234, db_address='sqlite:///test.db')
+    assert processed_image.tries == 0
+    assert not processed_image.success
+    assert processed_image.checksum_changed
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        record = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == 'claim-new.fits').one()
+        assert record.checksum == 'a' * 32
+        assert record.frameid == 1234
+
+
+def test_claim_frame_keeps_state_if_unchanged():
+    dbs.claim_frame('claim-unchanged.fits', 'a' * 32, 1234, db_address='sqlite:///test.db')
+    assert dbs.mark_try('claim-unchanged.fits', db_address='sqlite:///test.db') == 1
+    dbs.mark_success('claim-unchanged.fits', db_address='sqlite:///test.db')
+    processed_image = dbs.claim_frame('claim-unchanged.fits', 'a' * 32, None, db_address='sqlite:///test.db')
+    assert processed_image.tries == 1
+    assert processed_image.success
+    assert not processed_image.checksum_changed
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        record = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == 'claim-unchanged.fits')
+        assert record.one().frameid == 1234
+
+
+def test_claim_frame_resets_state_if_changed():
+    dbs.claim_frame('claim-changed.fits', 'a' * 32, None, db_address='sqlite:///test.db')
+    dbs.mark_try('claim-changed.fits', db_address='sqlite:///test.db')
+    dbs.mark_success('claim-changed.fits', db_address='sqlite:///test.db')
+    processed_image = dbs.claim_frame('claim-changed.fits', 'b' * 32, None, db_address='sqlite:///test.db')
+    assert processed_image.tries == 0
+    assert not processed_image.success
+    assert processed_image.checksum_changed
+
+
+def test_claim_frame_reports_untried_frame_as_changed_on_sqlite():
+    # sqlite cannot return the checksum on record from the upsert, so a frame that was never tried looks reset
+    dbs.claim_frame('claim-untried.fits', 'a' * 32, None, db_address='sqlite:///test.db')
+    processed_image = dbs.claim_frame('claim-untried.fits', 'a' * 32, None, db_address='sqlite:///test.db')
+    assert processed_image.tries == 0
+    assert processed_image.checksum_changed
+
+
+def test_mark_try_counts_tries():
+    for expected_tries in [1, 2, 3]:
+        assert dbs.mark_try('mark-try.fits', db_address='sqlite:///test.db') == expected_tries
+
+
+def test_save_processed_image():
+    dbs.save_processed_image('/processed/saved.fits.fz', 'c' * 32, db_address='sqlite:///test.db')
+    dbs.save_processed_image('/processed/saved.fits.fz', 'd' * 32, db_address='sqlite:///test.db')
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        records = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == 'saved.fits.fz').all()
+        assert len(records) == 1
+        assert records[0].checksum == 'd' * 32
+
+
+def add_master(filename, dateobs, binning='1x1', instrument_id=999, **kwargs):
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        db_session.add(dbs.CalibrationImage(type='BIAS', filename=filename, dateobs=dateobs, datecreated=dateobs,
+                                            instrument_id=instrument_id, is_master=True, is_bad=False,
+                                            attributes={'binning': binning}, **kwargs))
+        db_session.commit()
+
+
+def make_image(dateobs, binning='1x1', instrument_id=999):
+    return SimpleNamespace(instrument=SimpleNamespace(id=instrument_id), dateobs=dateobs, binning=binning,
+                           block_start=None)
+
+
+def get_master_bias(dateobs, binning='1x1', instrument_id=999):
+    return dbs.get_master_cal_record(make_image(dateobs, binning, instrument_id), 'bias', ['binning'],
+                                     db_address='sqlite:///test.db')
+
+
+def test_get_master_cal_record_picks_closest_in_time():
+    add_master('bias-before.fits', datetime.datetime(2026, 1, 10))
+    add_master('bias-after.fits', datetime.datetime(2026, 1, 13))
+    add_master('bias-other-binning.fits', datetime.datetime(2026, 1, 11), binning='2x2')
+    assert get_master_bias(datetime.datetime(2026, 1, 11)).filename == 'bias-before.fits'
+    assert get_master_bias(datetime.datetime(2026, 1, 12)).filename == 'bias-after.fits'
+    assert get_master_bias(datetime.datetime(2026, 1, 1)).filename == 'bias-before.fits'
+    assert get_master_bias(datetime.datetime(2026, 2, 1)).filename == 'bias-after.fits'
+    # Ties go to the earlier master
+    assert get_master_bias(datetime.datetime(2026, 1, 11, 12)).filename == 'bias-before.fits'
+    assert get_master_bias(datetime.datetime(2026, 1, 11), binning='2x2').filename == 'bias-other-binning.fits'
+
+
+def test_get_master_cal_record_without_masters():
+    assert get_master_bias(datetime.datetime(2026, 1, 11), instrument_id=998) is None
+
+
+def test_get_master_cal_records_matches_individual_lookups():
+    start = datetime.datetime(2026, 3, 1)
+    for day in [0, 2, 3, 7, 8, 15]:
+        add_master(f'bias-batch-{day}.fits', start + datetime.timedelta(days=day), instrument_id=997)
+    # Only good for a day, so images after that need a master from outside of the loaded window
+    add_master('bias-batch-short.fits', start + datetime.timedelta(days=20), instrument_id=997,
+               good_until=start + datetime.timedelta(days=21))
+    add_master('bias-batch-2x2.fits', start + datetime.timedelta(days=4), binning='2x2', instrument_id=997)
+
+    images = [make_image(start + datetime.timedelta(days=day, hours=6), binning=binning, instrument_id=997)
+              for day in [-3, 1, 2, 5, 11, 19, 22, 30] for binning in ['1x1', '2x2', '3x3']]
+    records = dbs.get_master_cal_records(images, 'bias', ['binning'], db_address='sqlite:///test.db')
+    for image, record in zip(images, records):
+        expected = dbs.get_master_cal_record(image, 'bias', ['binning'], db_address='sqlite:///test.db')
+        assert getattr(record, 'filename', None) == getattr(expected, 'filename', None)
+
+
+def test_get_master_cal_records_does_not_query_each_image():
+    start = datetime.datetime(2026, 5, 1)
+    for day in [0, 5, 10]:
+        add_master(f'bias-no-fallback-{day}.fits', start + datetime.timedelta(days=day), instrument_id=996)
+    images = [make_image(start + datetime.timedelta(days=day), instrument_id=996) for day in range(-2, 13)]
+    with mock.patch('banzai.dbs.get_master_cal_record') as mock_get_master_cal_record:
+        records = dbs.get_master_cal_records(images, 'bias', ['binning'], db_address='sqlite:///test.db')
+    mock_get_master_cal_record.assert_not_called()
+    assert [record.filename for record in records[:5]] == ['bias-no-fallback-0.fits'] * 5
+    assert records[-1].filename == 'bias-no-fallback-10.fits'
+
+
+def test_instrument_registry_serves_repeat_lookups():
+    dbs.add_instrument({'site': 'tst', 'camera': 'registry01', 'name': 'registry01', 'type': 'SBig',
+                        'nx': 100, 'ny': 100}, db_address='sqlite:///test.db')
+    instrument = dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry01')
+    with mock.patch('banzai.dbs._query_for_instrument') as mock_query:
+        assert dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry01').id == instrument.id
+        assert dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry01', name='registry01').id == \
+            instrument.id
+        assert dbs.get_instrument_by_id(instrument.id, 'sqlite:///test.db').camera == 'registry01'
+    mock_query.assert_not_called()
+
+
+def test_instrument_registry_falls_through_for_new_instruments():
+    dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry01')
+    # Added behind the registry's back, e.g. by another process
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        dbs.add_or_update_record(db_session, dbs.Instrument, {'site': 'tst', 'camera': 'registry02'},
+                                 {'site': 'tst', 'camera': 'registry02', 'name': 'registry02', 'type': 'SBig'})
+    assert dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry02').camera == 'registry02'
+    assert dbs.query_for_instrument('sqlite:///test.db', 'tst', 'missing') is None
+
+
+def test_instruments_at_site_include_instruments_missing_from_the_registry():
+    dbs.query_for_instrument('sqlite:///test.db', 'tst', 'registry01')
+    # Added behind the registry's back, e.g. by another process
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        dbs.add_or_update_record(db_session, dbs.Instrument, {'site': 'tst', 'camera': 'registry03'},
+                                 {'site': 'tst', 'camera': 'registry03', 'name': 'registry03', 'type': 'SBig'})
+    instruments = dbs.get_instruments_at_site('tst', 'sqlite:///test.db')
+    assert 'registry03' in [instrument.camera for instrument in instruments]
+    new_instrument = [instrument for instrument in instruments if instrument.camera == 'registry03'][0]
+    # The registry picks up the new instrument too
+    with mock.patch('banzai.dbs.get_session', wraps=dbs.get_session) as mock_get_session:
+        assert dbs.get_instrument_by_id(new_instrument.id, 'sqlite:///test.db').camera == 'registry03'
+        assert dbs.get_instrument_by_id(new_instrument.id, 'sqlite:///test.db').camera == 'registry03'
+    # One reload of the registry and no per-lookup queries
+    assert mock_get_session.call_count == 1
+
+
+def test_instrument_registry_is_invalidated_by_updates():
+    dbs.add_site({'code': 'rgy', 'timezone': 1, 'longitude': 0.0, 'latitude': 0.0, 'elevation': 0.0},
+                 db_address='sqlite:///test.db')
+    assert dbs.get_timezone('rgy', 'sqlite:///test.db') == 1
+    dbs.add_site({'code': 'rgy', 'timezone': 2, 'longitude': 0.0, 'latitude': 0.0, 'elevation': 0.0},
+                 db_address='sqlite:///test.db')
+    assert dbs.get_timezone('rgy', 'sqlite:///test.db') == 2
+
+
+def test_instrument_registry_reloads_after_ttl():
+    registry = dbs.InstrumentRegistry('sqlite:///test.db', ttl=0)
+    assert registry.get_site('rgz') is None
+    dbs.add_site({'code': 'rgz', 'timezone': 3, 'longitude': 0.0, 'latitude': 0.0, 'elevation': 0.0},
+                 db_address='sqlite:///test.db')
+    assert registry.get_site('rgz').timezone == 3
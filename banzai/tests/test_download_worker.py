@@ -13,6 +13,7 @@ from banzai.cache.download_worker import (
     delete_calibration, run_download_worker_daemon,
 )
 from banzai.tests.utils import FakeContext
+from banzai.utils import fits_utils, mmap_utils
 
 pytestmark = pytest.mark.download_worker
 
@@ -261,3 +262,48 @@ def test_daemon_exits_without_site_id():
         with pytest.raises(SystemExit) as exc:
             run_download_worker_daemon()
         assert exc.value.code == 1
+
+
+# --- sidecar tests ---
+
+def test_download_writes_sidecar(tmp_path):
+    cal = _make_cal()
+    processed_path = str(tmp_path)
+    with mock.patch('banzai.utils.fits_utils.download_from_s3', return_value=_make_fits_buffer()), \
+         mock.patch('banzai.cache.download_worker.update_filepath'):
+        download_calibration('sqlite:///test.db', processed_path, FakeContext(), cal, write_sidecars=True)
+
+    local_path = os.path.join(get_cache_path(processed_path, cal), 'bias.fits')
+    assert mmap_utils.get_sidecar_path(local_path) == local_path + mmap_utils.MAPPED_FILE_SUFFIX
+    hdu_list, filename, frame_id = fits_utils.open_fits_file({'path': local_path}, FakeContext())
+    assert filename == 'bias.fits'
+    assert frame_id == 123
+    assert not hdu_list[0].data.flags.writeable
+
+
+def test_download_skips_sidecar_by_default(tmp_path):
+    cal = _make_cal()
+    processed_path = str(tmp_path)
+    with mock.patch('banzai.utils.fits_utils.download_from_s3', return_value=_make_fits_buffer()), \
+         mock.patch('banzai.cache.download_worker.update_filepath'):
+        download_calibration('sqlite:///test.db', processed_path, FakeContext(), cal)
+
+    local_path = os.path.join(get_cache_path(processed_path, cal), 'bias.fits')
+    assert mmap_utils.get_sidecar_path(local_path) is None
+
+
+def test_stale_sidecar_is_ignored(tmp_path):
+    local_path = str(tmp_path / 'bias.fits')
+    fits.PrimaryHDU(np.zeros((2, 2), dtype=np.float32)).writeto(local_path)
+    open(local_path + mmap_utils.MAPPED_FILE_SUFFIX, 'w').close()
+    os.utime(local_path + mmap_utils.MAPPED_FILE_SUFFIX, (0, 0))
+    assert mmap_utils.get_sidecar_path(local_path) is None
+
+
+def test_delete_removes_sidecar(tmp_path):
+    open(os.path.join(str(tmp_path), 'del.fits'), 'w').close()
+    open(os.path.join(str(tmp_path), 'del.fits' + mmap_utils.MAPPED_FILE_SUFFIX), 'w').close()
+    cal = mock.MagicMock(id=1, filename='del.fits', filepath=str(tmp_path))
+    with mock.patch('banzai.cache.download_worker.update_filepath'):
+        delete_calibration('sqlite:///test.db', cal)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'del.fits' + mmap_utils.MAPPED_FILE_SUFFIX))
@@ -1,5 +1,6 @@
 import pytest
 import numpy as np
+from unittest import mock
 
 from banzai.flats import FlatSNRChecker
 from banzai.tests.utils import FakeContext, FakeCCDData, FakeLCOObservationFrame
@@ -15,3 +16,18 @@ def test_rejects_high_noise():
     image = snr_checker.do_stage(image)
 
     assert image is None
+
+
+def test_accepts_high_snr_from_a_sample():
+    data = np.random.normal(10000.0, 100.0, size=(1000, 1000))
+    image = FakeLCOObservationFrame(hdu_list=[FakeCCDData(data=data, uncertainty=100.0 * np.ones(data.shape))])
+    context = FakeContext()
+    context.SAMPLED_STATISTICS_SIZE = 10000
+
+    with mock.patch.object(FakeCCDData, 'signal_to_noise', autospec=True,
+                           side_effect=lambda hdu, index=None: np.abs(hdu.data[index]) / hdu.uncertainty[index]) \
+            as mock_signal_to_noise:
+        assert FlatSNRChecker(context).do_stage(image) is image
+    # Only the sampled pixels were needed
+    assert mock_signal_to_noise.call_count == 1
+    assert mock_signal_to_noise.call_args[0][1] is not None
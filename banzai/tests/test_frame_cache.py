@@ -0,0 +1,75 @@
+import pytest
+import numpy as np
+
+from banzai.cache.frame_cache import CalibrationFrameCache, get_cache_key, get_frame_size
+from banzai.tests.utils import FakeCCDData, FakeLCOObservationFrame
+
+pytestmark = pytest.mark.frame_cache
+
+
+def make_frame(nx=101, ny=103):
+    return FakeLCOObservationFrame(hdu_list=[FakeCCDData(nx=nx, ny=ny, memmap=False)])
+
+
+def test_no_cache_key_without_frameid_or_file():
+    assert get_cache_key({'filename': 'test.fits'}) is None
+
+
+def test_cache_key_includes_frameid():
+    assert get_cache_key({'filename': 'test.fits', 'frameid': 1}) != get_cache_key({'filename': 'test.fits',
+                                                                                   'frameid': 2})
+
+
+def test_cache_key_changes_with_file_modification(tmpdir):
+    path = tmpdir.join('test.fits')
+    path.write('a')
+    file_info = {'filename': 'test.fits', 'path': str(path)}
+    original_key = get_cache_key(file_info)
+    path.setmtime(path.mtime() + 10)
+    assert get_cache_key(file_info) != original_key
+
+
+def test_frame_is_cached():
+    cache = CalibrationFrameCache(max_bytes=10 * 1024 ** 2)
+    frame = make_frame()
+    cache.add({'filename': 'test.fits', 'frameid': 1}, frame)
+    cached_frame = cache.get({'filename': 'test.fits', 'frameid': 1})
+    np.testing.assert_array_equal(cached_frame.data, frame.data)
+    assert cache.get({'filename': 'test.fits', 'frameid': 2}) is None
+
+
+def test_cached_frame_is_read_only():
+    cache = CalibrationFrameCache(max_bytes=10 * 1024 ** 2)
+    cache.add({'filename': 'test.fits', 'frameid': 1}, make_frame())
+    cached_frame = cache.get({'filename': 'test.fits', 'frameid': 1})
+    with pytest.raises(ValueError):
+        cached_frame.data[0, 0] = 1.0
+    with pytest.raises(ValueError):
+        cached_frame.primary_hdu *= 2.0
+
+
+def test_cached_frame_headers_are_copies():
+    cache = CalibrationFrameCache(max_bytes=10 * 1024 ** 2)
+    cache.add({'filename': 'test.fits', 'frameid': 1}, make_frame())
+    cached_frame = cache.get({'filename': 'test.fits', 'frameid': 1})
+    cached_frame.meta['ISMASTER'] = True
+    assert 'ISMASTER' not in cache.get({'filename': 'test.fits', 'frameid': 1}).meta
+
+
+def test_least_recently_used_frame_is_evicted():
+    frame_size = get_frame_size(make_frame())
+    cache = CalibrationFrameCache(max_bytes=2 * frame_size)
+    for frameid in [1, 2]:
+        cache.add({'filename': 'test.fits', 'frameid': frameid}, make_frame())
+    cache.get({'filename': 'test.fits', 'frameid': 1})
+    cache.add({'filename': 'test.fits', 'frameid': 3}, make_frame())
+    assert len(cache) == 2
+    assert {'filename': 'test.fits', 'frameid': 1} in cache
+    assert {'filename': 'test.fits', 'frameid': 2} not in cache
+    assert cache.n_bytes <= cache.max_bytes
+
+
+def test_frames_larger_than_budget_are_not_cached():
+    cache = CalibrationFrameCache(max_bytes=0)
+    cache.add({'filename': 'test.fits', 'frameid': 1}, make_frame())
+    assert len(cache) == 0
@@ -1,10 +1,14 @@
+import os
+
 import pytest
 import mock
 import numpy as np
 from astropy.table import Table
+from astropy.io import fits
 from astropy.io.fits import ImageHDU, Header
 from mock import MagicMock
 
+from banzai.utils import mmap_utils
 from banzai.utils.image_utils import Section
 from banzai.data import CCDData, DataTable
 from banzai.dbs import CalibrationImage
@@ -166,6 +170,19 @@ def test_uncertainty_propagation_on_subtract():
     assert np.allclose(data1.uncertainty, 2)
 
 
+def test_uncertainty_propagation_is_in_place():
+    data1 = FakeCCDData(data=np.array([0.0, 4.0]), uncertainty=np.array([2.0, 2.0]))
+    data2 = FakeCCDData(data=np.array([1.0, 1.0]), uncertainty=np.array([1.0, 1.0]))
+    flat = FakeCCDData(data=np.array([2.0, 2.0]), uncertainty=0.0)
+    variance = data1.variance
+    data1 -= data2
+    data1 /= flat
+    assert data1.variance is variance
+    np.testing.assert_allclose(data1.data, [-0.5, 1.5])
+    # Pixels with no signal still get a finite uncertainty
+    np.testing.assert_allclose(data1.uncertainty, np.sqrt(5) / 2)
+
+
 def test_trim():
     test_data = FakeCCDData(nx=1000, ny=1000,
                             meta={'TRIMSEC': '[1:950, 1:945]',
@@ -180,6 +197,89 @@ def test_trim():
     assert trimmed_data.uncertainty.shape == (945, 950)
 
 
+def test_trim_view_shares_arrays():
+    header = Header({'TRIMSEC': '[3:90,5:95]', 'DATASEC': '[1:100,1:100]', 'DETSEC': '[101:200,1:100]',
+                     'CCDSUM': '1 1', 'GAIN': 1.0, 'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    test_data = CCDData(np.arange(10000, dtype=np.float32).reshape(100, 100), meta=header,
+                        uncertainty=np.ones((100, 100), dtype=np.float32))
+    trimmed_data = test_data.trim(view=True)
+    copied_data = test_data.trim()
+    assert trimmed_data.data.shape == (91, 88)
+    for array_name in ['data', 'mask', 'variance']:
+        assert np.shares_memory(getattr(trimmed_data, array_name), getattr(test_data, array_name))
+        assert not np.shares_memory(getattr(copied_data, array_name), getattr(test_data, array_name))
+        np.testing.assert_array_equal(getattr(trimmed_data, array_name), getattr(copied_data, array_name))
+    assert trimmed_data.detector_section.to_region_keyword() == copied_data.detector_section.to_region_keyword() == '[103:190,5:95]'
+    assert trimmed_data.data_section.to_region_keyword() == '[1:88,1:91]'
+    # The untrimmed data keeps its sections
+    assert test_data.meta['DETSEC'] == '[101:200,1:100]'
+
+
+def test_trim_view_of_read_only_data_is_copied_on_write():
+    header = Header({'DATASEC': '[1:100,1:100]', 'DETSEC': '[1:100,1:100]', 'CCDSUM': '1 1', 'GAIN': 1.0,
+                     'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    test_data = CCDData(np.ones((100, 100), dtype=np.float32), meta=header,
+                        uncertainty=np.ones((100, 100), dtype=np.float32), memmap=False)
+    for array in [test_data.data, test_data.mask, test_data.variance]:
+        array.flags.writeable = False
+    trimmed_data = test_data.trim(Section(11, 20, 11, 20), view=True)
+    trimmed_data -= 1.0
+    trimmed_data *= 2.0
+    np.testing.assert_array_equal(trimmed_data.data, 0.0)
+    np.testing.assert_array_equal(trimmed_data.uncertainty, 2.0)
+    np.testing.assert_array_equal(test_data.data, 1.0)
+    np.testing.assert_array_equal(test_data.uncertainty, 1.0)
+
+
+def make_section_test_data(**kwargs):
+    header = Header({'DATASEC': '[1:100,1:100]', 'DETSEC': '[1:100,1:100]', 'CCDSUM': '1 1', 'GAIN': 1.0,
+                     'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    return CCDData(np.ones((100, 100), dtype=np.float32), meta=header,
+                   uncertainty=np.ones((100, 100), dtype=np.float32), **kwargs)
+
+
+def test_section_is_copied_on_write():
+    test_data = make_section_test_data()
+    section_data = test_data[Section(11, 20, 11, 20)]
+    for array_name in ['data', 'mask', 'variance']:
+        assert np.shares_memory(getattr(section_data, array_name), getattr(test_data, array_name))
+    section_data *= 2.0
+    # Only the arrays that were modified are copied
+    assert not np.shares_memory(section_data.data, test_data.data)
+    assert not np.shares_memory(section_data.variance, test_data.variance)
+    assert np.shares_memory(section_data.mask, test_data.mask)
+    section_data -= section_data
+    section_data.background = np.ones((10, 10))
+    np.testing.assert_array_equal(section_data.data, -1.0)
+    np.testing.assert_array_equal(test_data.data, 1.0)
+    np.testing.assert_array_equal(test_data.variance, 1.0)
+    assert not test_data.mask.any()
+
+
+def test_trim_view_of_writeable_data_writes_through():
+    test_data = make_section_test_data()
+    trimmed_data = test_data.trim(Section(11, 20, 11, 20), view=True)
+    trimmed_data *= 2.0
+    trimmed_data.init_poisson_uncertainties()
+    np.testing.assert_array_equal(test_data.data[10:20, 10:20], 2.0)
+    np.testing.assert_array_equal(test_data.variance[10:20, 10:20], 6.0)
+    np.testing.assert_array_equal(test_data.data[:10], 1.0)
+
+
+def test_in_place_updates_of_read_only_views_leave_the_original():
+    test_data = make_section_test_data(memmap=False)
+    for array in [test_data.data, test_data.mask, test_data.variance]:
+        array.flags.writeable = False
+    trimmed_data = test_data.trim(Section(11, 20, 11, 20), view=True)
+    trimmed_data.init_poisson_uncertainties()
+    trimmed_data.background = np.full((10, 10), 0.5)
+    trimmed_data.variance = np.full((10, 10), 3.0)
+    np.testing.assert_array_equal(trimmed_data.data, 0.5)
+    np.testing.assert_array_equal(trimmed_data.variance, 3.0)
+    np.testing.assert_array_equal(test_data.data, 1.0)
+    np.testing.assert_array_equal(test_data.variance, 1.0)
+
+
 def test_init_poisson_uncertainties():
     # Make sure the uncertainties add in quadrature
     nx = 101
@@ -189,6 +289,47 @@ def test_init_poisson_uncertainties():
     assert (test_data.uncertainty == 5 * np.ones(test_data.data.shape)).all()
 
 
+def test_uncertainty_stays_scalar_until_needed():
+    header = Header({'DATASEC': '[1:100,1:100]', 'DETSEC': '[1:100,1:100]', 'CCDSUM': '1 1', 'GAIN': 2.0,
+                     'RDNOISE': 8.0, 'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    test_data = CCDData(np.full((100, 100), 16.0, dtype=np.float32), meta=header)
+    trimmed_data = test_data.trim(Section(11, 20, 11, 20))
+    trimmed_data *= 2.0
+    assert test_data.uncertainty_is_scalar
+    assert trimmed_data.uncertainty_is_scalar
+    assert trimmed_data._variance == 64.0
+    test_data.init_poisson_uncertainties()
+    assert not test_data.uncertainty_is_scalar
+    np.testing.assert_allclose(test_data.uncertainty, np.sqrt(4.0 ** 2 + 16.0), rtol=1e-6)
+
+
+def test_scalar_uncertainty_is_expanded_when_needed():
+    header = Header({'DATASEC': '[1:100,1:100]', 'DETSEC': '[1:100,1:100]', 'CCDSUM': '1 1', 'GAIN': 1.0,
+                     'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    test_data = CCDData(np.ones((100, 100), dtype=np.float32), meta=header, uncertainty=3.0)
+    np.testing.assert_allclose(test_data.signal_to_noise(), 1.0 / 3.0)
+    assert test_data.uncertainty_is_scalar
+    test_data.variance[:10] = 16.0
+    assert test_data.uncertainty.shape == (100, 100)
+    assert test_data.uncertainty.dtype == np.float32
+    hdu_list = test_data.to_fits(FakeContext())
+    np.testing.assert_allclose(hdu_list[2].data[:10], 4.0)
+    np.testing.assert_allclose(hdu_list[2].data[10:], 3.0)
+
+
+def test_copy_in_scalar_uncertainty():
+    header = Header({'DATASEC': '[1:100,1:100]', 'DETSEC': '[1:100,1:100]', 'CCDSUM': '1 1', 'GAIN': 1.0,
+                     'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    test_data = CCDData(np.zeros((100, 100), dtype=np.float32), meta=header, uncertainty=0.0)
+    test_data.copy_in(test_data.trim(Section(1, 100, 1, 50), view=True))
+    assert test_data.uncertainty_is_scalar
+    band = CCDData(np.ones((50, 100), dtype=np.float32), uncertainty=2.0,
+                   meta=Header({**header, 'DETSEC': '[1:100,51:100]', 'DATASEC': '[1:100,1:50]'}))
+    test_data.copy_in(band)
+    np.testing.assert_array_equal(test_data.uncertainty[50:], 2.0)
+    np.testing.assert_array_equal(test_data.uncertainty[:50], 0.0)
+
+
 def test_get_output_filename():
     test_frame = FakeLCOObservationFrame(file_path='test_image_00.fits')
     test_context = FakeContext(frame_class=FakeLCOObservationFrame)
@@ -434,3 +575,21 @@ def test_ingester_response_with_frameid(mock_post_to_ingester, _mock_dbs):
     context = FakeContext(post_to_archive=True, no_file_cache=True)
     test_frame.write(context)
     assert mock_post_to_ingester.called
+
+
+@pytest.mark.parametrize('processing_dtype', ['float32', 'float64'])
+@mock.patch('banzai.lco.image_utils.image_can_be_processed', return_value=True)
+@mock.patch('banzai.lco.dbs.query_for_instrument')
+def test_raw_pixels_are_converted_to_processing_dtype(mock_instrument, mock_can_process, processing_dtype, tmpdir):
+    mock_instrument.return_value = FakeLCOObservationFrame().instrument
+    header = Header({'OBSTYPE': 'EXPOSE', 'SITEID': 'cpt', 'INSTRUME': 'fa16', 'GAIN': 1.0, 'RDNOISE': 3.0,
+                     'DATASEC': '[1:10,1:10]', 'DETSEC': '[1:10,1:10]', 'CCDSUM': '1 1', 'SATURATE': 65535.0,
+                     'MAXLIN': 65535.0, 'CRSTLK11': 0.0})
+    raw_data = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    path = os.path.join(str(tmpdir), 'raw.fits.mmap')
+    mmap_utils.write_mapped_file(path, fits.HDUList([fits.PrimaryHDU(data=raw_data, header=header)]), 'raw.fits')
+    context = FakeContext(PROCESSING_DTYPE=processing_dtype)
+    image = LCOFrameFactory().open({'path': path}, context)
+    assert image.data.dtype == np.dtype(processing_dtype)
+    assert image.uncertainty.dtype == np.dtype(processing_dtype)
+    np.testing.assert_array_equal(image.data, raw_data)
@@ -0,0 +1,87 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import mock
+import pytest
+
+from banzai.bias import BiasSubtractor
+from banzai.calibrations import MasterCalibrationPlan, resolve_master_calibrations
+from banzai.dark import DarkSubtractor
+from banzai.tests.utils import FakeContext
+from banzai.utils import stage_utils
+
+pytestmark = pytest.mark.master_calibration_plan
+
+
+def make_image(dateobs=datetime(2024, 1, 15), **kwargs):
+    defaults = {'configuration_mode': 'default', 'binning': [1, 1], 'ccd_temperature': -100,
+                'instrument': SimpleNamespace(id=1), 'dateobs': dateobs, 'block_start': dateobs}
+    return SimpleNamespace(**{**defaults, **kwargs})
+
+
+def make_record(filename):
+    return SimpleNamespace(filename=filename, filepath='/archive', frameid=1, dateobs=datetime(2024, 1, 14))
+
+
+@mock.patch('banzai.calibrations.get_bundle_file_info', return_value=None)
+@mock.patch('banzai.dbs.get_master_cal_records')
+def test_one_lookup_per_calibration_type(mock_get_records, mock_bundle):
+    mock_get_records.side_effect = lambda images, calibration_type, *args, **kwargs: \
+        [make_record(f'{calibration_type}-{i}.fits') for i in range(len(images))]
+    context = FakeContext()
+    images = [make_image(dateobs=datetime(2024, 1, day)) for day in range(1, 21)]
+    stages = [BiasSubtractor(context), DarkSubtractor(context)]
+    plan = resolve_master_calibrations(images, stages, context)
+    assert mock_get_records.call_count == 2
+    for i, image in enumerate(images):
+        for stage in stages:
+            assert plan.has_master(image, stage.calibration_type, stage.master_selection_criteria)
+        assert plan.get_master(image, 'bias', stages[0].master_selection_criteria)['filename'] == f'bias-{i}.fits'
+        assert plan.get_master(image, 'dark', stages[1].master_selection_criteria)['filename'] == f'dark-{i}.fits'
+
+
+@mock.patch('banzai.calibrations.get_bundle_file_info', return_value={'path': 'bias.bundle', 'bundle_member': 0})
+@mock.patch('banzai.dbs.get_master_cal_records')
+def test_bundles_are_used_before_the_database(mock_get_records, mock_bundle):
+    context = FakeContext()
+    stage = BiasSubtractor(context)
+    image = make_image()
+    plan = resolve_master_calibrations([image], [stage], context)
+    mock_get_records.assert_not_called()
+    assert plan.get_master(image, 'bias', stage.master_selection_criteria)['path'] == 'bias.bundle'
+
+
+@mock.patch('banzai.calibrations.get_bundle_file_info', return_value=None)
+@mock.patch('banzai.dbs.get_master_cal_record')
+def test_stage_uses_plan(mock_get_record, mock_bundle):
+    stage = BiasSubtractor(FakeContext())
+    stage.calibration_plan = MasterCalibrationPlan()
+    image = make_image()
+    stage.calibration_plan.add_master(image, 'bias', stage.master_selection_criteria, {'filename': 'planned.fits'})
+    assert stage.get_calibration_file_info(image) == {'filename': 'planned.fits'}
+    mock_get_record.assert_not_called()
+
+    # A missing master is part of the plan too
+    missing_image = make_image(dateobs=datetime(2024, 1, 1))
+    stage.calibration_plan.add_master(missing_image, 'bias', stage.master_selection_criteria, None)
+    assert stage.get_calibration_file_info(missing_image) is None
+    mock_get_record.assert_not_called()
+
+
+@mock.patch('banzai.calibrations.get_bundle_file_info', return_value=None)
+@mock.patch('banzai.dbs.get_master_cal_record', return_value=make_record('queried.fits'))
+def test_stage_queries_images_missing_from_plan(mock_get_record, mock_bundle):
+    stage = BiasSubtractor(FakeContext())
+    stage.calibration_plan = MasterCalibrationPlan()
+    stage.calibration_plan.add_master(make_image(), 'bias', stage.master_selection_criteria,
+                                      {'filename': 'planned.fits'})
+    image = make_image(binning=[2, 2])
+    assert stage.get_calibration_file_info(image)['filename'] == 'queried.fits'
+    mock_get_record.assert_called_once()
+
+
+@mock.patch('banzai.calibrations.resolve_master_calibrations', side_effect=ValueError)
+def test_stages_run_without_plan_if_resolving_fails(mock_resolve):
+    stage = BiasSubtractor(FakeContext())
+    stage_utils.add_calibration_plan([make_image()], [stage], FakeContext())
+    assert stage.calibration_plan is None
@@ -296,3 +296,148 @@ def test_median2d_uniform_distribution_nomask():
 #                       np.random.normal(-1000.0, 1000.0, size=size2) + center2)
 #         _compare_median2d(a, mask)
 #
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.int16, np.int32, np.uint32, np.float32, np.float64])
+def test_histogram_median1d_matches_numpy(dtype):
+    for size in [1, 2, 3, 1000, 1001, 600000]:
+        a = np.random.randint(0, 3000, size=size).astype(dtype)
+        mask = (np.random.uniform(size=size) > 0.8).astype(np.uint8)
+        assert median_utils.histogram_median1d(a) == np.float32(np.median(a.astype(np.float64)))
+        if (mask == 0).any():
+            expected = np.float32(np.median(a[mask == 0].astype(np.float64)))
+            assert median_utils.histogram_median1d(a, mask) == expected
+
+
+def test_histogram_median1d_full_16_bit_range():
+    a = np.random.randint(0, 65536, size=2000000).astype(np.uint16)
+    a[:2] = [0, 65535]
+    assert median_utils.histogram_median1d(a) == np.float32(np.median(a.astype(np.float64)))
+
+
+def test_histogram_median1d_memory_is_bounded():
+    for n_bins in [1, 3000, median_utils.MAX_HISTOGRAM_BINS]:
+        n_histograms = median_utils.get_n_histograms(1 << 24, n_bins)
+        assert n_histograms >= 1
+        assert n_histograms == 1 or n_histograms * n_bins * 8 <= median_utils.MAX_HISTOGRAM_BYTES
+    assert median_utils.get_n_histograms(1 << 24, 3000) == median_utils.MAX_HISTOGRAM_CHUNKS
+    # Wider ranges use quick select instead
+    assert median_utils.histogram_median1d(np.array([0, median_utils.MAX_HISTOGRAM_BINS], dtype=np.int32)) is None
+
+
+def test_histogram_median1d_negative_values():
+    a = np.random.randint(-3000, 3000, size=1001).astype(np.float64)
+    assert median_utils.histogram_median1d(a) == np.float32(np.median(a))
+
+
+def test_histogram_median1d_all_masks_returns_zero():
+    a = np.arange(10, dtype=np.uint16)
+    assert median_utils.histogram_median1d(a, np.ones(10, dtype=np.uint8)) == 0.0
+
+
+def test_histogram_median1d_rejects_data_it_cannot_count():
+    assert median_utils.histogram_median1d(np.array([1.5, 2.0, 3.0])) is None
+    assert median_utils.histogram_median1d(np.array([0.0, 1e9])) is None
+    assert median_utils.histogram_median1d(np.array([np.nan, 1.0, 2.0])) is None
+
+
+def test_parallel_median1d_matches_numpy():
+    for size in [1, 2, 3, 1000, 1001, 250000]:
+        for a in [np.random.normal(0.0, 1.0, size=size), np.arange(size),
+                  np.concatenate([np.random.normal(0.0, 1.0, size // 2), np.random.normal(1e4, 1.0, size - size // 2)]),
+                  np.ones(size)]:
+            a = a.astype(np.float32)
+            mask = (np.random.uniform(size=size) > 0.7).astype(np.uint8)
+            assert median_utils.parallel_median1d(a, np.zeros(size, dtype=np.uint8)) == np.float32(np.median(a))
+            if (mask == 0).any():
+                assert median_utils.parallel_median1d(a, mask) == np.float32(np.median(a[mask == 0]))
+
+
+def test_parallel_median1d_all_masks_returns_zero():
+    a = np.arange(100, dtype=np.float32)
+    assert median_utils.parallel_median1d(a, np.ones(100, dtype=np.uint8)) == 0.0
+
+
+def test_parallel_median1d_pivots_bracket_the_median_of_images_with_column_structure():
+    # Bad columns at the same spacing as a regular sample of the pixels would be
+    image = np.random.normal(100.0, 1.0, size=(2048, 2048)).astype(np.float32)
+    image[:, ::256] = 1e4
+    # Vignetting-like gradient along the rows
+    image += np.linspace(0.0, 50.0, 2048, dtype=np.float32)
+    mask = (np.random.uniform(size=image.shape) > 0.9).astype(np.uint8)
+    for test_mask in [None, mask.ravel()]:
+        # None means the pivots missed the median and we would have fallen back to a serial selection
+        median = median_utils._parallel_median1d(image.ravel(), test_mask)
+        assert median is not None
+        expected = image.ravel() if test_mask is None else image.ravel()[test_mask == 0]
+        assert median == np.float32(np.median(expected))
+
+
+def test_median1d_large_arrays_match_numpy():
+    a = np.random.normal(0.0, 1.0, size=median_utils.MIN_PARALLEL_SELECT_SIZE + 1).astype(np.float32)
+    mask = (np.random.uniform(size=a.size) > 0.5).astype(np.uint8)
+    assert median_utils.median1d(a, mask) == np.float32(np.median(a[mask == 0]))
+
+
+def test_median_along_axis_matches_median2d():
+    for dtype in [np.float32, np.float64, np.uint16]:
+        a = np.random.uniform(0, 1000, size=(4, 51, 30)).astype(dtype)
+        mask = np.random.uniform(size=a.shape) > 0.7
+        # The axis of interest is strided, so median2d needs a transposed copy
+        expected = median_utils.median2d(np.ascontiguousarray(np.moveaxis(a, 1, 2).reshape(-1, 51), dtype=np.float32),
+                                         np.ascontiguousarray(np.moveaxis(mask, 1, 2).reshape(-1, 51), dtype=np.uint8))
+        actual = median_utils.median_along_axis(a, mask.view(np.uint8))
+        assert actual.dtype == np.float32
+        np.testing.assert_array_equal(actual.ravel(), expected)
+        np.testing.assert_array_equal(median_utils.median_along_axis(a).ravel(),
+                                      np.median(np.moveaxis(a, 1, 2).astype(np.float32), axis=2).ravel())
+
+
+def test_median_along_axis_all_masks_returns_zero():
+    a = np.arange(24, dtype=np.float64).reshape(2, 3, 4)
+    actual = median_utils.median_along_axis(a, np.ones(a.shape, dtype=np.uint8))
+    np.testing.assert_array_equal(actual, np.zeros((2, 4), dtype=np.float32))
+
+
+def _numpy_sigma_clipped_mean(a, mask, nsigma):
+    values = a[mask == 0].astype(np.float32)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    good = np.abs(a[mask == 0].astype(np.float64) - median) <= nsigma * 1.4826 * mad
+    return a[mask == 0][good].astype(np.float64).mean()
+
+
+def test_sigma_clipped_mean_matches_numpy():
+    for dtype in [np.float32, np.float64, np.uint16]:
+        for size in [1, 2, 101, median_utils.MIN_PARALLEL_SELECT_SIZE + 1]:
+            a = np.random.normal(1000.0, 10.0, size=size)
+            a[::13] = 5000.0
+            a = a.astype(dtype).reshape(1, -1)
+            mask = (np.random.uniform(size=a.shape) > 0.8).astype(np.uint8)
+            if not (mask == 0).any():
+                mask[:] = 0
+            actual = median_utils.sigma_clipped_mean(a, mask, 3.0)
+            np.testing.assert_allclose(actual, _numpy_sigma_clipped_mean(a, mask, 3.0), rtol=1e-12)
+            np.testing.assert_allclose(median_utils.sigma_clipped_mean(a, None, 3.0),
+                                       _numpy_sigma_clipped_mean(a, np.zeros_like(mask), 3.0), rtol=1e-12)
+
+
+def test_sigma_clipped_mean_all_masked_returns_fill_value():
+    a = np.ones((3, 4), dtype=np.float32)
+    assert median_utils.sigma_clipped_mean(a, np.ones(a.shape, dtype=np.uint8), 3.0, -1.0) == -1.0
+    np.testing.assert_array_equal(median_utils.sigma_clipped_mean_along_axis(a.reshape(1, 3, 4),
+                                                                             np.ones((1, 3, 4), dtype=np.uint8),
+                                                                             3.0, -1.0),
+                                  -np.ones((1, 4)))
+
+
+def test_sigma_clipped_mean_along_axis_matches_sigma_clipped_mean():
+    a = np.random.normal(0.0, 1.0, size=(5, 40, 6))
+    a[:, ::7, :] = 100.0
+    mask = (np.random.uniform(size=a.shape) > 0.7).astype(np.uint8)
+    actual = median_utils.sigma_clipped_mean_along_axis(a, mask, 3.0)
+    for outer in range(5):
+        for inner in range(6):
+            expected = median_utils.sigma_clipped_mean(a[outer, :, inner].reshape(1, -1),
+                                                       mask[outer, :, inner].reshape(1, -1), 3.0)
+            assert actual[outer, inner] == pytest.approx(expected, rel=1e-12)
@@ -1,6 +1,7 @@
 import mock
 import pytest
 
+from banzai import dbs
 from banzai.tests.utils import FakeContext
 from banzai.utils.realtime_utils import need_to_process_image
 import datetime
@@ -12,14 +13,15 @@ pytestmark = pytest.mark.need_to_process_image
 
 
 class FakeRealtimeImage(object):
-    def __init__(self, success=False, checksum=md5_hash1, tries=0, block_end_date=None):
+    def __init__(self, success=False, checksum=md5_hash1, tries=0, block_end_date=None, checksum_changed=False):
         self.success = success
         self.checksum = checksum
         self.tries = tries
+        self.checksum_changed = checksum_changed
 
 
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_frame')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
 def test_no_processing_if_previous_success(mock_can_process, mock_header, mock_processed, mock_md5):
@@ -30,12 +32,11 @@ def test_no_processing_if_previous_success(mock_can_process, mock_header, mock_p
     assert not need_to_process_image({'path': 'test.fits'}, FakeContext(), mock_task)
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_frame')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_never_tried(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
+def test_do_process_if_never_tried(mock_can_process, mock_header, mock_processed, mock_md5):
     mock_task = mock.MagicMock()
     mock_can_process.return_value = True
     mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=0)
@@ -43,12 +44,11 @@ def test_do_process_if_never_tried(mock_can_process, mock_header, mock_processed
     assert need_to_process_image({'path': 'test.fits'}, FakeContext(), mock_task)
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_frame')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_tries_less_than_max(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
+def test_do_process_if_tries_less_than_max(mock_can_process, mock_header, mock_processed, mock_md5):
     mock_task = mock.MagicMock()
     mock_can_process.return_value = True
     mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=3)
@@ -58,12 +58,11 @@ def test_do_process_if_tries_less_than_max(mock_can_process, mock_header, mock_p
     assert need_to_process_image({'path': 'test.fits'}, context, mock_task)
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_frame')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_no_processing_if_tries_at_max(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
+def test_no_processing_if_tries_at_max(mock_can_process, mock_header, mock_processed, mock_md5):
     mock_task = mock.MagicMock()
     mock_can_process.return_value = True
     max_tries = 5
@@ -74,19 +73,36 @@ def test_no_processing_if_tries_at_max(mock_can_process, mock_header, mock_proce
     assert not need_to_process_image({'path': 'test.fits'}, context, mock_task)
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_frame')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_new_checksum(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
+def test_frame_is_claimed_with_checksum(mock_can_process, mock_header, mock_processed, mock_md5):
+    mock_task = mock.MagicMock()
+    mock_can_process.return_value = True
+    mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash2, tries=0)
+    mock_md5.return_value = md5_hash2
+    context = FakeContext()
+    assert need_to_process_image({'path': 'test.fits'}, context, mock_task)
+    mock_processed.assert_called_once_with('test.fits', md5_hash2, None, db_address=context.db_address)
+
+
+@mock.patch('banzai.utils.file_utils.get_md5')
+@mock.patch('banzai.utils.fits_utils.get_primary_header')
+@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+def test_do_process_if_new_checksum(mock_can_process, mock_header, mock_md5, tmpdir):
     # assert that tries and success are reset to 0
     mock_task = mock.MagicMock()
-    image = FakeRealtimeImage(success=True, checksum=md5_hash1, tries=3)
     mock_can_process.return_value = True
-    mock_processed.return_value = image
+    context = FakeContext(db_address='sqlite:///' + str(tmpdir.join('test.db')))
+    dbs.create_db(context.db_address)
+    with dbs.get_session(db_address=context.db_address) as db_session:
+        db_session.add(dbs.ProcessedImage(filename='test.fits', checksum=md5_hash1, tries=3, success=True))
+        db_session.commit()
     mock_md5.return_value = md5_hash2
-    assert need_to_process_image({'path': 'test.fits'}, FakeContext(), mock_task)
-    assert not image.success
-    assert image.tries == 0
-    assert image.checksum == md5_hash2
+    assert need_to_process_image({'path': 'test.fits'}, context, mock_task)
+    with dbs.get_session(db_address=context.db_address) as db_session:
+        image = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == 'test.fits').one()
+        assert not image.success
+        assert image.tries == 0
+        assert image.checksum == md5_hash2
@@ -38,7 +38,7 @@ def test_adds_good_noise_map(mock_noise_map_file_info, mock_noise_map, mock_upda
     mock_noise_map.return_value = super_image
     tester = ReadNoiseLoader(FakeContext())
     image = tester.do_stage(image)
-    np.testing.assert_array_equal(image.uncertainty, super_image.data)
+    np.testing.assert_array_equal(image.uncertainty, np.abs(super_image.data))
     assert image.meta.get("L1IDRDN") == "test.fits"
 
 
@@ -59,7 +59,7 @@ def test_adds_good_noise_map_3d(mock_noise_map_file_info, mock_noise_map, mock_u
     tester = ReadNoiseLoader(FakeContext())
     image = tester.do_stage(image)
     for image_hdu, master_hdu in zip(image.ccd_hdus, super_image.ccd_hdus):
-        np.testing.assert_array_equal(image_hdu.uncertainty, master_hdu.data)
+        np.testing.assert_array_equal(image_hdu.uncertainty, np.abs(master_hdu.data))
     assert image.meta.get("L1IDRDN") == "test.fits"
 
 
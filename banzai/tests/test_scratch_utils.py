@@ -0,0 +1,69 @@
+import gc
+import os
+
+import mock
+import numpy as np
+import pytest
+
+from banzai.utils.scratch_utils import ScratchStorage
+from astropy.io import fits
+
+from banzai.data import CCDData
+from banzai.utils.image_utils import Section
+
+pytestmark = pytest.mark.scratch_utils
+
+
+def count_open_files():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def test_large_arrays_are_spilled_without_leaving_files(tmpdir):
+    storage = ScratchStorage(str(tmpdir), max_bytes=10 ** 6, min_bytes=1000)
+    array = storage.copy(np.arange(1000, dtype=np.float32))
+    np.testing.assert_array_equal(array, np.arange(1000, dtype=np.float32))
+    assert storage.used_bytes == 4000
+    assert os.listdir(str(tmpdir)) == []
+    view = array[10:20]
+    del array
+    assert storage.used_bytes == 4000
+    np.testing.assert_array_equal(view, np.arange(10, 20, dtype=np.float32))
+    del view
+    gc.collect()
+    assert storage.used_bytes == 0
+
+
+def test_small_arrays_stay_in_memory(tmpdir):
+    storage = ScratchStorage(str(tmpdir), max_bytes=10 ** 6, min_bytes=1000)
+    array = storage.zeros((10, 10), np.uint8)
+    assert array.flags.owndata
+    assert np.all(array == 0)
+    assert storage.used_bytes == 0
+
+
+def test_arrays_over_the_quota_stay_in_memory(tmpdir):
+    storage = ScratchStorage(str(tmpdir), max_bytes=10000, min_bytes=0)
+    first = storage.zeros((1000,), np.float64)
+    second = storage.zeros((1000,), np.float64)
+    assert not first.flags.owndata
+    assert second.flags.owndata
+    assert storage.used_bytes == 8000
+
+
+def test_data_does_not_hold_files_open(tmpdir):
+    storage = ScratchStorage(str(tmpdir), max_bytes=10 ** 9, min_bytes=0)
+    with mock.patch('banzai.data.get_scratch_storage', return_value=storage):
+        n_open_files = count_open_files()
+        for i in range(50):
+            header = fits.Header({'RDNOISE': 3.0, 'GAIN': 1.0, 'DETSEC': '[1:64,1:64]', 'DATASEC': '[1:64,1:64]',
+                                  'CCDSUM': '1 1'})
+            data = CCDData(np.ones((64, 64), dtype=np.float32) * i, meta=header)
+            trimmed = data[Section(1, 10, 1, 10)]
+            assert storage.used_bytes > 0
+            assert np.all(trimmed.data == i)
+        del data, trimmed
+        gc.collect()
+        # Only the arrays that are still around hold files open
+        assert count_open_files() == n_open_files
+    assert storage.used_bytes == 0
+    assert os.listdir(str(tmpdir)) == []
@@ -1,7 +1,10 @@
 import numpy as np
 import pytest
 
-from banzai.data import stack
+from astropy.io import fits
+
+from banzai.data import CCDData, stack
+from banzai.stacking import plan_row_bands, plan_band_tasks, read_band, stack_by_band
 from banzai.tests.utils import FakeCCDData
 
 pytestmark = pytest.mark.stacking
@@ -47,3 +50,80 @@ def test_stacking_with_different_pixels(set_random_seed):
     np.testing.assert_allclose(stacked_data.data, 4.0 * d)
     np.testing.assert_allclose(stacked_data.uncertainty, np.ones((ny, nx)))
     assert np.all(stacked_data.mask == 0)
+
+
+def test_stacking_rejects_outliers(set_random_seed):
+    nx, ny = 102, 105
+    test_data = [FakeCCDData(data=np.random.normal(100.0, 1.0, size=(ny, nx)),
+                             mask=np.zeros((ny, nx), dtype=np.uint8),
+                             uncertainty=np.ones((ny, nx))) for i in range(9)]
+    test_data[0].data[10, 10] = 1e6
+    stacked_data = stack(test_data, 3.0)
+    assert abs(stacked_data.data[10, 10] - 100.0) < 3.0
+    assert stacked_data.mask[10, 10] == 0
+
+
+def test_stacking_pixels_masked_in_every_image():
+    nx, ny = 102, 105
+    test_data = []
+    for i in range(4):
+        mask = np.zeros((ny, nx), dtype=np.uint8)
+        mask[5, 6] = 2 ** i
+        test_data.append(FakeCCDData(data=np.ones((ny, nx)) * i, mask=mask, uncertainty=np.ones((ny, nx)) * 2.0))
+    stacked_data = stack(test_data, 3.0)
+    # Fall back to the mean of every image and keep every bit of the masks
+    assert stacked_data.data[5, 6] == 1.5
+    assert stacked_data.uncertainty[5, 6] == 1.0
+    assert stacked_data.mask[5, 6] == 15
+    assert stacked_data.mask.sum() == 15
+
+
+def test_row_bands_cover_every_row_once():
+    bands = plan_row_bands(105, 1000, 10000)
+    assert bands[0] == (0, 10)
+    assert bands[-1] == (100, 105)
+    assert sum(stop - start for start, stop in bands) == 105
+    assert all(previous[1] == current[0] for previous, current in zip(bands[:-1], bands[1:]))
+
+
+def test_row_bands_are_at_least_one_row():
+    assert plan_row_bands(3, 1000, 10) == [(0, 1), (1, 2), (2, 3)]
+    assert plan_row_bands(3, 1000, 10 ** 9) == [(0, 3)]
+
+
+def test_band_tasks_split_rows_evenly():
+    assert plan_band_tasks(105, 3) == [(0, 35), (35, 70), (70, 105)]
+    assert plan_band_tasks(47, 3) == [(0, 16), (16, 32), (32, 47)]
+    assert plan_band_tasks(2, 4) == [(0, 1), (1, 2)]
+
+
+def make_ccd_data(data, **kwargs):
+    ny, nx = data.shape
+    header = fits.Header({'DATASEC': f'[1:{nx},1:{ny}]', 'DETSEC': f'[1:{nx},1:{ny}]', 'CCDSUM': '1 1'})
+    return CCDData(data=data, meta=header, **kwargs)
+
+
+def test_read_band_does_not_copy():
+    data = make_ccd_data(np.arange(20.0).reshape(5, 4), uncertainty=np.ones((5, 4)))
+    band = read_band(data, 2, 4)
+    assert np.shares_memory(band.data, data.data)
+    assert np.shares_memory(band.variance, data.variance)
+    np.testing.assert_equal(band.data, data.data[2:4])
+    assert band.detector_section.to_region_keyword() == '[1:4,3:4]'
+
+
+def test_stacking_by_band_matches_stacking_whole_frames(set_random_seed):
+    nx, ny = 102, 105
+    test_data = []
+    for i in range(15):
+        mask = np.zeros((ny, nx), dtype=np.uint8)
+        mask[np.random.uniform(size=(ny, nx)) > 0.95] = 1
+        test_data.append(make_ccd_data(np.random.normal(100.0, 10.0, size=(ny, nx)), mask=mask,
+                                       uncertainty=np.ones((ny, nx)) * 10.0))
+    expected = stack(test_data, 3.0)
+    output = make_ccd_data(np.zeros((ny, nx)))
+    # A tiny budget so we stack one row at a time
+    stack_by_band(test_data, output, 3.0, max_bytes=1)
+    np.testing.assert_allclose(output.data, expected.data)
+    np.testing.assert_allclose(output.uncertainty, expected.uncertainty)
+    np.testing.assert_equal(output.mask, expected.mask)
@@ -0,0 +1,202 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+import numpy as np
+import pytest
+from astropy.io.fits import Header
+
+from banzai.data import CCDData
+from banzai import logs
+from banzai.stages import Stage
+from banzai.utils import stage_utils, median_utils, import_utils
+from banzai.utils.scratch_utils import get_scratch_storage
+from banzai.tests.utils import FakeContext, FakeInstrument, FakeLCOObservationFrame
+
+pytestmark = pytest.mark.stages
+
+
+class WaitingStage(Stage):
+    """Only finishes if every image is processed at the same time"""
+    def __init__(self, runtime_context, barrier):
+        super(WaitingStage, self).__init__(runtime_context)
+        self.barrier = barrier
+
+    def do_stage(self, image):
+        self.barrier.wait()
+        if image.frame_id == 1:
+            raise ValueError('Bad frame')
+        if image.frame_id == 2:
+            return None
+        return image
+
+
+class GroupedStage(Stage):
+    @property
+    def process_by_group(self):
+        return True
+
+    def do_stage(self, images):
+        return images[0]
+
+
+class ProcessRecordingStage(GroupedStage):
+    def do_stage(self, images):
+        if images[0].instrument.id == 1:
+            raise ValueError('Bad group')
+        images[0].processed_by = os.getpid()
+        return images[0]
+
+
+def test_stage_runs_images_on_executor_in_order():
+    images = [FakeLCOObservationFrame(frame_id=i) for i in range(6)]
+    stage = WaitingStage(None, threading.Barrier(len(images), timeout=5))
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        stage.executor = executor
+        processed_images = stage.run(images)
+    assert [image.frame_id for image in processed_images] == [0, 3, 4, 5]
+
+
+def test_stage_runs_serially_without_executor():
+    images = [FakeLCOObservationFrame(frame_id=i) for i in range(4)]
+    stage = WaitingStage(None, threading.Barrier(1))
+    assert [image.frame_id for image in stage.run(images)] == [0, 3]
+
+
+def test_grouped_stages_do_not_use_executor():
+    images = [FakeLCOObservationFrame(frame_id=i) for i in range(3)]
+    stage = GroupedStage(None)
+    stage.executor = mock.MagicMock()
+    assert len(stage.run(images)) == 1
+    stage.executor.submit.assert_not_called()
+
+
+def make_grouped_images(n_groups):
+    images = []
+    for i in range(n_groups):
+        instrument = FakeInstrument(i, 'cpt', f'fa{i:02d}', 'doma', '1m0a', '1M-SCICAM-SINISTRO')
+        images += [FakeLCOObservationFrame(instrument=instrument, frame_id=10 * i + j) for j in range(2)]
+    return images
+
+
+def test_groups_run_in_processes():
+    stage = ProcessRecordingStage(None)
+    context = FakeContext(STAGE_GROUP_PROCESSES=2)
+    group_executor = stage_utils.get_group_executor(context)
+    try:
+        stage.group_executor = group_executor
+        stage.executor = ThreadPoolExecutor(max_workers=2)
+        processed_images = stage.run(make_grouped_images(3))
+    finally:
+        group_executor.shutdown()
+        stage.executor.shutdown()
+    # The failing group is dropped without affecting the others
+    assert [image.frame_id for image in processed_images] == [0, 20]
+    assert all(image.processed_by != os.getpid() for image in processed_images)
+
+
+class ProcessSettingsStage(GroupedStage):
+    def do_stage(self, images):
+        images[0].scratch_max_bytes = get_scratch_storage().max_bytes
+        images[0].log_level = logs.get_log_level()
+        return images[0]
+
+
+def test_group_processes_are_configured_from_the_context():
+    stage = ProcessSettingsStage(None)
+    context = FakeContext(STAGE_GROUP_PROCESSES=2, SCRATCH_MAX_BYTES=12345)
+    original_log_level = logs.get_log_level()
+    logs.set_log_level('WARNING')
+    group_executor = stage_utils.get_group_executor(context)
+    try:
+        stage.group_executor = group_executor
+        processed_images = stage.run(make_grouped_images(2))
+    finally:
+        group_executor.shutdown()
+        logs.set_log_level(original_log_level)
+    assert [image.scratch_max_bytes for image in processed_images] == [12345, 12345]
+    assert [image.log_level for image in processed_images] == ['WARNING', 'WARNING']
+
+
+def test_groups_that_cannot_be_sent_to_a_process_are_dropped():
+    stage = GroupedStage(None)
+    stage.group_executor = mock.MagicMock()
+    stage.group_executor.submit.return_value.result.side_effect = [RuntimeError('Process died'),
+                                                                   mock.sentinel.master]
+    assert stage.run(make_grouped_images(2)) == [mock.sentinel.master]
+
+
+def test_no_group_processes_by_default():
+    assert stage_utils.get_group_executor(FakeContext()) is None
+    assert stage_utils.get_group_executor(FakeContext(STAGE_GROUP_PROCESSES=1)) is None
+
+
+class WaitingFrameFactory:
+    barrier = None
+
+    def open(self, file_info, runtime_context):
+        self.barrier.wait()
+        return None
+
+
+def test_frames_are_opened_concurrently():
+    WaitingFrameFactory.barrier = threading.Barrier(4, timeout=5)
+    context = FakeContext(PIPELINE_THREADS=4, FRAME_FACTORY='banzai.tests.test_stages.WaitingFrameFactory')
+    stage_utils.run_pipeline_stages([{'path': f'frame{i}.fits'} for i in range(4)], context)
+    assert not WaitingFrameFactory.barrier.broken
+
+
+REDUCTION_STAGES = ['banzai.bpm.SaturatedPixelFlagger', 'banzai.bias.OverscanSubtractor', 'banzai.gain.GainNormalizer',
+                    'banzai.trim.Trimmer', 'banzai.uncertainty.PoissonInitializer',
+                    'banzai.bias.BiasMasterLevelSubtractor']
+
+
+def make_raw_frames(n_frames):
+    frames = []
+    for i in range(n_frames):
+        random_generator = np.random.default_rng(i)
+        data = random_generator.normal(1000.0, 10.0, size=(103, 110)).astype(np.float32)
+        data[:, :100] += random_generator.poisson(500.0, size=(103, 100))
+        data[5, 5] = 70000.0
+        meta = Header({'BIASSEC': '[101:110,1:103]', 'TRIMSEC': '[1:100,1:103]', 'DATASEC': '[1:110,1:103]',
+                       'DETSEC': '[1:110,1:103]', 'CCDSUM': '1 1', 'GAIN': 2.0, 'RDNOISE': 5.0,
+                       'SATURATE': 65000.0, 'MAXLIN': 65000.0})
+        frames.append(FakeLCOObservationFrame(hdu_list=[CCDData(data, meta=meta, name='SCI')], frame_id=i))
+    return frames
+
+
+def reduce_frames(frames, executor):
+    for stage_name in REDUCTION_STAGES:
+        stage = import_utils.import_attribute(stage_name)(FakeContext())
+        stage.executor = executor
+        frames = stage.run(frames)
+    return frames
+
+
+def test_stages_on_threads_match_serial_reduction():
+    serial_frames = reduce_frames(make_raw_frames(4), None)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        threaded_frames = reduce_frames(make_raw_frames(4), executor)
+    assert [frame.frame_id for frame in threaded_frames] == [frame.frame_id for frame in serial_frames] == [0, 1, 2, 3]
+    for serial_frame, threaded_frame in zip(serial_frames, threaded_frames):
+        assert threaded_frame.data.shape == (103, 100)
+        np.testing.assert_array_equal(threaded_frame.data, serial_frame.data)
+        np.testing.assert_array_equal(threaded_frame.mask, serial_frame.mask)
+        np.testing.assert_array_equal(threaded_frame.uncertainty, serial_frame.uncertainty)
+        for keyword in ['OVERSCAN', 'BIASLVL', 'GAIN']:
+            assert threaded_frame.meta[keyword] == serial_frame.meta[keyword]
+
+
+def test_stages_run_serially_by_default():
+    assert FakeContext().STAGE_THREADS == 1
+
+
+def test_kernel_threads_are_shared_between_stage_threads():
+    try:
+        stage_utils.configure_kernel_threads(2)
+        assert median_utils.get_num_threads() == max(1, median_utils.DEFAULT_NUM_THREADS // 2)
+        stage_utils.configure_kernel_threads(1)
+        assert median_utils.get_num_threads() == median_utils.DEFAULT_NUM_THREADS
+    finally:
+        median_utils.set_num_threads(median_utils.DEFAULT_NUM_THREADS)
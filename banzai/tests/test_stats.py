@@ -1,3 +1,4 @@
+import mock
 import pytest
 import numpy as np
 from numpy import ma
@@ -670,3 +671,86 @@ def test_mad_3d_axis_2_mask(set_random_seed):
         expected = ma.median(ma.array(np.abs(a - np.expand_dims(ma.median(a_masked, axis=2), axis=2)), dtype=np.float32, mask=mask), axis=2)
         actual = stats.median_absolute_deviation(a, mask=mask, axis=2)
         np.testing.assert_allclose(actual, expected.astype(np.float32), atol=1e-9)
+
+
+def test_median_of_integer_data_uses_histogram(set_random_seed):
+    # Raw frames are integers stored as floats
+    a = np.random.randint(0, 65535, size=(300, 200)).astype(np.float64)
+    mask = np.random.uniform(0, 1, size=a.shape) < 0.3
+    expected = ma.median(ma.array(a, mask=mask, dtype=np.float32))
+    with mock.patch('banzai.utils.median_utils.median1d') as mock_median1d:
+        actual = stats.median(a, mask=mask)
+        assert stats.median(a.astype(np.uint16)) == np.float32(np.median(a))
+    mock_median1d.assert_not_called()
+    assert np.float32(expected) == actual
+
+
+def test_median_along_axis_reads_data_in_place(set_random_seed):
+    a = np.random.normal(1000.0, 10.0, size=(20, 30, 40))
+    mask = np.random.uniform(0, 1, size=a.shape) < 0.3
+    a.setflags(write=False)
+    for axis in [0, 1, 2, -1]:
+        expected = ma.median(ma.array(a, mask=mask, dtype=np.float32), axis=axis)
+        with mock.patch('banzai.utils.median_utils.median2d') as mock_median2d:
+            actual = stats.median(a, axis=axis, mask=mask)
+        mock_median2d.assert_not_called()
+        np.testing.assert_allclose(actual, expected.astype(np.float32), atol=1e-6)
+
+
+def test_sigma_clipped_mean_rejects_outliers(set_random_seed):
+    a = np.random.normal(100.0, 1.0, size=(200, 300))
+    a[::10, ::10] = 1e4
+    mask = np.zeros(a.shape, dtype=bool)
+    mask[50:60] = True
+    good = np.logical_and(a < 1e3, np.logical_not(mask))
+    np.testing.assert_allclose(stats.sigma_clipped_mean(a, 3.5, mask=mask), a[good].mean(), rtol=1e-4)
+    # Sections of a frame are read in place
+    np.testing.assert_allclose(stats.sigma_clipped_mean(a[:, 100:200], 3.5), a[:, 100:200][a[:, 100:200] < 1e3].mean(),
+                               rtol=1e-4)
+
+
+def test_sigma_clipped_mean_axis(set_random_seed):
+    a = np.random.normal(100.0, 1.0, size=(5, 400, 6))
+    a[:, ::20, :] = 1e4
+    actual = stats.sigma_clipped_mean(a, 3.0, axis=1, fill_value=-1.0, mask=np.zeros(a.shape, dtype=np.uint8))
+    assert actual.shape == (5, 6)
+    np.testing.assert_allclose(actual, a.mean(axis=1, where=a < 1e3), rtol=1e-3)
+    np.testing.assert_array_equal(stats.sigma_clipped_mean(a, 3.0, axis=-1, mask=np.ones(a.shape, dtype=bool),
+                                                           fill_value=-1.0),
+                                  -np.ones((5, 400)))
+
+
+def test_sampled_estimates_bracket_exact_values(set_random_seed):
+    a = np.random.normal(1000.0, 30.0, size=(2000, 1000))
+    median, lower, upper = stats.sampled_median(a, n_samples=10000)
+    assert lower < median < upper
+    assert lower <= np.median(a) <= upper
+    std, lower, upper = stats.sampled_robust_standard_deviation(a, n_samples=10000)
+    assert lower <= stats.robust_standard_deviation(a) <= upper
+    mean, lower, upper = stats.sampled_sigma_clipped_mean(a, 3.0, n_samples=10000)
+    assert lower <= stats.sigma_clipped_mean(a, 3.0) <= upper
+
+
+def test_sampled_median_is_exact_near_threshold(set_random_seed):
+    a = np.random.normal(1000.0, 30.0, size=(2000, 1000))
+    mask = np.random.uniform(size=a.shape) < 0.1
+    _, lower, upper = stats.sampled_median(a, mask=mask, n_samples=10000)
+    expected = ma.median(ma.array(a, mask=mask, dtype=np.float32))
+    assert stats.sampled_median(a, mask=mask, threshold=(lower + upper) / 2.0, n_samples=10000) == (expected,
+                                                                                                      expected,
+                                                                                                      expected)
+    # Small arrays are never sampled
+    assert stats.sampled_median(a[:10, :10], n_samples=10000)[1:] == (np.float32(np.median(a[:10, :10])),) * 2
+
+
+def test_sampled_median_only_evaluates_function_at_sample(set_random_seed):
+    a = np.random.normal(1000.0, 30.0, size=(2000, 1000))
+    evaluated_sizes = []
+
+    def values(index):
+        evaluated_sizes.append(np.size(a[index]))
+        return a[index]
+
+    median, lower, upper = stats.sampled_median(values, shape=a.shape, n_samples=10000)
+    assert evaluated_sizes == [10000]
+    assert lower <= np.median(a) <= upper
@@ -13,7 +13,8 @@ class Trimmer(Stage):
         # TODO: this enumeration might not actually work, add a replace method in the image class
         data_to_replace = []
         for i, data in enumerate(image.ccd_hdus):
-            trimmed_data = data.trim()
+            # The untrimmed data is replaced below, so the trimmed data can share its arrays
+            trimmed_data = data.trim(view=True)
             data_to_replace.append((data, trimmed_data))
 
         for old_data, trimmed_data in data_to_replace:
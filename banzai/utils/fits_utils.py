@@ -5,6 +5,7 @@ from collections.abc import Iterable
 from collections import OrderedDict
 
 from banzai import logs
+from banzai.utils import mmap_utils
 from banzai.exceptions import FrameNotAvailableError
 
 from astropy.io import fits
@@ -165,6 +166,14 @@ def open_fits_file(file_info, context, is_raw_frame=False):
         frame_id = None
         buffer = file_info.get('data_buffer')
     elif file_info.get('path') is not None and os.path.exists(file_info.get('path')):
+        # Decompressed copies of masters (from the calibration store or a sidecar written by the download worker)
+        # are memory mapped rather than read and decompressed
+        if mmap_utils.is_mapped_file(file_info.get('path')):
+            return mmap_utils.read_mapped_file(file_info.get('path'), file_info.get('bundle_member', 0),
+                                               copy_on_write=file_info.get('copy_on_write', False))
+        sidecar_path = mmap_utils.get_sidecar_path(file_info.get('path'))
+        if sidecar_path is not None:
+            return mmap_utils.read_mapped_file(sidecar_path)
         buffer = open(file_info.get('path'), 'rb')
         filename = os.path.basename(file_info.get('path'))
         frame_id = None
@@ -2,16 +2,44 @@
 # cython: cdivision=True
 # cython: language_level=3
 from __future__ import absolute_import, division, print_function, unicode_literals
-from libc.stdint cimport uint8_t
+from libc.stdint cimport uint8_t, uint16_t, int16_t, int32_t, uint32_t, int64_t
 from libc.stdlib cimport malloc, free
+from libc.math cimport fabs, floor, INFINITY
 import numpy as np
 cimport numpy as np
 
 cimport cython
 from cython.parallel import parallel, prange
+import os
 
 np.import_array()
 
+
+def _get_default_num_threads():
+    # OpenMP uses OMP_NUM_THREADS (the first entry if it is a list) or otherwise one thread per core
+    try:
+        return max(1, int(os.environ.get('OMP_NUM_THREADS', '').split(',')[0]))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+DEFAULT_NUM_THREADS = _get_default_num_threads()
+cdef int _num_threads = DEFAULT_NUM_THREADS
+
+
+def set_num_threads(int n_threads):
+    """set_num_threads(n_threads)\n
+    Limit the number of threads each call to the parallel functions in this module (and stack_utils) uses,
+    e.g. so that frames reduced on several threads at once share the cores rather than oversubscribing them.
+    """
+    global _num_threads
+    _num_threads = max(1, n_threads)
+
+
+def get_num_threads():
+    """Number of threads each call to the parallel functions in this module uses (see set_num_threads)"""
+    return _num_threads
+
 cdef extern from "quick_select.h":
     float quick_select(float * k, int k, int n) nogil
 
@@ -63,23 +91,178 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
     are masked), we return zero. This has comparable performance to np.median on unmasked data,
     but does not require the gil. For masked arrays, the performance is significantly better
     (anecdotally, I have seen improvements of more than order of magnitude, but I have not done
-    a comprehensive benchmark).
+    a comprehensive benchmark). Arrays with more than MIN_PARALLEL_SELECT_SIZE elements are handed
+    to parallel_median1d.
     """
 
+    if d.shape[0] >= MIN_PARALLEL_SELECT_SIZE:
+        return parallel_median1d(d, mask)
+    return _serial_median1d(d, mask)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef float _serial_median1d(float[::1] d, uint8_t[::1] mask):
     cdef int n = d.shape[0]
+    cdef bint use_mask = mask is not None
 
-    cdef float[::1] median_array = np.empty(n, dtype=np.float32)
+    cdef float[::1] median_array = np.empty(max(n, 1), dtype=np.float32)
 
     cdef int n_unmasked_pixels = 0
     cdef int i = 0
     for i in range(n):
-        if mask[i] == 0:
+        if not use_mask or mask[i] == 0:
             median_array[n_unmasked_pixels] = d[i]
             n_unmasked_pixels += 1
 
     return _cmedian1d(&median_array[0], n_unmasked_pixels)
 
 
+# Below this many elements, a serial quick select is faster than setting up the parallel selection
+MIN_PARALLEL_SELECT_SIZE = 1 << 20
+PARALLEL_SELECT_CHUNKS = 64
+PIVOT_SAMPLE_SIZE = 1 << 14
+# The pivot sample is random, but always the same for the same size of data
+PIVOT_SAMPLE_SEED = 1031
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parallel_median1d(float[::1] d not None, uint8_t[::1] mask=None):
+    """parallel_median1d(d, mask=None)\n
+    Same as median1d, but splits the work across threads.
+    Parameters
+    ----------
+    d : float numpy array
+        Input array to find the median.
+    mask: unit8 numpy array
+          Numpy array of bitmask values. Non-zero values are ignored when calculating the median.
+          If None, every value is used.
+    Returns
+    -------
+    med : float
+        The median value.
+    Notes
+    -----
+    We sort a random sample of the unmasked values and take two pivots from the sample that bracket
+    the median with high probability. Unlike a regular stride, a random sample does not line up with the
+    rows or columns of an image, so structure like bad columns or gradients does not bias the pivots. Threads then count the values below the lower pivot and copy the
+    (few) values between the pivots into a small buffer, and a serial quick select of that buffer gives
+    the median. If the pivots miss the median, we fall back to a serial quick select of every value.
+    """
+    med = _parallel_median1d(d, mask)
+    if med is None:
+        return _serial_median1d(d, mask)
+    return med
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _parallel_median1d(float[::1] d not None, uint8_t[::1] mask=None):
+    """Same as parallel_median1d, but returns None instead of falling back if the pivots miss the median"""
+    cdef Py_ssize_t n = d.shape[0]
+    cdef bint use_mask = mask is not None
+    if use_mask and mask.shape[0] != n:
+        raise ValueError('Mask must have the same shape as the data')
+    if n == 0:
+        return 0.0
+
+    cdef Py_ssize_t n_chunks = min(PARALLEL_SELECT_CHUNKS, n)
+    cdef Py_ssize_t chunk_size = (n + n_chunks - 1) // n_chunks
+    cdef int64_t[::1] n_unmasked_per_chunk = np.zeros(n_chunks, dtype=np.int64)
+    cdef int64_t[::1] n_below_per_chunk = np.zeros(n_chunks, dtype=np.int64)
+    cdef int64_t[::1] n_between_per_chunk = np.zeros(n_chunks, dtype=np.int64)
+    cdef Py_ssize_t chunk, i, j, start, stop
+    cdef int64_t n_unmasked_in_chunk, n_below, n_between, offset
+
+    # Pick the pivots from a random sample of the unmasked values (read in order, to be kind to the cache)
+    indices = np.random.default_rng(PIVOT_SAMPLE_SEED).integers(0, n, size=min(n, PIVOT_SAMPLE_SIZE))
+    indices.sort()
+    sample = np.asarray(d)[indices]
+    if use_mask:
+        sample = sample[np.asarray(mask)[indices] == 0]
+    sample.sort()
+
+    with nogil:
+        for chunk in prange(n_chunks, schedule='static', num_threads=_num_threads):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n)
+            n_unmasked_in_chunk = 0
+            for i in range(start, stop):
+                if not use_mask or mask[i] == 0:
+                    n_unmasked_in_chunk = n_unmasked_in_chunk + 1
+            n_unmasked_per_chunk[chunk] = n_unmasked_in_chunk
+
+    cdef int64_t n_unmasked = np.asarray(n_unmasked_per_chunk).sum()
+    if n_unmasked == 0:
+        return 0.0
+    cdef int64_t k = (n_unmasked - 1) // 2
+    # The median needs the kth and, if there is an even number of values, the (k + 1)th value
+    cdef int64_t last_rank = k + 1 if n_unmasked % 2 == 0 else k
+
+    cdef float lower_pivot = -INFINITY
+    cdef float upper_pivot = INFINITY
+    cdef Py_ssize_t n_sample = sample.shape[0]
+    cdef Py_ssize_t sample_rank, margin
+    if n_sample > 0:
+        # Four standard deviations of the rank of the median in the sample
+        sample_rank = <Py_ssize_t> (k * n_sample // n_unmasked)
+        margin = <Py_ssize_t> (2.0 * n_sample ** 0.5) + 1
+        if sample_rank - margin >= 0:
+            lower_pivot = sample[sample_rank - margin]
+        if sample_rank + margin < n_sample:
+            upper_pivot = sample[sample_rank + margin]
+
+    cdef float value
+    with nogil:
+        for chunk in prange(n_chunks, schedule='static', num_threads=_num_threads):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n)
+            n_below = 0
+            n_between = 0
+            for i in range(start, stop):
+                if not use_mask or mask[i] == 0:
+                    value = d[i]
+                    if value < lower_pivot:
+                        n_below = n_below + 1
+                    elif value <= upper_pivot:
+                        n_between = n_between + 1
+            n_below_per_chunk[chunk] = n_below
+            n_between_per_chunk[chunk] = n_between
+
+    cdef int64_t total_below = np.asarray(n_below_per_chunk).sum()
+    cdef int64_t total_between = np.asarray(n_between_per_chunk).sum()
+    if not (total_below <= k and last_rank < total_below + total_between):
+        return None
+
+    cdef int64_t[::1] offsets = np.zeros(n_chunks, dtype=np.int64)
+    offset = 0
+    for chunk in range(n_chunks):
+        offsets[chunk] = offset
+        offset += n_between_per_chunk[chunk]
+    cdef float[::1] candidates = np.empty(max(total_between, 1), dtype=np.float32)
+
+    with nogil:
+        for chunk in prange(n_chunks, schedule='static', num_threads=_num_threads):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n)
+            j = offsets[chunk]
+            for i in range(start, stop):
+                if not use_mask or mask[i] == 0:
+                    value = d[i]
+                    if lower_pivot <= value <= upper_pivot:
+                        candidates[j] = value
+                        j = j + 1
+
+    cdef float med
+    with nogil:
+        med = quick_select(&candidates[0], k - total_below, total_between)
+        if n_unmasked % 2 == 0:
+            med += quick_select(&candidates[0], k + 1 - total_below, total_between)
+            med /= 2.0
+    return med
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
@@ -94,7 +277,7 @@ def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
     cdef float* median_array
     cdef int n_unmasked_pixels = 0
 
-    with nogil, parallel():
+    with nogil, parallel(num_threads=_num_threads):
         median_array = <float *> malloc(nx * sizeof(float))
         for j in prange(ny):
             n_unmasked_pixels = 0
@@ -106,3 +289,363 @@ def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
             output_array[j] = _cmedian1d(median_array, n_unmasked_pixels)
         free(median_array)
     return output_array
+
+
+ctypedef fused median_t:
+    float
+    double
+    uint16_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def median_along_axis(const median_t[:, :, :] d not None, const uint8_t[:, :, :] mask=None):
+    """median_along_axis(d, mask=None)\n
+    Median along the middle axis of a 3D array.
+    Parameters
+    ----------
+    d : float32, float64 or uint16 numpy array
+        Input array with shape (n_outer, n, n_inner). Any strides are accepted, so this can be a view
+        of the data with the axis of interest in the middle (see stats.median).
+    mask: unit8 numpy array
+          Numpy array of bitmask values with the same shape as d. Non-zero values are ignored when
+          calculating the median. Boolean masks can be passed as a uint8 view.
+    Returns
+    -------
+    med : float32 numpy array with shape (n_outer, n_inner)
+        The median values.
+    Notes
+    -----
+    The values along the axis are gathered straight from d into a per-thread float32 buffer, so unlike
+    median2d the data does not need to be transposed or cast to float32 first, but the results are
+    identical. As with median2d, if all of the elements along the axis are masked we return zero.
+    """
+    cdef Py_ssize_t n_outer = d.shape[0]
+    cdef Py_ssize_t n = d.shape[1]
+    cdef Py_ssize_t n_inner = d.shape[2]
+    cdef bint use_mask = mask is not None
+    if use_mask and (mask.shape[0] != n_outer or mask.shape[1] != n or mask.shape[2] != n_inner):
+        raise ValueError('Mask must have the same shape as the data')
+
+    output_array = np.zeros((n_outer, n_inner), dtype=np.float32)
+    cdef float[:, ::1] output = output_array
+
+    cdef Py_ssize_t pixel, outer, inner, i
+    cdef int n_unmasked
+    cdef float* scratch
+
+    if n_outer * n_inner > 0 and n > 0:
+        with nogil, parallel(num_threads=_num_threads):
+            scratch = <float *> malloc(n * sizeof(float))
+            for pixel in prange(n_outer * n_inner, schedule='static'):
+                outer = pixel // n_inner
+                inner = pixel % n_inner
+                n_unmasked = 0
+                for i in range(n):
+                    if use_mask and mask[outer, i, inner] != 0:
+                        continue
+                    scratch[n_unmasked] = <float> d[outer, i, inner]
+                    n_unmasked = n_unmasked + 1
+                output[outer, inner] = _cmedian1d(scratch, n_unmasked)
+            free(scratch)
+    return output_array
+
+
+# Scale from the median absolute deviation to the standard deviation of a Gaussian
+MAD_TO_SIGMA = 1.4826
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigma_clipped_mean(const median_t[:, :] d not None, const uint8_t[:, :] mask=None, double nsigma=3.0,
+                       double fill_value=0.0):
+    """sigma_clipped_mean(d, mask=None, nsigma=3.0, fill_value=0.0)\n
+    Mean of the values of a 2D array that are within nsigma robust standard deviations of the median.
+    Parameters
+    ----------
+    d : float32, float64 or uint16 numpy array
+        Input array. Any strides are accepted (e.g. a section of a frame).
+    mask: unit8 numpy array
+          Numpy array of bitmask values with the same shape as d. Non-zero values are ignored.
+    nsigma : float
+             Values more than this many robust standard deviations (1.4826 x the median absolute
+             deviation) from the median are ignored
+    fill_value : float
+                 Returned if there are no values left
+    Returns
+    -------
+    mean : float
+        The sigma clipped mean.
+    Notes
+    -----
+    The unmasked values are copied into a single float32 scratch array. The median is selected from it,
+    it is overwritten with the absolute deviations to select the median absolute deviation, and a final
+    pass over d sums the values that survive the clipping. The medians of more than
+    MIN_PARALLEL_SELECT_SIZE values use parallel_median1d and the other passes are split over threads too.
+    """
+    cdef Py_ssize_t ny = d.shape[0]
+    cdef Py_ssize_t nx = d.shape[1]
+    cdef bint use_mask = mask is not None
+    if use_mask and (mask.shape[0] != ny or mask.shape[1] != nx):
+        raise ValueError('Mask must have the same shape as the data')
+    if ny * nx == 0:
+        return fill_value
+
+    scratch_array = np.empty(ny * nx, dtype=np.float32)
+    cdef float[::1] scratch = scratch_array
+    cdef Py_ssize_t i, j, n_unmasked = 0
+    with nogil:
+        for j in range(ny):
+            for i in range(nx):
+                if not use_mask or mask[j, i] == 0:
+                    scratch[n_unmasked] = <float> d[j, i]
+                    n_unmasked = n_unmasked + 1
+    if n_unmasked == 0:
+        return fill_value
+
+    cdef float median
+    if n_unmasked >= MIN_PARALLEL_SELECT_SIZE:
+        median = parallel_median1d(scratch[:n_unmasked])
+    else:
+        median = _cmedian1d(&scratch[0], n_unmasked)
+    with nogil:
+        for i in prange(n_unmasked, schedule='static', num_threads=_num_threads):
+            scratch[i] = fabs(scratch[i] - median)
+    cdef double threshold
+    if n_unmasked >= MIN_PARALLEL_SELECT_SIZE:
+        threshold = nsigma * MAD_TO_SIGMA * parallel_median1d(scratch[:n_unmasked])
+    else:
+        threshold = nsigma * MAD_TO_SIGMA * _cmedian1d(&scratch[0], n_unmasked)
+
+    cdef double total = 0.0
+    cdef int64_t n_good = 0
+    with nogil:
+        for j in prange(ny, schedule='static', num_threads=_num_threads):
+            for i in range(nx):
+                if use_mask and mask[j, i] != 0:
+                    continue
+                if fabs(<double> d[j, i] - median) <= threshold:
+                    total += d[j, i]
+                    n_good += 1
+    if n_good == 0:
+        return fill_value
+    return total / n_good
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigma_clipped_mean_along_axis(const median_t[:, :, :] d not None, const uint8_t[:, :, :] mask=None,
+                                  double nsigma=3.0, double fill_value=0.0):
+    """sigma_clipped_mean_along_axis(d, mask=None, nsigma=3.0, fill_value=0.0)\n
+    Same as sigma_clipped_mean, along the middle axis of a 3D array.
+    Parameters
+    ----------
+    d : float32, float64 or uint16 numpy array
+        Input array with shape (n_outer, n, n_inner). Any strides are accepted (see median_along_axis).
+    mask: unit8 numpy array
+          Numpy array of bitmask values with the same shape as d. Non-zero values are ignored.
+    nsigma : float
+    fill_value : float
+                 Used where there are no values left
+    Returns
+    -------
+    mean : float64 numpy array with shape (n_outer, n_inner)
+    Notes
+    -----
+    Each thread only needs a scratch buffer of n values: the selection of the median, its replacement by
+    the absolute deviations and the selection of the median absolute deviation all happen in place.
+    """
+    cdef Py_ssize_t n_outer = d.shape[0]
+    cdef Py_ssize_t n = d.shape[1]
+    cdef Py_ssize_t n_inner = d.shape[2]
+    cdef bint use_mask = mask is not None
+    if use_mask and (mask.shape[0] != n_outer or mask.shape[1] != n or mask.shape[2] != n_inner):
+        raise ValueError('Mask must have the same shape as the data')
+
+    output_array = np.full((n_outer, n_inner), fill_value, dtype=np.float64)
+    cdef double[:, ::1] output = output_array
+
+    cdef Py_ssize_t pixel, outer, inner, i
+    cdef int n_unmasked, n_good
+    cdef float median
+    cdef double threshold, total
+    cdef double mad_to_sigma = MAD_TO_SIGMA
+    cdef float* scratch
+
+    if n_outer * n_inner > 0 and n > 0:
+        with nogil, parallel(num_threads=_num_threads):
+            scratch = <float *> malloc(n * sizeof(float))
+            for pixel in prange(n_outer * n_inner, schedule='static'):
+                outer = pixel // n_inner
+                inner = pixel % n_inner
+                n_unmasked = 0
+                for i in range(n):
+                    if use_mask and mask[outer, i, inner] != 0:
+                        continue
+                    scratch[n_unmasked] = <float> d[outer, i, inner]
+                    n_unmasked = n_unmasked + 1
+                if n_unmasked == 0:
+                    continue
+                median = _cmedian1d(scratch, n_unmasked)
+                for i in range(n_unmasked):
+                    scratch[i] = fabs(scratch[i] - median)
+                threshold = nsigma * mad_to_sigma * _cmedian1d(scratch, n_unmasked)
+
+                total = 0.0
+                n_good = 0
+                for i in range(n):
+                    if use_mask and mask[outer, i, inner] != 0:
+                        continue
+                    if fabs(<double> d[outer, i, inner] - median) <= threshold:
+                        total = total + d[outer, i, inner]
+                        n_good = n_good + 1
+                if n_good > 0:
+                    output[outer, inner] = total / n_good
+            free(scratch)
+    return output_array
+
+
+ctypedef fused histogram_t:
+    uint16_t
+    int16_t
+    int32_t
+    uint32_t
+    float
+    double
+
+# Largest range of values we will build a histogram for. Raw 16 bit data always fits; wider ranges use quick select.
+MAX_HISTOGRAM_BINS = 1 << 16
+# Pixels per thread below which it is not worth splitting the histogram
+MIN_HISTOGRAM_CHUNK = 1 << 18
+MAX_HISTOGRAM_CHUNKS = 16
+# Memory budget for the per-thread histograms of a single call
+MAX_HISTOGRAM_BYTES = 1 << 22
+
+
+def get_n_histograms(Py_ssize_t n, Py_ssize_t n_bins):
+    """Number of per-thread histograms histogram_median1d splits n values with n_bins bins between"""
+    n_histograms = min(MAX_HISTOGRAM_CHUNKS, max(1, n // MIN_HISTOGRAM_CHUNK))
+    return max(1, min(n_histograms, MAX_HISTOGRAM_BYTES // (n_bins * sizeof(int64_t))))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def histogram_median1d(histogram_t[::1] d not None, uint8_t[::1] mask=None):
+    """histogram_median1d(d, mask=None)\n
+    Exact median of integer valued data using a histogram of the values rather than quick select.
+    Parameters
+    ----------
+    d : integer or float numpy array
+        Input array to find the median. Float data must only hold integer values.
+    mask: unit8 numpy array
+          Numpy array of bitmask values. Non-zero values are ignored when calculating the median.
+    Returns
+    -------
+    med : float or None
+        The median value, or None if d holds non-integer values or if its values span more than
+        MAX_HISTOGRAM_BINS. In that case use median1d instead.
+    Notes
+    -----
+    The data is read in place (no copy or cast) in two passes, each split over threads: one to find the
+    range of the values and one to count them into per-thread histograms that are then added together.
+    Wide ranges of values use fewer per-thread histograms so that they take at most MAX_HISTOGRAM_BYTES.
+    This is exact and, unlike quick select, does not depend on the order of the data. If all of the
+    elements in the array are masked we return zero, like median1d.
+    """
+    cdef Py_ssize_t n = d.shape[0]
+    cdef bint use_mask = mask is not None
+    if use_mask and mask.shape[0] != n:
+        raise ValueError('Mask must have the same shape as the data')
+
+    cdef Py_ssize_t n_chunks = min(MAX_HISTOGRAM_CHUNKS, max(1, n // MIN_HISTOGRAM_CHUNK))
+    cdef Py_ssize_t chunk_size = (n + n_chunks - 1) // n_chunks
+
+    cdef double[::1] chunk_min = np.empty(n_chunks, dtype=np.float64)
+    cdef double[::1] chunk_max = np.empty(n_chunks, dtype=np.float64)
+    cdef int64_t[::1] chunk_count = np.zeros(n_chunks, dtype=np.int64)
+    cdef uint8_t[::1] chunk_is_integer = np.ones(n_chunks, dtype=np.uint8)
+
+    cdef Py_ssize_t chunk, i, start, stop, index
+    cdef double value, local_min, local_max
+    cdef int64_t local_count
+    cdef uint8_t local_is_integer
+
+    with nogil:
+        for chunk in prange(n_chunks, schedule='static', num_threads=_num_threads):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n)
+            local_min = INFINITY
+            local_max = -INFINITY
+            local_count = 0
+            local_is_integer = 1
+            for i in range(start, stop):
+                if use_mask and mask[i] != 0:
+                    continue
+                value = <double> d[i]
+                if histogram_t is float or histogram_t is double:
+                    if value != floor(value):
+                        local_is_integer = 0
+                        break
+                if value < local_min:
+                    local_min = value
+                if value > local_max:
+                    local_max = value
+                local_count = local_count + 1
+            chunk_min[chunk] = local_min
+            chunk_max[chunk] = local_max
+            chunk_count[chunk] = local_count
+            chunk_is_integer[chunk] = local_is_integer
+
+    cdef int64_t n_unmasked = 0
+    cdef double min_value = INFINITY, max_value = -INFINITY
+    for chunk in range(n_chunks):
+        if chunk_is_integer[chunk] == 0:
+            return None
+        n_unmasked += chunk_count[chunk]
+        min_value = min(min_value, chunk_min[chunk])
+        max_value = max(max_value, chunk_max[chunk])
+    if n_unmasked == 0:
+        return 0.0
+    if not max_value - min_value < MAX_HISTOGRAM_BINS:
+        return None
+
+    cdef Py_ssize_t n_bins = <Py_ssize_t> (max_value - min_value) + 1
+    n_chunks = get_n_histograms(n, n_bins)
+    chunk_size = (n + n_chunks - 1) // n_chunks
+    cdef int64_t[:, ::1] chunk_histograms = np.zeros((n_chunks, n_bins), dtype=np.int64)
+    with nogil:
+        for chunk in prange(n_chunks, schedule='static', num_threads=_num_threads):
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, n)
+            for i in range(start, stop):
+                if use_mask and mask[i] != 0:
+                    continue
+                index = <Py_ssize_t> (<double> d[i] - min_value)
+                if 0 <= index < n_bins:
+                    chunk_histograms[chunk, index] += 1
+
+    cdef int64_t[::1] histogram = np.asarray(chunk_histograms).sum(axis=0)
+    # Values that did not land in a bin (e.g. NaNs that slipped through) mean we cannot trust the histogram
+    cdef int64_t n_counted = 0
+    for index in range(n_bins):
+        n_counted += histogram[index]
+    if n_counted != n_unmasked:
+        return None
+
+    # Same convention as _cmedian1d: the mean of the middle two values if there are an even number of them
+    cdef int64_t k = (n_unmasked - 1) // 2
+    cdef int64_t cumulative = 0
+    cdef float med = 0.0
+    cdef bint found_lower = False
+    for index in range(n_bins):
+        cumulative += histogram[index]
+        if not found_lower and cumulative > k:
+            med = <float> (min_value + index)
+            found_lower = True
+            if n_unmasked % 2 == 1:
+                break
+        if found_lower and cumulative > k + 1:
+            med += <float> (min_value + index)
+            med /= 2.0
+            break
+    return med
@@ -0,0 +1,233 @@
+"""Uncompressed, memory-mappable copies of FITS files.
+
+A mapped file holds one or more members (e.g. several master calibrations in a calibration bundle). It is laid out as
+
+    magic (8 bytes) | padding | array | padding | array ... | JSON index | index length (8 bytes, little endian) | magic
+
+The index stores any metadata about each member (filename, frameid, ...) and the header of each of its HDUs
+along with the dtype, shape and byte offset of the HDU data. Every array starts on a page boundary so it can be
+memory mapped directly. Opening a mapped file costs a JSON parse and page faults when the pixels are read instead
+of reading and decompressing the whole file. The index is written last so members can be written one at a time.
+"""
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+
+MAGIC = b'BANZAIMM'
+PAGE_SIZE = 4096
+MAPPED_FILE_SUFFIX = '.mmap'
+TRAILER_SIZE = 8 + len(MAGIC)
+INDEX_CACHE_SIZE = 32
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def _align(n_bytes):
+    return (n_bytes + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+def _descr_to_dtype(descr):
+    # json turns the (name, format) tuples of structured dtypes into lists which numpy will not accept
+    if isinstance(descr, list):
+        return np.dtype([tuple(_descr_to_dtype(field) if isinstance(field, list) else field for field in column)
+                         for column in descr])
+    return np.dtype(descr)
+
+
+def is_mapped_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (OSError, TypeError):
+        return False
+
+
+def get_sidecar_path(path):
+    """
+    Path to the decompressed, memory-mappable copy of a FITS file written next to it.
+
+    Returns
+    -------
+    sidecar_path: str or None
+                  None if there is no sidecar or if the FITS file has been modified since the sidecar was written
+    """
+    sidecar_path = path + MAPPED_FILE_SUFFIX
+    try:
+        if os.path.getmtime(sidecar_path) >= os.path.getmtime(path):
+            return sidecar_path
+    except OSError:
+        pass
+    return None
+
+
+def get_mapped_file_size(hdu_list):
+    """Approximate number of bytes a mapped copy of hdu_list will take on disk"""
+    index_size = sum(len(hdu.header.tostring()) + 256 for hdu in hdu_list)
+    return PAGE_SIZE + sum(_align(hdu.data.nbytes) for hdu in hdu_list if hdu.data is not None) + index_size
+
+
+class MappedFileWriter:
+    """
+    Write members to a mapped file one at a time.
+
+    The file is written to a temporary file in the same directory and renamed into place when the writer is
+    closed, so other processes never see a partially written file. Use as a context manager:
+
+        with MappedFileWriter(path) as writer:
+            writer.add_member(hdu_list, filename='bias.fits.fz', frameid=1234)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.members = []
+        self._file = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(path)), delete=False)
+        self._file.write(MAGIC)
+        self._offset = PAGE_SIZE
+
+    def add_member(self, hdu_list, **metadata):
+        """
+        Parameters
+        ----------
+        hdu_list: astropy.io.fits.HDUList
+                  Uncompressed hdu list, e.g. as returned by fits_utils.open_fits_file
+        metadata:
+                  Anything else to store about this member in the index. Must be json serializable.
+        """
+        member = {**metadata, 'hdus': []}
+        for hdu in hdu_list:
+            entry = {'header': hdu.header.tostring(), 'kind': None}
+            if hdu.data is not None:
+                if isinstance(hdu, fits.BinTableHDU):
+                    entry['kind'] = 'table'
+                    array = hdu.data.view(np.ndarray)
+                else:
+                    entry['kind'] = 'image'
+                    array = hdu.data
+                array = np.ascontiguousarray(array)
+                entry['dtype'] = np.lib.format.dtype_to_descr(array.dtype)
+                entry['shape'] = list(array.shape)
+                entry['offset'] = self._offset
+                self._file.seek(self._offset)
+                self._file.write(array.data)
+                self._offset += _align(array.nbytes)
+            member['hdus'].append(entry)
+        self.members.append(member)
+
+    def close(self):
+        encoded_index = json.dumps({'members': self.members}).encode()
+        self._file.seek(self._offset)
+        self._file.write(encoded_index)
+        self._file.write(len(encoded_index).to_bytes(8, 'little'))
+        self._file.write(MAGIC)
+        self._file.close()
+        os.replace(self._file.name, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._file.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_mapped_file(path, hdu_list, filename, frame_id=None):
+    """
+    Write an uncompressed hdu list to a memory-mappable file.
+
+    Parameters
+    ----------
+    path: str
+          Output path
+    hdu_list: astropy.io.fits.HDUList
+              Uncompressed hdu list, e.g. as returned by fits_utils.open_fits_file
+    filename: str
+              Name of the original file
+    frame_id: int
+              Archive frame id of the original file
+    """
+    with MappedFileWriter(path) as writer:
+        writer.add_member(hdu_list, filename=filename, frameid=frame_id)
+
+
+def read_index(path):
+    """
+    Read the index of a mapped file.
+
+    The parsed index is cached per process. Mapped files are always renamed into place when they are rewritten,
+    so the inode, size and modification time tell us whether the cached copy is still valid.
+
+    Returns
+    -------
+    members: list of dict
+             Metadata for each member. The 'hdus' entry describes the layout of the member's HDUs.
+    """
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _index_cache_lock:
+        if path in _index_cache and _index_cache[path][0] == key:
+            _index_cache.move_to_end(path)
+            return _index_cache[path][1]
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a memory mapped FITS file')
+        f.seek(-TRAILER_SIZE, os.SEEK_END)
+        index_length = int.from_bytes(f.read(8), 'little')
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is incomplete')
+        f.seek(-TRAILER_SIZE - index_length, os.SEEK_END)
+        members = json.loads(f.read(index_length))['members']
+
+    with _index_cache_lock:
+        _index_cache[path] = (key, members)
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return members
+
+
+def read_mapped_file(path, member=0, copy_on_write=False):
+    """
+    Open a member of a file written by MappedFileWriter (or write_mapped_file).
+
+    Parameters
+    ----------
+    path: str
+    member: int
+            Index of the member to open
+    copy_on_write: bool
+                   Map the data copy-on-write so it can be modified in place. Modified pages are private to this
+                   process and are never written back to the file.
+
+    Returns
+    -------
+    hdu_list, filename, frame_id: astropy.io.fits.HDUList, str, int
+        The data in each HDU is a read-only (or copy-on-write) memory map of the file.
+    """
+    member_index = read_index(path)[member]
+    hdu_list = fits.HDUList()
+    for i, entry in enumerate(member_index['hdus']):
+        header = fits.Header.fromstring(entry['header'])
+        data = None
+        if entry['kind'] is not None and 0 in entry['shape']:
+            data = np.zeros(tuple(entry['shape']), dtype=_descr_to_dtype(entry['dtype']))
+        elif entry['kind'] is not None:
+            data = np.memmap(path, mode='c' if copy_on_write else 'r', dtype=_descr_to_dtype(entry['dtype']),
+                             shape=tuple(entry['shape']), offset=entry['offset'])
+        if entry['kind'] == 'table':
+            hdu_list.append(fits.BinTableHDU(data=data, header=header))
+        elif i == 0:
+            hdu_list.append(fits.PrimaryHDU(data=data, header=header))
+        else:
+            hdu_list.append(fits.ImageHDU(data=data, header=header))
+    return hdu_list, member_index.get('filename'), member_index.get('frameid')
@@ -11,17 +11,11 @@ logger = logs.get_logger()
 
 
 def set_file_as_processed(path, db_address):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    if image is not None:
-        image.success = True
-        dbs.commit_processed_image(image, db_address=db_address)
+    dbs.mark_success(path, db_address=db_address)
 
 
 def increment_try_number(path, db_address):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    # Otherwise increment the number of tries
-    image.tries += 1
-    dbs.commit_processed_image(image, db_address=db_address)
+    dbs.mark_try(path, db_address=db_address)
 
 
 def need_to_process_image(file_info, context, task):
@@ -65,27 +59,19 @@ def need_to_process_image(file_info, context, task):
                      extra_tags={"filename": filename})
         return False
 
-    # Get the image in db. If it doesn't exist add it.
-    image = dbs.get_processed_image(filename, db_address=context.db_address)
-    # If this is an message on the archived_fits queue, then update the frameid
-    image.frameid = file_info.get('frameid')
+    # Add the image to the db if it isn't there already. If the file has changed on disk/in s3 (the md5 is
+    # different), this resets the success flag and the number of tries.
+    # If this is an message on the archived_fits queue, this also updates the frameid
+    image = dbs.claim_frame(filename, checksum, file_info.get('frameid'), db_address=context.db_address)
 
     need_to_process = False
-    # Check the md5.
-    # Reset the number of tries if the file has changed on disk/in s3
-    if image.checksum != checksum:
+    if image.checksum_changed:
         logger.info('File has changed on disk. Resetting success flags and tries', extra_tags={'filename': filename})
         need_to_process = True
-        image.checksum = checksum
-        image.tries = 0
-        image.success = False
-        dbs.commit_processed_image(image, context.db_address)
-
     # Check if we need to try again
     elif image.tries < context.max_tries and not image.success:
         logger.info('File has not been successfully processed yet. Trying again.', extra_tags={'filename': filename})
         need_to_process = True
-        dbs.commit_processed_image(image, context.db_address)
 
     # if we are pulling off the archived fits queue, make sure that the header can make a valid image object before
     # bothering to pull it from s3
@@ -0,0 +1,100 @@
+"""Scratch storage for the pixel arrays of frames being reduced.
+
+Large arrays are spilled to memory mapped scratch files (ideally on tmpfs or local NVMe) so that the pages can be
+dropped when memory is tight. Each scratch file is unlinked and closed as soon as it is mapped: the mapping keeps
+the pages alive until the array (and every view of it) is gone, at which point the kernel frees them. Unlike
+keeping a list of temporary files around, a worker's scratch space and open files only ever cover the frames it
+is working on, however many frames it reduces.
+"""
+import mmap
+import sys
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+from banzai import settings
+
+# Before python 3.13, mmap keeps a duplicate of the file descriptor open for as long as the mapping exists
+MMAP_KWARGS = {'trackfd': False} if sys.version_info >= (3, 13) else {}
+
+
+class ScratchStorage:
+    """
+    Allocate arrays, spilling the large ones to scratch files
+
+    Parameters
+    ----------
+    directory: str
+               Directory for the scratch files. None uses the system temporary directory.
+    max_bytes: int
+               Quota for the scratch files of this process. Arrays that do not fit are kept in memory.
+    min_bytes: int
+               Arrays smaller than this are always kept in memory
+    """
+    def __init__(self, directory=None, max_bytes=0, min_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self.used_bytes = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, n_bytes):
+        with self._lock:
+            if n_bytes < self.min_bytes or self.used_bytes + n_bytes > self.max_bytes:
+                return False
+            self.used_bytes += n_bytes
+            return True
+
+    def _release(self, n_bytes):
+        with self._lock:
+            self.used_bytes -= n_bytes
+
+    def zeros(self, shape, dtype):
+        """Array of zeros that is mapped from a scratch file if it is large enough and fits in the quota"""
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        if n_bytes == 0 or not self._reserve(n_bytes):
+            return np.zeros(shape, dtype=dtype)
+        try:
+            # The file is removed as soon as it is closed (if it was ever linked), but the pages we have mapped
+            # stay until the mapping is gone. New files are full of zeros.
+            with tempfile.TemporaryFile(dir=self.directory) as file_handle:
+                file_handle.truncate(n_bytes)
+                scratch_buffer = mmap.mmap(file_handle.fileno(), n_bytes, **MMAP_KWARGS)
+        except OSError:
+            self._release(n_bytes)
+            return np.zeros(shape, dtype=dtype)
+        # The arrays (and their views) keep the mapping alive, so this runs when the last of them is gone
+        weakref.finalize(scratch_buffer, self._release, n_bytes)
+        return np.frombuffer(scratch_buffer, dtype=dtype).reshape(shape)
+
+    def copy(self, array):
+        """Copy of array in scratch storage (see zeros)"""
+        scratch_array = self.zeros(array.shape, array.dtype)
+        scratch_array[...] = array
+        return scratch_array
+
+
+_scratch_storage = None
+
+
+def get_scratch_storage():
+    """
+    Get the scratch storage for this process, creating it from the settings if necessary.
+    """
+    global _scratch_storage
+    if _scratch_storage is None:
+        _scratch_storage = ScratchStorage(settings.SCRATCH_DIRECTORY, settings.SCRATCH_MAX_BYTES,
+                                          settings.SCRATCH_MIN_BYTES)
+    return _scratch_storage
+
+
+def configure_scratch_storage(runtime_context):
+    """Apply the scratch settings of runtime_context to the scratch storage of this process"""
+    scratch_storage = get_scratch_storage()
+    scratch_storage.directory = runtime_context.SCRATCH_DIRECTORY
+    scratch_storage.max_bytes = runtime_context.SCRATCH_MAX_BYTES
+    scratch_storage.min_bytes = runtime_context.SCRATCH_MIN_BYTES
+    return scratch_storage
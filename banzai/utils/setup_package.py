@@ -27,4 +27,16 @@ def get_extensions():
 
     add_openmp_flags_if_available(ext_med)
 
-    return [ext_med]
+    stack_sources = [str(os.path.join(UTIL_DIR, "stack_utils.pyx")),
+                     str(os.path.join(UTIL_DIR, "quick_select.c"))]
+
+    ext_stack = Extension(name=str('banzai.utils.stack_utils'),
+                          sources=stack_sources,
+                          include_dirs=include_dirs,
+                          libraries=libraries,
+                          language="c",
+                          extra_compile_args=extra_compile_args)
+
+    add_openmp_flags_if_available(ext_stack)
+
+    return [ext_med, ext_stack]
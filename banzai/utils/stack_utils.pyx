@@ -0,0 +1,124 @@
+# cython: boundscheck=False, nonecheck=False, wraparound=False
+# cython: cdivision=True
+# cython: language_level=3
+from __future__ import absolute_import, division, print_function, unicode_literals
+from libc.stdint cimport uint8_t
+from libc.stdlib cimport malloc, free
+from libc.math cimport fabs, sqrt
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel import parallel, prange
+
+from banzai.utils.median_utils import get_num_threads
+
+np.import_array()
+
+cdef extern from "quick_select.h":
+    float quick_select(float * k, int k, int n) nogil
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef float _cmedian(float* ptr, int n) nogil:
+    # Same as median_utils._cmedian1d: the median of the first n elements of ptr (which get reordered)
+    cdef float med = 0.0
+    cdef int k = (n - 1) // 2
+    if n > 0:
+        med = quick_select(ptr, k, n)
+        if n % 2 == 0:
+            med += quick_select(ptr, k + 1, n)
+            med /= 2.0
+    return med
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigma_clipped_stack(float[:, :, ::1] data not None, float[:, :, ::1] uncertainty not None,
+                        uint8_t[:, :, ::1] mask not None, float nsigma_reject):
+    """sigma_clipped_stack(data, uncertainty, mask, nsigma_reject)\n
+    Sigma clipped mean of a stack of images, one pixel at a time.
+    Parameters
+    ----------
+    data : float32 numpy array
+           Stack of images with shape (n_images, ny, nx)
+    uncertainty : float32 numpy array
+                  Uncertainty of each pixel in data
+    mask : uint8 numpy array
+           Bitmask of each pixel in data. Non-zero values are ignored.
+    nsigma_reject : float
+                    Pixels more than this many robust standard deviations (1.4826 x the median absolute
+                    deviation) from the median of the unmasked pixels are ignored
+    Returns
+    -------
+    stacked_data, stacked_uncertainty, stacked_mask : float32, float32, and uint8 numpy arrays with shape (ny, nx)
+        The mean of the remaining pixels, their uncertainties added in quadrature divided by the number of pixels,
+        and a mask that is only set when no pixels remain.
+    Notes
+    -----
+    This gives the same results as banzai.data.stack did using numpy, but rather than building several
+    temporary arrays the size of the whole stack, each thread only needs scratch space for one pixel of each
+    image. If every image is rejected for a pixel, we use the mean of all of the images and take the bitwise
+    or of their masks.
+    """
+    cdef int n_images = data.shape[0]
+    cdef int ny = data.shape[1]
+    cdef int nx = data.shape[2]
+
+    stacked_data_array = np.zeros((ny, nx), dtype=np.float32)
+    stacked_uncertainty_array = np.zeros((ny, nx), dtype=np.float32)
+    stacked_mask_array = np.zeros((ny, nx), dtype=np.uint8)
+    cdef float[:, ::1] stacked_data = stacked_data_array
+    cdef float[:, ::1] stacked_uncertainty = stacked_uncertainty_array
+    cdef uint8_t[:, ::1] stacked_mask = stacked_mask_array
+
+    cdef int i, j, k
+    cdef int n_unmasked, n_good
+    cdef float median, threshold
+    cdef double total, variance
+    cdef uint8_t combined_mask
+    cdef float* scratch
+    cdef int num_threads = get_num_threads()
+
+    with nogil, parallel(num_threads=num_threads):
+        scratch = <float *> malloc(n_images * sizeof(float))
+        for j in prange(ny):
+            for i in range(nx):
+                n_unmasked = 0
+                for k in range(n_images):
+                    if mask[k, j, i] == 0:
+                        scratch[n_unmasked] = data[k, j, i]
+                        n_unmasked = n_unmasked + 1
+                median = _cmedian(scratch, n_unmasked)
+
+                n_unmasked = 0
+                for k in range(n_images):
+                    if mask[k, j, i] == 0:
+                        scratch[n_unmasked] = fabs(data[k, j, i] - median)
+                        n_unmasked = n_unmasked + 1
+                threshold = nsigma_reject * (<float> 1.4826 * _cmedian(scratch, n_unmasked))
+
+                n_good = 0
+                total = 0.0
+                variance = 0.0
+                for k in range(n_images):
+                    if mask[k, j, i] == 0 and fabs(data[k, j, i] - median) <= threshold:
+                        n_good = n_good + 1
+                        total = total + data[k, j, i]
+                        variance = variance + uncertainty[k, j, i] * uncertainty[k, j, i]
+
+                if n_good == 0:
+                    # Every image is bad for this pixel so fall back to all of them
+                    combined_mask = 0
+                    for k in range(n_images):
+                        combined_mask = combined_mask | mask[k, j, i]
+                        total = total + data[k, j, i]
+                        variance = variance + uncertainty[k, j, i] * uncertainty[k, j, i]
+                    n_good = n_images
+                    stacked_mask[j, i] = combined_mask
+
+                stacked_data[j, i] = total / n_good
+                stacked_uncertainty[j, i] = sqrt(variance) / n_good
+        free(scratch)
+    return stacked_data_array, stacked_uncertainty_array, stacked_mask_array
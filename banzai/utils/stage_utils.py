@@ -1,6 +1,14 @@
-from banzai.utils import import_utils
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from banzai.utils import import_utils, median_utils
+from banzai.utils.scratch_utils import configure_scratch_storage
 from banzai.context import Context
-from banzai.logs import get_logger
+from banzai import calibrations
+from banzai.cache.accumulator import accumulate_calibration_frame
+from banzai import logs
+from banzai.logs import get_logger, format_exception
 from banzai.metrics import trace_function
 
 logger = get_logger()
@@ -39,10 +47,84 @@ def get_stages_for_individual_frame(ordered_stages, last_stage=None, extra_stage
     return stages_todo
 
 
+def add_calibration_plan(images, stages, runtime_context):
+    """Resolve the master calibrations for every calibration stage at once and hand the plan to those stages"""
+    calibration_stages = [stage for stage in stages if isinstance(stage, calibrations.CalibrationUser)]
+    if not calibration_stages:
+        return
+    try:
+        plan = calibrations.resolve_master_calibrations(images, calibration_stages, runtime_context)
+    except Exception:
+        # Each stage can still look up its own masters
+        logger.error(f'Could not resolve master calibrations ahead of time: {format_exception()}')
+        return
+    for stage in calibration_stages:
+        stage.calibration_plan = plan
+
+
+def map_images(function, images, executor=None):
+    """function applied to each of images, on the threads of executor if we have one, in order"""
+    if executor is None:
+        return [function(image) for image in images]
+    # Copy the context for each thread so that telemetry from the threads ends up in the current span
+    futures = [executor.submit(contextvars.copy_context().run, function, image) for image in images]
+    return [future.result() for future in futures]
+
+
 @trace_function("run_pipeline_stages")
 def run_pipeline_stages(image_paths: list, runtime_context: Context, calibration_maker: bool = False):
+    configure_scratch_storage(runtime_context)
+    # Opening a frame is mostly waiting on downloads and decompression, so open (and later write) the frames on
+    # a pool of threads
+    n_threads = min(runtime_context.PIPELINE_THREADS, len(image_paths))
+    executor = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 1 else None
+    # Stages only process several frames at once if STAGE_THREADS is set
+    n_stage_threads = max(1, min(runtime_context.STAGE_THREADS, len(image_paths)))
+    stage_executor = ThreadPoolExecutor(max_workers=n_stage_threads) if n_stage_threads > 1 else None
+    configure_kernel_threads(n_stage_threads)
+    group_executor = get_group_executor(runtime_context)
+    try:
+        _run_pipeline_stages(image_paths, runtime_context, calibration_maker, executor, stage_executor,
+                             group_executor)
+    finally:
+        for pool in [executor, stage_executor, group_executor]:
+            if pool is not None:
+                pool.shutdown()
+
+
+def configure_kernel_threads(n_threads_sharing_cores):
+    """Split the threads of the parallel median and stacking functions between threads that call them at once"""
+    median_utils.set_num_threads(median_utils.DEFAULT_NUM_THREADS // max(1, n_threads_sharing_cores))
+
+
+def get_group_executor(runtime_context):
+    """
+    Process pool for stages to run independent groups of images on, or None if STAGE_GROUP_PROCESSES is not set
+    or we cannot start processes from here (daemonic processes cannot have children). The processes are only
+    started when a stage has more than one group to run.
+    """
+    n_processes = runtime_context.STAGE_GROUP_PROCESSES
+    if n_processes < 2 or multiprocessing.current_process().daemon:
+        return None
+    # Spawn rather than fork: this process may have other threads (e.g. the pool above) running
+    return ProcessPoolExecutor(max_workers=n_processes, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=configure_group_process,
+                               initargs=(runtime_context, logs.get_log_level(), n_processes))
+
+
+def configure_group_process(runtime_context, log_level, n_processes):
+    """
+    Set up a (freshly spawned) process of the group executor like the process that started it: same log level and
+    scratch storage, with the cores shared between the n_processes processes
+    """
+    logs.set_log_level(log_level)
+    configure_scratch_storage(runtime_context)
+    configure_kernel_threads(n_processes)
+
+
+def _run_pipeline_stages(image_paths, runtime_context, calibration_maker, executor, stage_executor, group_executor):
     frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
-    images = [frame_factory.open(image_path, runtime_context) for image_path in image_paths]
+    images = map_images(lambda image_path: frame_factory.open(image_path, runtime_context), image_paths, executor)
     images = [image for image in images if image is not None]
     if len(images) == 0:
         return
@@ -53,13 +135,23 @@ def run_pipeline_stages(image_paths: list, runtime_context: Context, calibration
                                                        last_stage=runtime_context.LAST_STAGE[images[0].obstype.upper()],
                                                        extra_stages=runtime_context.EXTRA_STAGES[images[0].obstype.upper()])
 
-    for stage_name in stages_to_do:
-        stage_constructor = import_utils.import_attribute(stage_name)
-        stage = stage_constructor(runtime_context)
+    stages = [import_utils.import_attribute(stage_name)(runtime_context) for stage_name in stages_to_do]
+    add_calibration_plan(images, stages, runtime_context)
+    for stage in stages:
+        stage.executor = stage_executor
+        stage.group_executor = group_executor
+
+    for stage in stages:
         images = stage.run(images)
 
         if not images:
             return
 
-    for image in images:
-        image.write(runtime_context)
+    map_images(lambda image: write_image(image, runtime_context, calibration_maker), images, executor)
+
+
+def write_image(image, runtime_context, calibration_maker=False):
+    image.write(runtime_context)
+    if not calibration_maker:
+        # Get individual calibration frames ready to stack as soon as they are reduced
+        accumulate_calibration_frame(image, runtime_context)
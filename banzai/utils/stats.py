@@ -5,6 +5,11 @@ from banzai.utils import median_utils
 
 __author__ = 'cmccully'
 
+# Types we can take an exact histogram median of without a copy (see median_utils.histogram_median1d)
+HISTOGRAM_MEDIAN_DTYPES = [np.uint16, np.int16, np.int32, np.uint32, np.float32, np.float64]
+AXIS_MEDIAN_DTYPES = [np.float32, np.float64, np.uint16]
+CLIPPED_MEAN_DTYPES = AXIS_MEDIAN_DTYPES
+
 
 def median(d, axis=None, mask=None):
     """
@@ -31,9 +36,15 @@ def median(d, axis=None, mask=None):
     -----
     Makes extensive use of the quick select algorithm written in C, included in quick_select.c.
     If all of the elements in the array are masked (or all of the elements of the axis of interest
-    are masked), we return zero.
+    are masked), we return zero. When axis is None and the data are integer valued (like raw frames),
+    the median is taken from a histogram of the values instead, which is exact and does not copy the data.
+    Medians along an axis of float32, float64 or uint16 data are read in place by
+    median_utils.median_along_axis, without transposing or casting the data to float32.
     """
     if axis is None:
+        histogram_median = _histogram_median(d, mask)
+        if histogram_median is not None:
+            return histogram_median
         if mask is not None:
             median_mask = mask.ravel()
         else:
@@ -41,25 +52,66 @@ def median(d, axis=None, mask=None):
         output_median = median_utils.median1d(np.ascontiguousarray(d.ravel(), dtype=np.float32),
                                               np.ascontiguousarray(median_mask, dtype=np.uint8))
     else:
+        output_median = _median_along_axis(d, axis, mask)
+        if output_median is None:
+            nx = d.shape[axis]
+            ny = d.size // nx
 
-        nx = d.shape[axis]
-        ny = d.size // nx
+            output_shape = np.delete(d.shape, axis)
 
-        output_shape = np.delete(d.shape, axis)
+            if mask is not None:
+                median_mask = np.rollaxis(mask, axis, len(d.shape)).reshape(ny, nx).astype(np.uint8)
+            else:
+                median_mask = np.zeros((ny, nx), dtype=np.uint8)
 
-        if mask is not None:
-            median_mask = np.rollaxis(mask, axis, len(d.shape)).reshape(ny, nx).astype(np.uint8)
-        else:
-            median_mask = np.zeros((ny, nx), dtype=np.uint8)
-
-        med = median_utils.median2d(np.ascontiguousarray(np.rollaxis(d, axis, len(d.shape)).reshape(ny, nx), dtype=np.float32),
-                                    mask=np.ascontiguousarray(median_mask, dtype=np.uint8))
-        median_array = np.array(med)
-        output_median = median_array.reshape(output_shape)
+            med = median_utils.median2d(np.ascontiguousarray(np.rollaxis(d, axis, len(d.shape)).reshape(ny, nx),
+                                                             dtype=np.float32),
+                                        mask=np.ascontiguousarray(median_mask, dtype=np.uint8))
+            median_array = np.array(med)
+            output_median = median_array.reshape(output_shape)
 
     return output_median
 
 
+def _as_uint8_mask(mask):
+    if mask.dtype == bool:
+        # Same size, so we can reinterpret the mask rather than copying it
+        return mask.view(np.uint8)
+    return mask.astype(np.uint8, copy=False)
+
+
+def _histogram_median(d, mask=None):
+    """Median from median_utils.histogram_median1d, or None if we have to use quick select"""
+    d = np.asanyarray(d)
+    if d.dtype not in HISTOGRAM_MEDIAN_DTYPES or d.dtype.byteorder not in '=|' or not d.flags.c_contiguous:
+        return None
+    if mask is not None:
+        if mask.shape != d.shape or not mask.flags.c_contiguous:
+            return None
+        mask = _as_uint8_mask(np.asarray(mask)).ravel()
+    return median_utils.histogram_median1d(np.asarray(d).ravel(), mask)
+
+
+def _median_along_axis(d, axis, mask=None):
+    """Median from median_utils.median_along_axis, or None if we have to cast and transpose for median2d"""
+    d = np.asarray(d)
+    if d.dtype not in AXIS_MEDIAN_DTYPES or d.dtype.byteorder not in '=|':
+        return None
+    if mask is not None:
+        mask = np.asarray(mask)
+        if mask.shape != d.shape:
+            return None
+    axis = axis % d.ndim
+    output_shape = d.shape[:axis] + d.shape[axis + 1:]
+    # Put the axis of interest in the middle. For contiguous data (and any data where the axes either side
+    # can be merged) these are views, so the kernel reads the values straight from d.
+    shape = (int(np.prod(d.shape[:axis])), d.shape[axis], int(np.prod(d.shape[axis + 1:])))
+    d = d.reshape(shape)
+    if mask is not None:
+        mask = _as_uint8_mask(mask).reshape(shape)
+    return median_utils.median_along_axis(d, mask).reshape(output_shape)
+
+
 def absolute_deviation(a, axis=None, mask=None):
     """
     Find the absolute deviation from the median of a numpy array. If an axis is provided,
@@ -106,37 +158,208 @@ def robust_standard_deviation(a, axis=None, abs_deviation=None, mask=None):
 
 def sigma_clipped_mean(a, sigma, axis=None, mask=None, fill_value=0.0, inplace=False):
     """
+    Find the mean of the values of a numpy array that are within sigma robust standard deviations
+    (1.4826 x the median absolute deviation) of the median. If an axis is provided, then find the
+    mean along the given axis.
+
+    Parameters
+    ----------
+    a : numpy array
+        Input array
+    sigma : float
+            Values more than this many robust standard deviations from the median are ignored
+    axis : int (default is None)
+           Index of the array to take the mean along
+    mask : unit8 or boolean numpy array (default is None)
+          Numpy array of bitmask values. Non-zero values are ignored.
+    fill_value : float
+                 Returned where there are no values left
+    inplace : bool
+              Not used. a is never modified. Kept for backwards compatibility.
+
+    Returns
+    -------
+    mean : float or float64 numpy array
+        The sigma clipped mean. If axis is None, then we return a single float.
+
+    Notes
+    -----
+    The median, median absolute deviation, clipping and mean are all done by
+    median_utils.sigma_clipped_mean(_along_axis) without the GIL and with a single scratch buffer,
+    reading float32, float64 and uint16 data in place. Other data types are converted to float64 first.
+    """
+    a = np.asarray(a)
+    if a.dtype not in CLIPPED_MEAN_DTYPES or a.dtype.byteorder not in '=|':
+        a = a.astype(np.float64)
+    if mask is not None:
+        mask = _as_uint8_mask(np.broadcast_to(mask, a.shape))
+    if axis is None:
+        if a.size == 0:
+            return fill_value
+        # Keep the last axis so that sections of a frame are still views rather than copies
+        shape = (-1, a.shape[-1]) if a.ndim > 1 else (1, -1)
+        return median_utils.sigma_clipped_mean(a.reshape(shape), None if mask is None else mask.reshape(shape),
+                                               sigma, fill_value)
+
+    axis = axis % a.ndim
+    output_shape = a.shape[:axis] + a.shape[axis + 1:]
+    shape = (int(np.prod(a.shape[:axis])), a.shape[axis], int(np.prod(a.shape[axis + 1:])))
+    mean_values = median_utils.sigma_clipped_mean_along_axis(a.reshape(shape),
+                                                             None if mask is None else mask.reshape(shape),
+                                                             sigma, fill_value)
+    return mean_values.reshape(output_shape)
+
+
+DEFAULT_SAMPLE_SIZE = 100000
+# Two sided 99.9% confidence intervals for the sampled estimates
+SAMPLE_CONFIDENCE_Z = 3.29
+# Only sample arrays with at least this many times more pixels than the sample, otherwise the exact
+# statistic is not much more expensive
+MIN_SAMPLING_FACTOR = 10
+
+
+def sample_indices(shape, n_samples, seed=0):
     """
-    abs_deviation = absolute_deviation(a, axis=axis, mask=mask)
+    Stratified random sample of the pixels of an array: split the flattened array into n_samples strata of
+    equal size and pick one pixel at random from each.
 
-    robust_std = robust_standard_deviation(a, axis=axis, abs_deviation=abs_deviation, mask=mask)
+    Parameters
+    ----------
+    shape : tuple
+            Shape of the array to sample
+    n_samples : int
+    seed : int
+           The same seed always gives the same pixels so reductions are reproducible
 
-    if axis is not None:
-        robust_std = np.expand_dims(robust_std, axis=axis)
+    Returns
+    -------
+    index : tuple of numpy arrays
+            Index of the sampled pixels into an array with the given shape
+    """
+    size = int(np.prod(shape))
+    n_samples = min(n_samples, size)
+    stride = size / n_samples
+    random_offsets = np.random.default_rng(seed).uniform(0.0, stride, size=n_samples)
+    flat_index = np.minimum((np.arange(n_samples) * stride + random_offsets).astype(np.int64), size - 1)
+    return np.unravel_index(flat_index, shape)
 
-    # Throw away any values that are N sigma from the median
-    sigma_mask = abs_deviation > (sigma * robust_std)
 
+def _median_confidence_interval(sample):
+    """Distribution free confidence interval for the median of the population from order statistics"""
+    n = sample.size
+    half_width = SAMPLE_CONFIDENCE_Z * np.sqrt(n) / 2.0
+    lower_rank = int(max(np.floor(n / 2.0 - half_width), 0))
+    upper_rank = int(min(np.ceil(n / 2.0 + half_width), n - 1))
+    partitioned = np.partition(sample, [lower_rank, upper_rank])
+    return float(partitioned[lower_rank]), float(partitioned[upper_rank])
+
+
+def _get_sample(a, mask, shape, n_samples, seed):
+    """
+    Sample of the unmasked values of a, or None if the exact statistic should be used instead
+
+    a is either an array, or a function that returns the values at an index into an array with the given shape
+    """
+    if not callable(a):
+        a = np.asarray(a)
+        shape = a.shape
+    size = int(np.prod(shape))
+    if n_samples <= 0 or size < MIN_SAMPLING_FACTOR * n_samples:
+        return None
+    index = sample_indices(shape, n_samples, seed=seed)
+    sample = np.asarray(a(index) if callable(a) else a[index], dtype=np.float64)
     if mask is not None:
-        sigma_mask = np.logical_or(sigma_mask, mask > 0)
-    if inplace:
-        mean_array = a
-    else:
-        mean_array = a.copy()
+        sample = sample[np.asarray(mask)[index] == 0]
+    if sample.size == 0:
+        return None
+    return sample
 
-    mean_array[sigma_mask] = 0.0
 
-    # Take the sigma clipped mean
-    mean_values = mean_array.sum(axis=axis)
+def _all_values(a):
+    return np.asarray(a(Ellipsis) if callable(a) else a)
 
-    n_good_pixels = np.logical_not(sigma_mask).sum(axis=axis)
-    if axis is None:
-        if n_good_pixels > 0:
-            mean_values /= n_good_pixels
-        else:
-            mean_values = fill_value
-    else:
-        mean_values[n_good_pixels > 0] /= n_good_pixels[n_good_pixels > 0]
-        mean_values[n_good_pixels == 0] = fill_value
 
-    return mean_values
+def _is_near_threshold(lower, upper, threshold):
+    return threshold is not None and lower <= threshold <= upper
+
+
+def sampled_median(a, mask=None, threshold=None, n_samples=DEFAULT_SAMPLE_SIZE, shape=None, seed=0):
+    """
+    Estimate the median of an array from a stratified random sample of its pixels.
+
+    Parameters
+    ----------
+    a : numpy array or function
+        Input array, or a function that returns the values at an index into an array of the given shape, so that
+        quantities derived from other arrays (e.g. signal to noise) only need to be computed for the sample
+    mask : unit8 or boolean numpy array (default is None)
+          Numpy array of bitmask values. Non-zero values are ignored.
+    threshold : float (default is None)
+                Decision threshold the median is compared to. If it falls inside the confidence interval of the
+                estimate, the exact median is computed instead so the decision does not depend on the sample.
+    n_samples : int
+                Size of the sample. If 0, or if the array is not much larger than the sample, the exact median
+                is computed.
+    shape : tuple
+            Shape of the array. Only needed if a is a function.
+    seed : int
+
+    Returns
+    -------
+    median, lower, upper : floats
+        The estimate and its 99.9% confidence interval. If the median was computed exactly, lower and upper are
+        equal to the median.
+    """
+    sample = _get_sample(a, mask, shape, n_samples, seed)
+    if sample is not None:
+        lower, upper = _median_confidence_interval(sample)
+        if not _is_near_threshold(lower, upper, threshold):
+            return float(np.median(sample)), lower, upper
+    exact_median = float(median(_all_values(a), mask=mask))
+    return exact_median, exact_median, exact_median
+
+
+def sampled_robust_standard_deviation(a, mask=None, threshold=None, n_samples=DEFAULT_SAMPLE_SIZE, shape=None, seed=0):
+    """
+    Estimate the robust standard deviation (1.4826 x the median absolute deviation) of an array from a
+    stratified random sample of its pixels. The parameters and return values are the same as sampled_median.
+
+    Notes
+    -----
+    The confidence interval comes from the order statistics of the absolute deviations from the median of the
+    sample, so it does not include the (much smaller) uncertainty in the median itself.
+    """
+    sample = _get_sample(a, mask, shape, n_samples, seed)
+    if sample is not None:
+        absolute_deviations = np.abs(sample - np.median(sample))
+        lower, upper = _median_confidence_interval(absolute_deviations)
+        lower, upper = 1.4826 * lower, 1.4826 * upper
+        if not _is_near_threshold(lower, upper, threshold):
+            return 1.4826 * float(np.median(absolute_deviations)), lower, upper
+    exact_std = float(robust_standard_deviation(_all_values(a), mask=mask))
+    return exact_std, exact_std, exact_std
+
+
+def sampled_sigma_clipped_mean(a, sigma, mask=None, threshold=None, n_samples=DEFAULT_SAMPLE_SIZE, shape=None, seed=0):
+    """
+    Estimate the sigma clipped mean (see sigma_clipped_mean) of an array from a stratified random sample of its
+    pixels. The other parameters and the return values are the same as sampled_median.
+
+    Notes
+    -----
+    The confidence interval is from the standard error of the mean of the sampled values that survive the
+    clipping.
+    """
+    sample = _get_sample(a, mask, shape, n_samples, seed)
+    if sample is not None:
+        sample_median = np.median(sample)
+        robust_std = 1.4826 * np.median(np.abs(sample - sample_median))
+        kept = sample[np.abs(sample - sample_median) <= sigma * robust_std]
+        if kept.size > 1:
+            mean = float(kept.mean())
+            half_width = SAMPLE_CONFIDENCE_Z * float(kept.std(ddof=1)) / float(np.sqrt(kept.size))
+            lower, upper = mean - half_width, mean + half_width
+            if not _is_near_threshold(lower, upper, threshold):
+                return mean, lower, upper
+    exact_mean = float(sigma_clipped_mean(_all_values(a), sigma, mask=mask))
+    return exact_mean, exact_mean, exact_mean